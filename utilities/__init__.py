@@ -1,6 +1,14 @@
 import utilities.cluster as cluster
 import utilities.config as config
 import utilities.dataset as dataset
+import utilities.early_stopping as early_stopping
 import utilities.experiment as experiment
+import utilities.hyperband as hyperband
 import utilities.job_factory as job_factory
-import utilities.job as job
\ No newline at end of file
+import utilities.job as job
+import utilities.job_state as job_state
+import utilities.journal as journal
+import utilities.listing_cache as listing_cache
+import utilities.sampling as sampling
+import utilities.search as search
+import utilities.throttling as throttling
\ No newline at end of file
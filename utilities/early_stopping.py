@@ -0,0 +1,210 @@
+from __future__ import print_function
+
+import logging
+import threading
+
+import azure.mgmt.batchai.models as models
+import numpy as np
+
+from utilities.job_state import COMPLETED_STATES
+
+MONITOR_INTERVAL_SECS = 60
+MIN_STEPS = 3
+MIN_JOBS = 3
+
+
+class MedianStoppingRule(object):
+    """
+    Stops a job if, after step s, its best metric value so far is worse than
+    the median of the running averages of the other jobs' metric values over
+    their first s steps.
+    """
+
+    def __init__(self, min_steps=MIN_STEPS, min_jobs=MIN_JOBS,
+                 maximize=False):
+        """
+        :param min_steps: number of metric values a job must report before
+        it can be stopped
+        :param min_jobs: number of other jobs which must have reported at
+        least as many metric values before the rule is applied
+        :param maximize: whether larger metric values are better
+        """
+        self.min_steps = min_steps
+        self.min_jobs = min_jobs
+        self.maximize = maximize
+
+    def should_stop(self, job_key, series, all_series):
+        """
+        :param job_key: the (job name, creation time) of the job to decide
+        on. A job resubmitted under the same name has a new key.
+        :param series: list of metric values reported by the job so far
+        :param all_series: dict of (job name, creation time) to list of
+        metric values, for all jobs observed by the monitor
+        :return: True if the job should be terminated
+        """
+        step = len(series)
+        if step < self.min_steps:
+            return False
+        averages = [np.mean(other[:step])
+                    for key, other in all_series.items()
+                    if key != job_key and len(other) >= step]
+        if len(averages) < self.min_jobs:
+            return False
+        median = np.median(averages)
+        if self.maximize:
+            return max(series) < median
+        return min(series) > median
+
+
+class ThresholdRule(object):
+    """
+    Stops a job whose latest metric value is worse than a threshold, which
+    may depend on the number of values reported so far (e.g. an expected
+    learning curve).
+    """
+
+    def __init__(self, threshold, min_steps=1, maximize=False):
+        """
+        :param threshold: a number, or a function taking the number of metric
+        values reported so far and returning the threshold for that step
+        :param min_steps: number of metric values a job must report before
+        it can be stopped
+        :param maximize: whether larger metric values are better
+        """
+        self.threshold = threshold
+        self.min_steps = min_steps
+        self.maximize = maximize
+
+    def should_stop(self, job_key, series, all_series):
+        """
+        See MedianStoppingRule.should_stop.
+        """
+        step = len(series)
+        if step < self.min_steps:
+            return False
+        if callable(self.threshold):
+            threshold = self.threshold(step)
+        else:
+            threshold = self.threshold
+        if self.maximize:
+            return series[-1] < threshold
+        return series[-1] > threshold
+
+
+class EarlyStoppingMonitor(object):
+    """
+    Background monitor which follows the log files of the running jobs in an
+    experiment, extracts their intermediate metric values and terminates the
+    jobs which an early-stopping rule decides are not worth finishing.
+
+    Logs are downloaded incrementally with
+    MetricExtractor.get_new_values: each poll only fetches the bytes
+    appended since the previous poll, and a match must not span lines.
+    """
+
+    def __init__(self, experiment_utils, metric_extractor, rule,
+                 interval=MONITOR_INTERVAL_SECS, job_names=None):
+        """
+        :param experiment_utils: the ExperimentUtils of the experiment
+        :param metric_extractor: an instance of utilities.job.MetricExtractor
+        describing the log file and the metric regex
+        :param rule: an early-stopping rule, e.g. MedianStoppingRule or
+        ThresholdRule. Any object with a should_stop(job_key, series,
+        all_series) method can be used.
+        :param interval: number of seconds between polls
+        :param job_names: names of jobs to monitor. If None, all jobs in the
+        experiment are monitored.
+        """
+        self.experiment_utils = experiment_utils
+        self.metric_extractor = metric_extractor
+        self.rule = rule
+        self.interval = interval
+        self.job_names = set(job_names) if job_names else None
+        # (job name, creation time) -> list of metric values, so that a job
+        # resubmitted under the same name gets a new series
+        self.series = {}
+        self.stopped_jobs = []
+        self._completed = set()  # (job name, creation time)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.logger = logging.getLogger('ExperimentUtils')
+
+    def start(self):
+        """Start monitoring in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop monitoring and wait for the background thread to exit."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def poll(self):
+        """
+        Fetch the new log output of the monitored jobs once, and terminate
+        the jobs which the rule decides to stop.
+
+        :return: list of names of the jobs terminated by this poll
+        """
+        jobs = self.experiment_utils.job_cache.get_jobs(
+            max_staleness=self.interval)
+        running = []
+        for job in jobs:
+            if self.job_names is not None and job.name not in self.job_names:
+                continue
+            key = (job.name, job.creation_time)
+            if key in self._completed or \
+                    job.execution_state == models.ExecutionState.queued:
+                continue
+            completed = job.execution_state in COMPLETED_STATES
+            self._update_series(job, final=completed)
+            if completed:
+                # Completed jobs keep contributing to the comparison
+                self._completed.add(key)
+            elif job.execution_state == models.ExecutionState.running:
+                running.append(key)
+        stopped = []
+        for key in running:
+            series = self.series.get(key)
+            if series and self.rule.should_stop(key, series, self.series):
+                self._terminate(key)
+                stopped.append(key[0])
+        return stopped
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.error("Early stopping poll failed: %s", str(e))
+            self._stop_event.wait(self.interval)
+
+    def _update_series(self, job, final=False):
+        eu = self.experiment_utils
+        values = self.metric_extractor.get_new_values(
+            job.name, eu.resource_group_name, eu.workspace_name,
+            eu.experiment_name, eu.client, throttle=eu.throttle, final=final,
+            creation_time=job.creation_time)
+        if values:
+            self.series.setdefault((job.name, job.creation_time),
+                                   []).extend(values)
+
+    def _terminate(self, key):
+        eu = self.experiment_utils
+        job_name = key[0]
+        print("Terminating job {0} (metric values: {1})".format(
+            job_name, self.series[key]))
+        eu.throttle.call(eu.client.jobs.terminate, eu.resource_group_name,
+                         eu.workspace_name, eu.experiment_name, job_name,
+                         polling=False)
+        self._completed.add(key)
+        self.stopped_jobs.append(job_name)
+        eu.stopped_jobs.add(job_name)
+        self.logger.info("Terminated job %s", job_name)
+
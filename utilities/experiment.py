@@ -3,22 +3,42 @@ from __future__ import print_function
 import collections
 import concurrent.futures
 import hashlib
+import heapq
+import itertools
 import json
 import logging
 import sys
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 
 import azure.mgmt.batchai.models as models
+import numpy as np
+import six
 from msrestazure.azure_exceptions import CloudError
-from msrestazure.polling.arm_polling import ARMPolling
+from msrestazure.tools import parse_resource_id
 
-from utilities.job import convert_job_to_jcp
+from utilities.early_stopping import MONITOR_INTERVAL_SECS, \
+    EarlyStoppingMonitor
+from utilities.job import JobOutputTailer, convert_job_to_jcp, \
+    get_storage_key_cache
+from utilities.job_factory import TRIAL_DIRECTORY_FORMAT, get_packed_trials
+from utilities.job_state import MIN_POLL_INTERVAL_SECS, \
+    BatchOperationPoller, JobStateCache, JobWatcher
+from utilities.journal import CONFIRMED, INTENT, SUBMITTED, \
+    SubmissionJournal
+from utilities.throttling import AdaptiveConcurrencyLimiter, \
+    get_default_throttle, is_congestion_error
 
 NUM_THREADS = 30
-RETRY_WAIT_SECS = 5
+MAX_SUBMISSION_THREADS = 100
 JOB_NAME_HASH_LENGTH = 16
 NUM_RETRIES = 5
+SUBMISSION_QUEUE_SIZE = 1000
+FEED_POLL_SECS = 0.1
+CONFIRMATION_TIMEOUT_SECS = 5 * 60
+WINDOW_REFRESH_SECS = 10
+MAX_SUBMITTED_JCPS = 10000
 
 JobToSubmit = collections.namedtuple('JobToSubmit', [
     'name',
@@ -28,7 +48,8 @@ JobToSubmit = collections.namedtuple('JobToSubmit', [
 
 class ExperimentUtils(object):
     def __init__(self, client, resource_group_name, workspace_name,
-                 experiment_name, log_to_stdout=True):
+                 experiment_name, log_to_stdout=True, throttle=None,
+                 max_submitted_jcps=MAX_SUBMITTED_JCPS):
         """
         Create a JobSubmitter object to manage job requests to the
         specified experiment.
@@ -37,12 +58,32 @@ class ExperimentUtils(object):
         :param resource_group_name: name of resource group of experiment
         :param workspace_name: name of workspace of experiment
         :param experiment_name: name of the experiment
+        :param log_to_stdout: whether to log to stdout
+        :param throttle: a utilities.throttling.RequestThrottle applied to
+        all requests made by this object. If None, the throttle shared by
+        all utilities in this process is used.
+        :param max_submitted_jcps: number of the most recently submitted
+        jobs whose JobCreateParameters are kept for resubmit_failed_jobs. If
+        0, none are kept.
         """
         self.client = client
         self.resource_group_name = resource_group_name
         self.workspace_name = workspace_name
         self.experiment_name = experiment_name
-        self.client.experiments.get(  # Ensure experiment exists
+        self.throttle = throttle or get_default_throttle()
+        self.job_cache = JobStateCache(self._list_jobs)
+        self.operations = BatchOperationPoller(self.job_cache,
+                                               throttle=self.throttle)
+        # job name -> JobCreateParameters of the jobs submitted by this
+        # object, oldest first
+        self.submitted_jcps = collections.OrderedDict()
+        self.max_submitted_jcps = max_submitted_jcps
+        self._submitted_jcps_lock = threading.Lock()
+        # names of the jobs terminated by early stopping, which are not
+        # resubmitted by resubmit_failed_jobs
+        self.stopped_jobs = set()
+        self.throttle.call(  # Ensure experiment exists
+            self.client.experiments.get,
             resource_group_name, workspace_name, experiment_name)
         if log_to_stdout:
             self.log_to_stdout()
@@ -55,85 +96,346 @@ class ExperimentUtils(object):
             ))
 
     def submit_jobs(self, jcp_list, job_name_prefix, max_retries=NUM_RETRIES,
-                    num_threads=NUM_THREADS):
+                    num_threads=MAX_SUBMISSION_THREADS, journal=None,
+                    wait_for_creation=True, queue_buffer=None,
+                    max_in_flight=None):
         """
         Submit jobs with the JobCreateParameters in jcp_list. Jobs have name
-        job_name_prefix with a hash of the JobCreateParameters object appended.
+        job_name_prefix with a hash of the JobCreateParameters object appended,
+        except for items of jcp_list which are JobToSubmit, which are
+        submitted with their own name.
 
-        :param jcp_list: a list of JobCreateParameters objects to submit
+        jcp_list may be any iterable, including a generator such as
+        ParameterSweep.iter_jobs. It is consumed on a background thread into
+        a bounded queue, so that generating and hashing JobCreateParameters
+        overlaps with submitting them.
+
+        :param jcp_list: an iterable of JobCreateParameters (or JobToSubmit)
+        objects to submit
         :param job_name_prefix: prefix for job names
-        :param max_retries: number of retries if server returns 5xx for
+        :param max_retries: number of retries if server returns 429 or 5xx for
         submission
-        :param num_threads: number of threads to use for submission
+        :param num_threads: maximum number of submission requests in flight.
+        The actual number is adjusted at runtime based on the latency and
+        throttling responses of the service.
+        :param journal: a utilities.journal.SubmissionJournal, or the path of
+        its file. If given, the intent to submit, the submission and the
+        creation of every job are recorded in the journal, and jobs which the
+        journal records as created are skipped (they are not included in the
+        result). This allows resuming an interrupted submission by calling
+        submit_jobs again with the same arguments. A journal opened from a
+        path is closed once the submission completes.
+        :param wait_for_creation: if False, do not wait for the jobs to be
+        created: the returned future is resolved as soon as the create
+        requests of all jobs were accepted, with the list of JobToSubmit
+        accepted. Pass this list to confirm_jobs to check in bulk that the
+        jobs were created.
+        :param queue_buffer: if given, submission is paced so that at most
+        the number of free nodes of a job's target cluster plus queue_buffer
+        jobs of the experiment are queued on that cluster. Jobs submitted
+        later (e.g. promoted configurations) then do not wait behind
+        thousands of queued ones.
+        :param max_in_flight: if given, at most this many jobs of the
+        experiment are queued or running at any time.
         :return: a concurrent.futures.Future object. Call .result() on the
         return object to get the list of azure.mgmt.batchai.models.Job submitted
         """
-        jobs = [JobToSubmit(
-            name=job_name_prefix + '_' + self._hash_jcp(jcp),
-            parameters=jcp) for jcp in jcp_list
-        ]
+        jobs = (jcp if isinstance(jcp, JobToSubmit) else JobToSubmit(
+            name=self.get_job_name(jcp, job_name_prefix),
+            parameters=jcp) for jcp in jcp_list)
+        journal, owns_journal = _open_journal(journal)
+        if journal is not None:
+            jobs = self._skip_journaled_jobs(jobs, journal)
+        window = None
+        if queue_buffer is not None or max_in_flight is not None:
+            window = SubmissionWindow(self, queue_buffer=queue_buffer,
+                                      max_in_flight=max_in_flight)
+
+        def submit():
+            try:
+                return self._submit_jobs_threadpool(
+                    jobs, max_retries=max_retries, num_threads=num_threads,
+                    journal=journal, wait_for_creation=wait_for_creation,
+                    window=window)
+            finally:
+                if owns_journal:
+                    journal.close()
+
         executor = ThreadPoolExecutor(max_workers=1)
-        future = executor.submit(
-            self._submit_jobs_threadpool, jobs, max_retries=max_retries,
-            num_threads=num_threads)
+        future = executor.submit(submit)
         executor.shutdown(wait=False)  # Do not block on waiting for results
         return future
 
-    def _submit_jobs_threadpool(self, jobs, max_retries, num_threads):
+    def confirm_jobs(self, jobs, timeout=CONFIRMATION_TIMEOUT_SECS,
+                     journal=None):
         """
-        Submits jobs using a thread pool. Returns list of
-        azure.mgmt.batchai.models.Job objects representing submitted jobs.
+        Check in bulk, from listings of the experiment, that jobs whose create
+        requests were accepted (e.g. by submit_jobs with
+        wait_for_creation=False) were created.
+
+        :param jobs: a list of JobToSubmit
+        :param timeout: number of seconds to wait for the jobs to appear
+        :param journal: a utilities.journal.SubmissionJournal in which the
+        creation of the confirmed jobs is recorded
+        :return: a tuple of the list of azure.mgmt.batchai.models.Job created,
+        and the list of JobToSubmit which failed to be created or were not
+        created within the timeout. Jobs whose provisioning failed are
+        reported as soon as they are listed. The parameters of the latter
+        can be passed to submit_jobs again to retry them.
+        """
+        pending = {job.name: job for job in jobs}
+        created_jobs = []
+        failed_jobs = []
+        start = time.time()
+        while pending:
+            for job in self.job_cache.get_jobs(
+                    max_staleness=self.operations.interval / 2.0):
+                if job.name not in pending:
+                    continue
+                if job.provisioning_state == \
+                        models.ProvisioningState.succeeded:
+                    del pending[job.name]
+                    self._on_job_created(job, journal)
+                    created_jobs.append(job)
+                elif job.provisioning_state == \
+                        models.ProvisioningState.failed:
+                    self.logger.error(
+                        "Job \"{0}\" failed to be created: provisioning "
+                        "state {1}".format(job.name, getattr(
+                            job.provisioning_state, 'value',
+                            job.provisioning_state)))
+                    failed_jobs.append(pending.pop(job.name))
+            if not pending or time.time() - start > timeout:
+                break
+            time.sleep(self.operations.interval)
+        missing_jobs = list(pending.values())
+        if missing_jobs:
+            self.logger.error(
+                "{0} jobs were not created within the timeout: {1}".format(
+                    len(missing_jobs),
+                    ", ".join(job.name for job in missing_jobs)))
+        return created_jobs, failed_jobs + missing_jobs
+
+    def _skip_journaled_jobs(self, jobs, journal):
+        """
+        Yields the jobs which are not recorded as created in the journal.
+        Jobs whose create request may have been sent (intent recorded), or
+        was accepted, but whose creation was not confirmed are looked up
+        individually.
+        """
+        num_skipped = 0
+        for job in jobs:
+            state = journal.get_state(job.name)
+            if state in (INTENT, SUBMITTED) and \
+                    self._job_exists(job.name):
+                journal.record_confirmed(job.name)
+                state = CONFIRMED
+            if state == CONFIRMED:
+                num_skipped += 1
+                continue
+            yield job
+        if num_skipped:
+            self.logger.info(
+                "Skipped {0} jobs which were already created according to "
+                "the journal {1}.".format(num_skipped, journal.path))
+
+    def _job_exists(self, job_name):
+        """
+        Whether a job with the given name exists in the experiment.
+        """
+        try:
+            self.throttle.call(
+                self.client.jobs.get, self.resource_group_name,
+                self.workspace_name, self.experiment_name, job_name)
+        except CloudError as ce:
+            if ce.status_code == 404:
+                return False
+            raise
+        return True
+
+    def _submit_jobs_threadpool(self, jobs, max_retries, num_threads,
+                                journal=None, wait_for_creation=True,
+                                window=None):
+        """
+        Submits jobs using a thread pool. The number of requests in flight is
+        tuned at runtime by an AdaptiveConcurrencyLimiter, bounded by
+        num_threads. jobs may be any iterable of JobToSubmit; it is consumed
+        lazily through a bounded queue. Threads only send the create
+        requests; the creation of the jobs is confirmed in bulk by
+        self.operations. If journal is given, the submission and creation of
+        each job are recorded in it. If window is given, a job is only sent
+        when the SubmissionWindow has room for it. Returns list of
+        azure.mgmt.batchai.models.Job objects representing submitted jobs, or
+        if wait_for_creation is False, the list of JobToSubmit whose create
+        requests were accepted.
         """
-        if len(jobs) == 0:
-            return
         job_results = []
-        attempts_left = max_retries + 1
+        failed_jobs = []
+        limiter = AdaptiveConcurrencyLimiter(max_limit=num_threads)
+        feed = JobFeed(jobs, maxsize=max(num_threads, SUBMISSION_QUEUE_SIZE))
+        ready = collections.deque()  # (job, retries left) ready for retry
+        retries = []  # heap of (retry time, sequence number, job, retries)
+        sequence = itertools.count()
+        futures_to_jobs = {}  # create requests in flight
+        operations_to_jobs = {}  # accepted jobs waiting for confirmation
         with ThreadPoolExecutor(max_workers=num_threads) as executor:
-            while jobs and attempts_left > 0:
-                futures_to_jobs = {}
-                for job in jobs:
+            while (ready or retries or futures_to_jobs or operations_to_jobs
+                   or not feed.exhausted):
+                while retries and retries[0][0] <= time.time():
+                    _, _, job, retries_left = heapq.heappop(retries)
+                    ready.append((job, retries_left))
+                window_closed = False
+                while limiter.try_acquire():
+                    if ready:
+                        job, retries_left = ready.popleft()
+                    else:
+                        # Block on the feed only when there is nothing
+                        # else to wait for.
+                        job = feed.get(block=not (
+                            futures_to_jobs or operations_to_jobs or
+                            retries))
+                        retries_left = max_retries
+                    if job is None:
+                        limiter.release()
+                        break
+                    if window is not None and not window.try_acquire(job):
+                        ready.appendleft((job, retries_left))
+                        limiter.release()
+                        window_closed = True
+                        break
                     future = executor.submit(
-                        self._submit_job, job.name, job.parameters)
-                    futures_to_jobs[future] = job
-                jobs = []
-                for future in concurrent.futures.as_completed(futures_to_jobs):
+                        self._submit_job, job.name, job.parameters,
+                        journal, wait_for_creation)
+                    futures_to_jobs[future] = (job, retries_left)
+                timeout = None
+                if not feed.exhausted and \
+                        limiter.in_flight < limiter.limit:
+                    timeout = FEED_POLL_SECS
+                if retries:
+                    retry_timeout = max(0, retries[0][0] - time.time())
+                    timeout = min(timeout or retry_timeout, retry_timeout)
+                if window_closed:
+                    timeout = min(timeout or window.refresh_interval,
+                                  window.refresh_interval)
+                if not futures_to_jobs and not operations_to_jobs:
+                    if timeout:
+                        time.sleep(timeout)
+                    continue
+                done, _ = concurrent.futures.wait(
+                    list(futures_to_jobs) + list(operations_to_jobs),
+                    timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in operations_to_jobs:
+                        job = operations_to_jobs.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            if window is not None:
+                                window.release(job)
+                            self.logger.error("Error: %s", str(e))
+                            failed_jobs.append(job)
+                        else:
+                            self._on_job_created(result, journal)
+                            job_results.append(result)
+                        continue
+                    job, retries_left = futures_to_jobs.pop(future)
                     try:
-                        result = future.result()
-                        job_results.append(result)
-                    except CloudError as ce:
-                        if ce.response.status_code >= 500:
-                            job = futures_to_jobs[future]
+                        operation, latency = future.result()
+                    except Exception as e:
+                        if window is not None:
+                            window.release(job)
+                        if not self.throttle.retry_policy.is_retryable(e):
+                            limiter.release()
+                            self.logger.error("Error: %s", str(e))
+                            raise
+                        if is_congestion_error(e):
+                            limiter.on_congestion()
+                        else:
+                            limiter.release()
+                        if retries_left > 0:
+                            delay = self.throttle.backoff(
+                                e, max_retries - retries_left)
                             print(
-                                "Job {0} failed to submit. "
-                                "Retrying ({1} attempts remaining)...".format(
-                                    job.name, attempts_left))
-                            jobs.append(job)
+                                "Job {0} failed to submit. Retrying in {1:.1f} "
+                                "seconds ({2} attempts remaining)...".format(
+                                    job.name, delay, retries_left))
+                            heapq.heappush(retries, (
+                                time.time() + delay, next(sequence), job,
+                                retries_left - 1))
+                        else:
+                            failed_jobs.append(job)
+                    else:
+                        limiter.on_success(latency)
+                        if wait_for_creation:
+                            operations_to_jobs[operation] = job
                         else:
-                            self.logger.error("Error: %s", str(ce))
-                            raise ce
-                attempts_left -= 1
-                if jobs and attempts_left > 0:
-                    print("Waiting {0} seconds...".format(RETRY_WAIT_SECS))
-                    time.sleep(RETRY_WAIT_SECS)
-        if jobs:
-            print("{0} jobs failed to submit.".format(len(jobs)))
+                            job_results.append(job)
+        if failed_jobs:
+            print("{0} jobs failed to submit.".format(len(failed_jobs)))
         return job_results
 
-    def _submit_job(self, job_name, jcp):
+    def _submit_job(self, job_name, jcp, journal=None, track=True):
         """
-        Submit a job. Returns azure.mgmt.batchai.models.Job object
-        representing the submitted job.
+        Send the create request for a job, without waiting for the job to be
+        created. If journal is given, the intent to submit the job is
+        recorded right before the request is sent, and its submission once
+        it was accepted. Returns a tuple of an operation and the duration of
+        the create request in seconds, excluding the wait for the rate
+        limiter, so that only the latency of the service is measured. If
+        track is True, the operation is a concurrent.futures.Future resolved
+        with the azure.mgmt.batchai.models.Job once self.operations observes
+        that the job was created, otherwise it is None.
         """
-        polling = CustomPolling()  # Poll for results once per second
-        job = self.client.jobs.create(
+        self.throttle.acquire()
+        if journal is not None:
+            journal.record_intent(job_name)
+        start = time.time()
+        self.client.jobs.create(
             self.resource_group_name, self.workspace_name,
-            self.experiment_name, job_name, jcp, polling=polling).result()
+            self.experiment_name, job_name, jcp, polling=False)
+        latency = time.time() - start
+        # Until a listing shows the job, the cache returns it as being
+        # created, so that operations reading the cache see our own creates.
+        self.job_cache.put(_get_accepted_job(job_name, jcp))
+        self._keep_jcp(job_name, jcp)
+        if journal is not None:
+            journal.record_submitted(job_name)
+        if track:
+            return self.operations.track_create(job_name), latency
+        return None, latency
+
+    def _keep_jcp(self, job_name, jcp):
+        """
+        Record the JobCreateParameters of a submitted job in submitted_jcps,
+        forgetting the oldest ones beyond max_submitted_jcps.
+        """
+        if not self.max_submitted_jcps:
+            return
+        with self._submitted_jcps_lock:
+            self.submitted_jcps.pop(job_name, None)
+            self.submitted_jcps[job_name] = jcp
+            while len(self.submitted_jcps) > self.max_submitted_jcps:
+                self.submitted_jcps.popitem(last=False)
+
+    def _on_job_created(self, job, journal=None):
+        """
+        Record and log a job whose creation was confirmed.
+        """
+        if journal is not None:
+            journal.record_confirmed(job.name)
         if not job.environment_variables:
             job.environment_variables = []
         parameters = {ev.name: ev.value for ev in job.environment_variables}
         self.logger.info("Created job \"{0}\" with parameters {1}".format(
             job.name, json.dumps(parameters, sort_keys=True)))
-        return job
+
+    def get_job_name(self, jcp, job_name_prefix):
+        """
+        Returns the name submit_jobs gives to the job created from jcp:
+        job_name_prefix with a hash of the JobCreateParameters appended.
+        """
+        return job_name_prefix + '_' + self._hash_jcp(jcp)
 
     def _hash_jcp(self, jcp, length=JOB_NAME_HASH_LENGTH):
         """
@@ -145,121 +447,271 @@ class ExperimentUtils(object):
         hash_str_substr = hash_str[0:length]
         return hash_str_substr
 
-    def wait_all_jobs(self, job_names=None, on_progress=None, timeout=None):
+    def wait_all_jobs(self, job_names=None, on_progress=None, timeout=None,
+                      on_change=None):
         """
         Block until all jobs in the experiment are completed (succeeded
         or failed).
 
         :param job_names: names of jobs to wait for. If None, wait until all
         jobs in experiment are completed.
-        :param on_progress: a function that wait_all_jobs will call every 10
-        secs with list of azure.mgmt.batchai.models.Job, representing current
-        state of jobs
+        :param on_progress: a function that wait_all_jobs will call after
+        every poll of the experiment with list of
+        azure.mgmt.batchai.models.Job, representing current state of jobs
         :param timeout: number of seconds to wait before unblocking
+        :param on_change: a function that wait_all_jobs will call with a
+        utilities.job_state.JobStateChange for every job whose execution
+        state changes
         :return: list of completed Jobs
         """
-
-        jobs = list(self.client.jobs.list_by_experiment(
-            self.resource_group_name, self.workspace_name,
-            self.experiment_name))
-        if job_names:
-            jobs = [j for j in jobs if j.name in job_names]
+        watcher = self.create_job_watcher(job_names=job_names)
         start = time.time()
-        while self._num_jobs_completed(jobs) != len(jobs):
-            print("{0}/{1} jobs completed ({2} succeeded, {3} failed)".format(
-                self._num_jobs_completed(jobs), len(jobs),
-                self._num_jobs_in_state(jobs, models.ExecutionState.succeeded),
-                self._num_jobs_in_state(jobs, models.ExecutionState.failed)),
-                end='')
+        changes = watcher.poll()
+        printed_progress = False
+        while True:
+            if on_change:
+                for change in changes:
+                    on_change(change)
+            if watcher.all_completed():
+                break
+            if changes:
+                if printed_progress:
+                    print()
+                print("{0}/{1} jobs completed ({2} succeeded, {3} failed)"
+                      .format(watcher.num_completed, len(watcher.jobs),
+                              watcher.state_counts[
+                                  models.ExecutionState.succeeded],
+                              watcher.state_counts[
+                                  models.ExecutionState.failed]), end='')
+            print('.', end='')
             sys.stdout.flush()
-            for _ in range(15):
-                print('.', end='')
-                sys.stdout.flush()
-                time.sleep(3)
-                if timeout and time.time() - start > timeout:
-                    return jobs
-            print()
-            jobs = list(self.client.jobs.list_by_experiment(
-                self.resource_group_name, self.workspace_name,
-                self.experiment_name))
-            if job_names:
-                jobs = [j for j in jobs if j.name in job_names]
+            printed_progress = True
+            delay = watcher.interval
+            if timeout:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    print()
+                    return list(watcher.jobs.values())
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            changes = watcher.poll()
             if on_progress:
-                on_progress(jobs)
+                on_progress(list(watcher.jobs.values()))
+        if printed_progress:
+            print()
         print("All jobs completed.")
-        return jobs
+        return list(watcher.jobs.values())
 
-    def _num_jobs_completed(self, jobs):
-        return (
-                self._num_jobs_in_state(jobs, models.ExecutionState.succeeded) +
-                self._num_jobs_in_state(jobs, models.ExecutionState.failed))
+    def create_job_watcher(self, job_names=None):
+        """
+        Create a watcher reporting the execution state transitions of jobs
+        in the experiment. Iterate over watcher.events() to receive the
+        transitions as they are observed.
 
-    def _num_jobs_in_state(self, jobs, state):
-        return len([j for j in jobs if j.execution_state == state])
+        :param job_names: names of jobs to watch. If None, all jobs in the
+        experiment are watched.
+        :return: a utilities.job_state.JobWatcher
+        """
+        # Reuse a listing made by another operation within the poll interval
+        return JobWatcher(
+            lambda: self.job_cache.get_jobs(
+                max_staleness=MIN_POLL_INTERVAL_SECS),
+            job_names=job_names)
+
+    @property
+    def storage_keys(self):
+        """
+        The utilities.job.StorageKeyCache of the subscription of the client.
+        """
+        return get_storage_key_cache(self.client)
+
+    def create_output_tailer(self, job_names=None, **kwargs):
+        """
+        Create a tailer following the standard output and error (or other
+        output files) of jobs in the experiment. Call tailer.run() to follow
+        them until the jobs complete, or tailer.start() to follow them in
+        the background.
+
+        :param job_names: names of jobs to follow. If None, all jobs in the
+        experiment are followed.
+        :param kwargs: other arguments of utilities.job.JobOutputTailer
+        :return: a utilities.job.JobOutputTailer
+        """
+        return JobOutputTailer(self, job_names=job_names, **kwargs)
 
     def resubmit_failed_jobs(self, job_names=None, max_retries=NUM_RETRIES,
-                             num_threads=NUM_THREADS):
+                             num_threads=MAX_SUBMISSION_THREADS,
+                             journal=None):
         """
-        Resubmit the failed jobs in an experiment.
+        Resubmit the failed jobs in an experiment. Jobs submitted by this
+        object are resubmitted with their original JobCreateParameters; the
+        parameters of other jobs are rebuilt from the jobs, looking up the
+        keys of their storage accounts once per account. Jobs terminated by
+        early stopping (see start_early_stopping) fail as well, but are not
+        resubmitted.
 
         :param job_names: names of jobs to resubmit. If None, all jobs will
         be resubmitted.
-        :param max_retries: number of retries if server returns 5xx for
+        :param max_retries: number of retries if server returns 429 or 5xx for
         submission
-        :param num_threads: number of threads to use for submission
+        :param num_threads: maximum number of submission requests in flight
+        :param journal: the utilities.journal.SubmissionJournal (or the path
+        of its file) the jobs were submitted with, if any. The failed jobs
+        are removed from it when they are deleted, and recorded again as
+        they are resubmitted, so that a rerun of submit_jobs does not skip
+        jobs which failed to resubmit.
         :return: list of Jobs that were resubmitted
         """
-        all_jobs = list(self.client.jobs.list_by_experiment(
-            self.resource_group_name, self.workspace_name,
-            self.experiment_name))
+        all_jobs = self.job_cache.get_jobs()
+        with self._submitted_jcps_lock:
+            # Succeeded jobs will not be resubmitted
+            for job in all_jobs:
+                if job.execution_state == models.ExecutionState.succeeded:
+                    self.submitted_jcps.pop(job.name, None)
         if job_names:
+            job_names = set(job_names)
             all_jobs = [j for j in all_jobs if j.name in job_names]
         failed_jobs = [j for j in all_jobs
-                       if j.execution_state == models.ExecutionState.failed]
+                       if j.execution_state == models.ExecutionState.failed
+                       and j.name not in self.stopped_jobs]
         failed_jobs_names = [j.name for j in failed_jobs]
         if not failed_jobs:
             self.logger.info(
                 "There are no failed jobs in the experiment {0}.".format(
                     self.experiment_name))
             return
-        print("Deleting the failed jobs...")
-        self.delete_jobs_in_experiment(job_names=failed_jobs_names)
-        jobs_to_submit = [
-            JobToSubmit(
-                name=job.name, parameters=convert_job_to_jcp(job, self.client))
-            for job in failed_jobs
-        ]
-        resubmitted_jobs = self._submit_jobs_threadpool(
-            jobs_to_submit, max_retries, num_threads)
+        journal, owns_journal = _open_journal(journal)
+        try:
+            print("Deleting the failed jobs...")
+            self.delete_jobs_in_experiment(job_names=failed_jobs_names,
+                                           journal=journal)
+            jobs_to_submit = [
+                JobToSubmit(
+                    name=job.name,
+                    parameters=self.submitted_jcps.get(job.name) or
+                    convert_job_to_jcp(job, self.client, self.storage_keys))
+                for job in failed_jobs
+            ]
+            resubmitted_jobs = self._submit_jobs_threadpool(
+                jobs_to_submit, max_retries, num_threads, journal=journal)
+        finally:
+            if owns_journal:
+                journal.close()
         return resubmitted_jobs
 
-    def get_metrics_for_jobs(self, jobs, metric_extractor):
+    def get_metrics_for_jobs(self, jobs, metric_extractor, table=False):
         """
         Gets the metrics for a collection of jobs in the experiment.
 
         :param jobs: a collection of azure.mgmt.batchai.models.Job objects
         :param metric_extractor: an instance of utilities.job.MetricExtractor
+        or utilities.job.TimeSeriesExtractor
+        :param table: if True, return the time series of all jobs as one
+        table; metric_extractor must be a TimeSeriesExtractor
         :return: a list of dictionaries with keys "job_name" (the name of the
         job), "job" (the Job object), "metric_value" (the extracted value of
-        the metric).
+        the metric). Jobs created by ParameterSweep.generate_packed_jobs have
+        one dictionary per trial, with the additional keys "trial" (the index
+        of the trial in the job) and "parameters" (the parameter combination
+        of the trial). If table is True, a dict of column name to numpy array
+        instead, with one row per record of the series of every job (and
+        trial): the columns "job_name", "trial" (-1 for jobs which are not
+        packed) and one column per metric, NaN where a record does not have
+        the metric.
         """
         self.wait_all_jobs(job_names=[j.name for j in jobs])
+        if table:
+            return self._get_series_table(jobs, metric_extractor)
         job_results = []
         for idx, job in enumerate(jobs):
-            metric = metric_extractor.get_metric(job.name,
-                                                 self.resource_group_name,
-                                                 self.workspace_name,
-                                                 self.experiment_name,
-                                                 self.client)
-            job_results.append({
-                "job_name": job.name,
-                "job": job,
-                "metric_value": metric
-            })
+            trials = get_packed_trials(job)
+            if trials is None:
+                metric = metric_extractor.get_metric(
+                    job.name, self.resource_group_name, self.workspace_name,
+                    self.experiment_name, self.client, throttle=self.throttle,
+                    creation_time=job.creation_time)
+                job_results.append({
+                    "job_name": job.name,
+                    "job": job,
+                    "metric_value": metric
+                })
+                continue
+            for trial, parameters in enumerate(trials):
+                metric = metric_extractor.get_metric(
+                    job.name, self.resource_group_name, self.workspace_name,
+                    self.experiment_name, self.client, throttle=self.throttle,
+                    directory=TRIAL_DIRECTORY_FORMAT.format(trial),
+                    creation_time=job.creation_time)
+                job_results.append({
+                    "job_name": job.name,
+                    "job": job,
+                    "metric_value": metric,
+                    "trial": trial,
+                    "parameters": parameters
+                })
         return job_results
 
+    def _get_series_table(self, jobs, series_extractor):
+        """
+        Returns the time series of the jobs as a dict of columns, see
+        get_metrics_for_jobs.
+        """
+        if not hasattr(series_extractor, 'get_series'):
+            raise ValueError("A TimeSeriesExtractor is required for a table")
+        parts = []  # (job name, trial, series)
+        for job in jobs:
+            trials = get_packed_trials(job)
+            if trials is None:
+                directories = [(-1, '.')]
+            else:
+                directories = [(trial, TRIAL_DIRECTORY_FORMAT.format(trial))
+                               for trial in range(len(trials))]
+            for trial, directory in directories:
+                series = series_extractor.get_series(
+                    job.name, self.resource_group_name, self.workspace_name,
+                    self.experiment_name, self.client, throttle=self.throttle,
+                    directory=directory, final=True,
+                    creation_time=job.creation_time)
+                parts.append((job.name, trial, series))
+        names = sorted(set(name for _, _, series in parts for name in series))
+        lengths = [len(next(iter(series.values()))) if series else 0
+                   for _, _, series in parts]
+        table = {
+            "job_name": np.repeat(np.array([p[0] for p in parts],
+                                           dtype=object), lengths),
+            "trial": np.repeat(np.array([p[1] for p in parts], dtype=int),
+                               lengths)
+        }
+        for name in names:
+            table[name] = np.concatenate(
+                [series.get(name, np.full(length, np.nan))
+                 for (_, _, series), length in zip(parts, lengths)])
+        return table
+
+    def start_early_stopping(self, metric_extractor, rule,
+                             interval=MONITOR_INTERVAL_SECS, job_names=None):
+        """
+        Start a background monitor which follows the logs of the running
+        jobs in the experiment and terminates the jobs which rule decides
+        to stop, so that their nodes are freed for queued jobs.
+
+        :param metric_extractor: an instance of utilities.job.MetricExtractor
+        describing the log file and the metric regex
+        :param rule: an early-stopping rule, e.g.
+        utilities.early_stopping.MedianStoppingRule
+        :param interval: number of seconds between polls
+        :param job_names: names of jobs to monitor. If None, all jobs in the
+        experiment are monitored.
+        :return: the started utilities.early_stopping.EarlyStoppingMonitor.
+        Call .stop() on it to stop monitoring.
+        """
+        monitor = EarlyStoppingMonitor(self, metric_extractor, rule,
+                                       interval=interval, job_names=job_names)
+        monitor.start()
+        return monitor
+
     def delete_jobs_in_experiment(self, execution_state=None, job_names=None,
-                                  num_threads=NUM_THREADS):
+                                  num_threads=NUM_THREADS, journal=None):
         """
         Delete the jobs in the experiment.
 
@@ -271,42 +723,79 @@ class ExperimentUtils(object):
         :param job_name_regex: regex used with re.match to match names of jobs
         to delete
         :param num_threads: number of threads to use for deletion.
+        :param journal: the utilities.journal.SubmissionJournal (or the path
+        of its file) the jobs were submitted with, if any. The deleted jobs
+        are removed from it, so that submit_jobs creates them again.
         :return: None
         """
-        jobs = list(self.client.jobs.list_by_experiment(
-            self.resource_group_name, self.workspace_name,
-            self.experiment_name))
+        jobs = self.job_cache.get_jobs()
         if execution_state:
             jobs = [j for j in jobs if j.execution_state == execution_state]
         if job_names:
+            job_names = set(job_names)
             jobs = [j for j in jobs if j.name in job_names]
         if len(jobs) == 0:
             print("There are no jobs to delete in the experiment {0}.".format(
                 self.experiment_name))
             return
-        with ThreadPoolExecutor(max_workers=num_threads) as executor:
-            futures = []
-            for job in jobs:
-                future = executor.submit(self._delete_job, job.name)
-                futures.append(future)
-            for future in concurrent.futures.as_completed(futures):
-                future.result()
+        journal, owns_journal = _open_journal(journal)
+        try:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                futures = []
+                for job in jobs:
+                    future = executor.submit(self._delete_job, job.name)
+                    futures.append(future)
+                operations = [future.result() for future in
+                              concurrent.futures.as_completed(futures)]
+            for operation in operations:
+                operation.result()
+            if journal is not None:
+                for job in jobs:
+                    journal.remove(job.name)
+        finally:
+            if owns_journal:
+                journal.close()
         self.logger.info(str(len(jobs)) + " jobs in experiment {0} were "
                          "deleted.".format(self.experiment_name))
 
     def _delete_job(self, job_name):
         """
-        Delete a job.
+        Send the delete request for a job, without waiting for the job to be
+        deleted.
 
         :param job_name: name of job to delete
-        :return: None
+        :return: a concurrent.futures.Future resolved once self.operations
+        observes that the job was deleted
         """
-        polling = CustomPolling()  # Poll once per second for results
-        self.client.jobs.delete(
-            self.resource_group_name, self.workspace_name,
-            self.experiment_name, job_name,
-            polling=polling).result()
-        self.logger.info("Deleted Job: {}".format(job_name))
+        self.throttle.call(
+            self.client.jobs.delete, self.resource_group_name,
+            self.workspace_name, self.experiment_name, job_name,
+            polling=False)
+        operation = self.operations.track_delete(job_name)
+        operation.add_done_callback(
+            lambda _: self.logger.info("Deleted Job: {}".format(job_name)))
+        return operation
+
+    def refresh_jobs(self):
+        """
+        Refresh the cached state of the jobs in the experiment. Operations
+        on the experiment reuse cached job states which are at most
+        job_cache.max_staleness seconds old.
+
+        :return: list of azure.mgmt.batchai.models.Job
+        """
+        return self.job_cache.refresh()
+
+    def _list_jobs(self):
+        """
+        List the jobs in the experiment.
+
+        :return: list of azure.mgmt.batchai.models.Job
+        """
+        return self.throttle.call(lambda: list(
+            self.client.jobs.list_by_experiment(
+                self.resource_group_name, self.workspace_name,
+                self.experiment_name)))
 
     def log_to_stdout(self):
         """
@@ -319,8 +808,175 @@ class ExperimentUtils(object):
         logger.handlers = [logging.StreamHandler(sys.stdout)]
 
 
-class CustomPolling(ARMPolling):
-    def _delay(self):
-        if self._response is None:
-            return
-        time.sleep(1)  # Override default polling, poll once per second
+def _get_accepted_job(job_name, jcp):
+    """
+    Returns an azure.mgmt.batchai.models.Job standing for a job whose create
+    request was accepted, but which was not listed yet.
+    """
+    job = models.Job(cluster=jcp.cluster, node_count=jcp.node_count,
+                     environment_variables=jcp.environment_variables)
+    job.name = job_name
+    job.provisioning_state = models.ProvisioningState.creating
+    job.execution_state = models.ExecutionState.queued
+    return job
+
+
+def _open_journal(journal):
+    """
+    Returns a tuple of the utilities.journal.SubmissionJournal journal, opened
+    if journal is a path, and whether it was opened (and should be closed)
+    by the caller.
+    """
+    if isinstance(journal, six.string_types):
+        return SubmissionJournal(journal), True
+    return journal, False
+
+
+class JobFeed(object):
+    """
+    Consumes an iterable of jobs on a background thread into a bounded
+    queue, so that producing jobs overlaps with submitting them while only
+    a bounded number of jobs is held in memory.
+    """
+
+    _END = object()
+
+    def __init__(self, jobs, maxsize=SUBMISSION_QUEUE_SIZE):
+        """
+        :param jobs: an iterable of jobs
+        :param maxsize: maximum number of jobs buffered ahead of the consumer
+        """
+        self.exhausted = False
+        self._error = None
+        self._queue = six.moves.queue.Queue(maxsize=maxsize)
+        thread = threading.Thread(target=self._produce, args=(jobs,))
+        thread.daemon = True
+        thread.start()
+
+    def get(self, block=True):
+        """
+        Get the next job. Re-raises any error raised by the iterable.
+
+        :param block: whether to wait until a job is produced
+        :return: the next job, or None if no job is available yet or all
+        jobs were consumed
+        """
+        if self.exhausted:
+            return None
+        try:
+            job = self._queue.get(block=block)
+        except six.moves.queue.Empty:
+            return None
+        if job is self._END:
+            self.exhausted = True
+            if self._error is not None:
+                raise self._error
+            return None
+        return job
+
+    def _produce(self, jobs):
+        try:
+            for job in jobs:
+                self._queue.put(job)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._queue.put(self._END)
+
+
+class SubmissionWindow(object):
+    """
+    Paces job submission by the capacity of the target clusters: at most
+    free nodes + queue_buffer jobs of the experiment are kept queued on each
+    cluster, and at most max_in_flight jobs of the experiment are queued or
+    running. Free nodes are the idle nodes and the nodes still preparing,
+    which take queued jobs once they have booted. Jobs of other experiments
+    running on the same cluster are accounted for through the free node
+    count only.
+    """
+
+    def __init__(self, experiment_utils, queue_buffer=None,
+                 max_in_flight=None, refresh_interval=WINDOW_REFRESH_SECS):
+        """
+        :param experiment_utils: the ExperimentUtils submitting the jobs
+        :param queue_buffer: number of jobs allowed to be queued on a cluster
+        in addition to its free nodes. If None, cluster capacity is ignored.
+        :param max_in_flight: maximum number of queued or running jobs in the
+        experiment. If None, there is no limit.
+        :param refresh_interval: number of seconds between updates of the
+        cluster and job states
+        """
+        self.experiment_utils = experiment_utils
+        self.queue_buffer = queue_buffer
+        self.max_in_flight = max_in_flight
+        self.refresh_interval = refresh_interval
+        self._pending = {}  # job name -> cluster id, submitted but not listed
+        self._free_nodes = {}  # cluster id -> number of free nodes
+        self._queued = collections.Counter()  # cluster id -> queued jobs
+        self._in_flight = 0
+        self._refreshed_at = None
+
+    def try_acquire(self, job):
+        """
+        Reserve room for a job in the window.
+
+        :param job: a JobToSubmit
+        :return: True if the job may be submitted now, False otherwise
+        """
+        if (self._refreshed_at is None or
+                time.time() - self._refreshed_at > self.refresh_interval):
+            self._refresh()
+        if self.max_in_flight is not None and \
+                self._in_flight + len(self._pending) >= self.max_in_flight:
+            return False
+        cluster_id = job.parameters.cluster.id.lower()
+        if self.queue_buffer is not None:
+            if cluster_id not in self._free_nodes:
+                self._free_nodes[cluster_id] = self._get_free_nodes(
+                    cluster_id)
+            pending_on_cluster = sum(
+                1 for c in self._pending.values() if c == cluster_id)
+            if (self._queued[cluster_id] + pending_on_cluster >=
+                    self._free_nodes[cluster_id] + self.queue_buffer):
+                return False
+        self._pending[job.name] = cluster_id
+        return True
+
+    def release(self, job):
+        """
+        Give back the room reserved for a job whose create request or
+        creation failed.
+
+        :param job: a JobToSubmit
+        """
+        self._pending.pop(job.name, None)
+
+    def _refresh(self):
+        jobs = self.experiment_utils.job_cache.get_jobs(
+            max_staleness=self.refresh_interval)
+        self._queued = collections.Counter()
+        self._in_flight = 0
+        for job in jobs:
+            # Listed jobs are counted from their state from now on
+            self._pending.pop(job.name, None)
+            if job.execution_state == models.ExecutionState.queued:
+                self._in_flight += 1
+                if job.cluster is not None:
+                    self._queued[job.cluster.id.lower()] += 1
+            elif job.execution_state == models.ExecutionState.running:
+                self._in_flight += 1
+        self._free_nodes = {cluster_id: self._get_free_nodes(cluster_id)
+                            for cluster_id in self._free_nodes}
+        self._refreshed_at = time.time()
+
+    def _get_free_nodes(self, cluster_id):
+        resource = parse_resource_id(cluster_id)
+        cluster = self.experiment_utils.throttle.call(
+            self.experiment_utils.client.clusters.get,
+            resource['resource_group'], resource['name'],
+            resource['child_name_1'])
+        counts = cluster.node_state_counts
+        if counts is None:
+            return 0
+        return (counts.idle_node_count or 0) + \
+            (counts.preparing_node_count or 0)
@@ -0,0 +1,309 @@
+from __future__ import print_function
+
+import collections
+import copy
+import itertools
+import logging
+import math
+import time
+
+import azure.mgmt.batchai.models as models
+
+from utilities.experiment import JobToSubmit
+from utilities.job import set_resume_from
+from utilities.job_state import COMPLETED_STATES
+
+RESOURCE_ENV_VAR = 'PARAM_EPOCHS'
+POLL_INTERVAL_SECS = 10
+
+Trial = collections.namedtuple('Trial', [
+    'config_id',  # index of the parameter combination
+    'bracket',
+    'rung',
+    'resource'  # value of the resource environment variable
+])
+
+
+class ASHA(object):
+    """
+    Asynchronous Successive Halving. Each parameter combination (config) is
+    first trained with min_resource (e.g. epochs). Whenever a job slot is
+    free, a config which is in the top 1/eta of the completed results of a
+    rung and was not promoted yet is trained again with eta times more
+    resource; if there is none, a new config is started. Unlike synchronous
+    successive halving, promotions never wait for a whole rung to complete,
+    so the cluster stays busy until the sweep ends.
+
+    With num_brackets > 1, new configs are spread round-robin over several
+    brackets whose first rung uses min_resource * eta ** bracket, as in
+    HyperBand, and all brackets run concurrently.
+    """
+
+    def __init__(self, experiment_utils, parameter_sweep,
+                 job_create_parameters, metric_extractor, job_name_prefix,
+                 min_resource, max_resource, max_concurrent_jobs, eta=3,
+                 num_configs=None, num_brackets=1, maximize=False,
+                 resource_env_var=RESOURCE_ENV_VAR,
+                 poll_interval=POLL_INTERVAL_SECS, resume=False,
+                 checkpoint_directory_id=None):
+        """
+        :param experiment_utils: the ExperimentUtils of the experiment to
+        run the jobs in
+        :param parameter_sweep: a utilities.job_factory.ParameterSweep
+        :param job_create_parameters: an instance of JobCreateParameters with
+        parameters of parameter_sweep substituted into it
+        :param metric_extractor: an instance of utilities.job.MetricExtractor
+        used to get the result of a completed job
+        :param job_name_prefix: prefix for job names
+        :param min_resource: resource of the first rung
+        :param max_resource: maximum resource a config is trained with
+        :param max_concurrent_jobs: number of jobs kept queued or running,
+        e.g. the number of nodes of the cluster
+        :param eta: reduction factor between rungs
+        :param num_configs: number of configs to generate with random
+        search. If None, all configs of the grid are tried.
+        :param num_brackets: number of brackets run concurrently
+        :param maximize: whether larger metric values are better
+        :param resource_env_var: environment variable through which the
+        resource is passed to the job
+        :param poll_interval: number of seconds between polls of the
+        experiment
+        :param resume: if True, a promoted config resumes from the output
+        directory of its job in the previous rung (see
+        utilities.job.set_resume_from) instead of training from scratch
+        :param checkpoint_directory_id: id of the output directory holding
+        the checkpoints. If None, the first output directory is used.
+        """
+        if min_resource <= 0 or max_resource < min_resource:
+            raise ValueError("Invalid resource range")
+        if eta < 2:
+            raise ValueError("Eta must be at least 2")
+        max_rungs = int(math.log(max_resource / float(min_resource),
+                                 eta) + 1e-9) + 1
+        if not 1 <= num_brackets <= max_rungs:
+            raise ValueError(
+                "Number of brackets must be between 1 and {0}".format(
+                    max_rungs))
+        self.experiment_utils = experiment_utils
+        self.metric_extractor = metric_extractor
+        self.job_name_prefix = job_name_prefix
+        self.min_resource = min_resource
+        self.max_resource = max_resource
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.eta = eta
+        self.num_brackets = num_brackets
+        self.maximize = maximize
+        self.resource_env_var = resource_env_var
+        self.poll_interval = poll_interval
+        self.resume = resume
+        self.checkpoint_directory_id = checkpoint_directory_id
+        self.configs = []  # config id -> (JobCreateParameters, param dict)
+        self.results = []
+        self._new_configs = parameter_sweep.iter_jobs(
+            job_create_parameters, num_configs, with_parameters=True)
+        self._next_bracket = itertools.cycle(range(num_brackets))
+        self._num_rungs = [max_rungs - bracket
+                           for bracket in range(num_brackets)]
+        # bracket -> rung -> list of (metric value, config id)
+        self._rung_results = [[[] for _ in range(n)]
+                              for n in self._num_rungs]
+        # bracket -> rung -> config ids promoted out of the rung
+        self._promoted = [[set() for _ in range(n)]
+                          for n in self._num_rungs]
+        self._running = {}  # job name -> Trial
+        self._jobs = {}  # Trial -> Job, for completed trials
+        self.logger = logging.getLogger('ExperimentUtils')
+
+    def run(self):
+        """
+        Run the sweep until no config can be started or promoted.
+
+        :return: list of dictionaries with keys "job_name", "job",
+        "metric_value", "parameters", "bracket", "rung" and "resource", one
+        per job which succeeded with a finite metric value
+        """
+        while True:
+            self._fill_slots()
+            if not self._running:
+                break
+            time.sleep(self.poll_interval)
+            self._collect_results()
+        return self.results
+
+    def get_best(self):
+        """
+        :return: the result of the best job trained with the largest
+        resource, or None if no job completed
+        """
+        if not self.results:
+            return None
+        top_resource = max(r["resource"] for r in self.results)
+        results = [r for r in self.results if r["resource"] == top_resource]
+        if self.maximize:
+            return max(results, key=lambda r: r["metric_value"])
+        return min(results, key=lambda r: r["metric_value"])
+
+    def _fill_slots(self):
+        """
+        Submit trials until max_concurrent_jobs jobs are running or no trial
+        can be started. Trials which fail to submit are dropped, and their
+        slots are given to other trials.
+        """
+        while len(self._running) < self.max_concurrent_jobs:
+            trials = []
+            while len(self._running) + len(trials) < \
+                    self.max_concurrent_jobs:
+                trial = self._get_promotion() or self._get_new_trial()
+                if trial is None:
+                    break
+                trials.append(trial)
+            if not trials:
+                return
+            jobs = [JobToSubmit(name=self._get_job_name(trial, jcp),
+                                parameters=jcp)
+                    for trial, jcp in ((t, self._create_jcp(t))
+                                       for t in trials)]
+            try:
+                submitted = set(
+                    job.name for job in self.experiment_utils.submit_jobs(
+                        jobs, self.job_name_prefix).result())
+            except Exception as e:
+                # Submission stopped at an error which cannot be retried;
+                # keep the trials whose jobs were created before it.
+                self.logger.error("Error: %s", str(e))
+                submitted = set(
+                    job.name for job in self.experiment_utils.refresh_jobs())
+            for trial, job in zip(trials, jobs):
+                if job.name in submitted:
+                    self._running[job.name] = trial
+                else:
+                    self.logger.error("Trial %s was not submitted",
+                                      str(trial))
+
+    def _get_promotion(self):
+        """
+        Returns a Trial promoting a config to the next rung of its bracket,
+        or None if no config can be promoted.
+        """
+        for bracket in range(self.num_brackets):
+            for rung in reversed(range(self._num_rungs[bracket] - 1)):
+                results = self._rung_results[bracket][rung]
+                num_promotable = len(results) // self.eta
+                if num_promotable == 0:
+                    continue
+                ranked = sorted(results, key=lambda r: r[0],
+                                reverse=self.maximize)
+                for _, config_id in ranked[:num_promotable]:
+                    if config_id not in self._promoted[bracket][rung]:
+                        self._promoted[bracket][rung].add(config_id)
+                        return Trial(config_id, bracket, rung + 1,
+                                     self._get_resource(bracket, rung + 1))
+        return None
+
+    def _get_new_trial(self):
+        """
+        Returns a Trial starting a new config in the first rung of the next
+        bracket, or None if all configs were started.
+        """
+        config = next(self._new_configs, None)
+        if config is None:
+            return None
+        self.configs.append(config)
+        bracket = next(self._next_bracket)
+        return Trial(len(self.configs) - 1, bracket, 0,
+                     self._get_resource(bracket, 0))
+
+    def _get_job_name(self, trial, jcp):
+        """
+        Returns the name of the job running trial: the name submit_jobs
+        gives to jcp, with the config and rung of the trial appended, so
+        that identical configs sampled twice get different jobs.
+        """
+        return '{0}_{1}_{2}'.format(
+            self.experiment_utils.get_job_name(jcp, self.job_name_prefix),
+            trial.config_id, trial.rung)
+
+    def _get_resource(self, bracket, rung):
+        resource = self.min_resource * self.eta ** (bracket + rung)
+        return min(self.max_resource, resource)
+
+    def _create_jcp(self, trial):
+        """
+        Returns the JobCreateParameters of the job running trial.
+        """
+        jcp = copy.copy(self.configs[trial.config_id][0])
+        jcp.environment_variables = list(jcp.environment_variables) + [
+            models.EnvironmentVariable(name=self.resource_env_var,
+                                       value=str(trial.resource))]
+        if self.resume and trial.rung > 0:
+            previous = Trial(trial.config_id, trial.bracket, trial.rung - 1,
+                             self._get_resource(trial.bracket,
+                                                trial.rung - 1))
+            set_resume_from(jcp, self._jobs[previous],
+                            self.checkpoint_directory_id)
+        return jcp
+
+    def _collect_results(self):
+        jobs = self.experiment_utils.job_cache.get_jobs(
+            max_staleness=self.poll_interval)
+        for job in jobs:
+            trial = self._running.get(job.name)
+            if trial is None or job.execution_state not in COMPLETED_STATES:
+                continue
+            del self._running[job.name]
+            self._jobs[trial] = job
+            if job.execution_state == models.ExecutionState.failed:
+                print("Job {0} failed and will not be promoted.".format(
+                    job.name))
+                continue
+            metric = self.metric_extractor.get_metric(
+                job.name, self.experiment_utils.resource_group_name,
+                self.experiment_utils.workspace_name,
+                self.experiment_utils.experiment_name,
+                self.experiment_utils.client,
+                throttle=self.experiment_utils.throttle,
+                creation_time=job.creation_time)
+            if metric is None or math.isinf(metric) or math.isnan(metric):
+                # e.g. the log file is missing or the metric was not found
+                print("Job {0} has no metric value and will not be "
+                      "promoted.".format(job.name))
+                continue
+            self._rung_results[trial.bracket][trial.rung].append(
+                (metric, trial.config_id))
+            self.results.append({
+                "job_name": job.name,
+                "job": job,
+                "metric_value": metric,
+                "parameters": self.configs[trial.config_id][1],
+                "bracket": trial.bracket,
+                "rung": trial.rung,
+                "resource": trial.resource
+            })
+            print("Job {0} (bracket {1}, rung {2}, resource {3}) completed "
+                  "with metric value {4}".format(
+                      job.name, trial.bracket, trial.rung, trial.resource,
+                      metric))
+
+
+class HyperBand(ASHA):
+    """
+    ASHA running all HyperBand brackets concurrently: bracket s starts its
+    configs with min_resource * eta ** s, from the most aggressive early
+    stopping (s = 0) to training every config with max_resource.
+    """
+
+    def __init__(self, experiment_utils, parameter_sweep,
+                 job_create_parameters, metric_extractor, job_name_prefix,
+                 min_resource, max_resource, max_concurrent_jobs, eta=3,
+                 num_configs=None, **kwargs):
+        """
+        See ASHA.__init__. The number of brackets is determined by
+        min_resource, max_resource and eta.
+        """
+        num_brackets = int(math.log(max_resource / float(min_resource),
+                                    eta) + 1e-9) + 1
+        super(HyperBand, self).__init__(
+            experiment_utils, parameter_sweep, job_create_parameters,
+            metric_extractor, job_name_prefix, min_resource, max_resource,
+            max_concurrent_jobs, eta=eta, num_configs=num_configs,
+            num_brackets=num_brackets, **kwargs)
@@ -1,67 +1,228 @@
 from __future__ import print_function
 
+import array
+import codecs
+import concurrent.futures
+import json
+import logging
+import posixpath
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import azure.mgmt.batchai.models as models
+import numpy as np
 import requests
+import six
 from azure.mgmt.storage import StorageManagementClient
 from msrestazure.tools import parse_resource_id
 
 from utilities.cluster import print_cluster_status
+from utilities.job_state import COMPLETED_STATES
+from utilities.throttling import get_default_throttle
 
 POLLING_INTERVAL_SEC = 5
+RESUME_FROM_ID = 'RESUME_FROM'
+RESUME_FROM_ENV_VAR = 'PARAM_RESUME_FROM'
+# Batch AI creates the output directories of a job under this directory of
+# the job's unique path segment
+OUTPUTS_DIRECTORY = 'outputs'
+STORAGE_KEY_TTL_SECS = 60 * 60
+LINK_EXPIRY_MINUTES = 60
+# Download URLs are listed again this long before their SAS expires
+LINK_REFRESH_MARGIN_SECS = 5 * 60
+STDOUTERR_DIRECTORY_ID = 'stdouterr'
+STDOUTERR_FILES = ('stdout.txt', 'stderr.txt')
+TAIL_THREADS = 32
+TAIL_MIN_INTERVAL_SECS = 1
+TAIL_MAX_INTERVAL_SECS = 30
+TAIL_BACKOFF = 2
+TAIL_FINAL_RETRIES = 5
+# Seconds to wait for a connection to, and for data from, the storage
+# account when downloading output files
+DOWNLOAD_CONNECT_TIMEOUT_SECS = 10
+DOWNLOAD_READ_TIMEOUT_SECS = 60
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Returns the requests.Session shared by the readers of job output files,
+    so that connections to the storage account are reused.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=TAIL_THREADS, pool_maxsize=TAIL_THREADS)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+class OutputFileReader(object):
+    """
+    Incremental reader of an output file of a job. Each read only downloads
+    the bytes appended since the previous read, with a Range request over
+    the shared HTTP session. The download URL of the file is listed once
+    and reused until shortly before its SAS expires, and bytes are decoded
+    incrementally, so that a character split between two reads is decoded
+    correctly.
+    """
+
+    def __init__(self, client, resource_group, workspace_name,
+                 experiment_name, job_name, output_directory_id, file_name,
+                 throttle=None, session=None, directory='.'):
+        """
+        :param client: instance of BatchAIManagementClient
+        :param output_directory_id: the id of the output directory of the
+        file, e.g. STDOUTERR_DIRECTORY_ID for the standard output and error
+        of the job
+        :param file_name: the name of the file
+        :param throttle: a utilities.throttling.RequestThrottle applied to the
+        requests listing the file. If None, the shared throttle is used.
+        :param session: a requests.Session. If None, the shared session is
+        used.
+        :param directory: directory of the file, relative to the output
+        directory
+        """
+        self.client = client
+        self.throttle = throttle or get_default_throttle()
+        self.session = session or get_http_session()
+        self.resource_group = resource_group
+        self.workspace_name = workspace_name
+        self.experiment_name = experiment_name
+        self.job_name = job_name
+        self.output_directory_id = output_directory_id
+        self.file_name = file_name
+        self.directory = directory
+        self.offset = 0
+        self.url = None
+        self._url_expiry = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')(
+            errors='replace')
+
+    def read_bytes(self):
+        """
+        :return: the bytes appended to the file since the previous read, or
+        None if the file does not exist yet
+        """
+        for _ in range(2):
+            if self.url is None or time.time() > self._url_expiry:
+                self.url = self._get_url()
+                if self.url is None:
+                    return None
+            r = self._download()
+            if r.status_code == 403:  # The download link expired
+                self.url = None
+                continue
+            if r.status_code == 416:  # Nothing was appended
+                return b''
+            r.raise_for_status()
+            content = r.content
+            if r.status_code == 200:  # The range was ignored
+                content = content[self.offset:]
+            self.offset += len(content)
+            return content
+        return None
+
+    def read(self, final=False):
+        """
+        :param final: whether no more output is expected, in which case an
+        incomplete character at the end of the file is decoded as well
+        :return: the text appended to the file since the previous read, or
+        None if the file does not exist yet
+        """
+        content = self.read_bytes()
+        if content is None:
+            return None
+        return self._decoder.decode(content, final)
+
+    def _download(self):
+        """
+        Request the bytes of the file from the offset, retrying timeouts
+        and connection failures as the retry policy of the throttle allows.
+        Downloads do not go through the rate limiter of the throttle, which
+        is meant for the requests to Batch AI.
+        """
+        retry_policy = self.throttle.retry_policy
+        attempt = 0
+        while True:
+            try:
+                return self.session.get(
+                    self.url,
+                    headers={'Range': 'bytes={0}-'.format(self.offset)},
+                    timeout=(DOWNLOAD_CONNECT_TIMEOUT_SECS,
+                             DOWNLOAD_READ_TIMEOUT_SECS))
+            except requests.exceptions.RequestException as e:
+                if (attempt >= retry_policy.max_retries or
+                        not retry_policy.is_retryable(e)):
+                    raise
+                time.sleep(retry_policy.get_delay(attempt, e))
+                attempt += 1
+
+    def _get_url(self):
+        listed_at = time.time()
+        files = self.throttle.call(lambda: list(
+            self.client.jobs.list_output_files(
+                self.resource_group, self.workspace_name,
+                self.experiment_name, self.job_name,
+                models.JobsListOutputFilesOptions(
+                    outputdirectoryid=self.output_directory_id,
+                    directory=self.directory,
+                    linkexpiryinminutes=LINK_EXPIRY_MINUTES))))
+        for f in files:
+            if f.name == self.file_name:
+                self._url_expiry = (listed_at + LINK_EXPIRY_MINUTES * 60 -
+                                    LINK_REFRESH_MARGIN_SECS)
+                return f.download_url
+        return None
 
 
 class OutputStreamer:
     """Helper class to stream (tail -f) job's output files."""
 
     def __init__(self, client, resource_group, workspace_name, experiment_name, 
-                 job_name, output_directory_id, file_name):
+                 job_name, output_directory_id, file_name, throttle=None):
         self.client = client
+        self.throttle = throttle or get_default_throttle()
         self.resource_group = resource_group
         self.workspace_name = workspace_name
         self.experiment_name = experiment_name
         self.job_name = job_name
         self.output_directory_id = output_directory_id
         self.file_name = file_name
-        self.url = None
-        self.downloaded = 0
+        self.reader = OutputFileReader(
+            client, resource_group, workspace_name, experiment_name,
+            job_name, output_directory_id, file_name, throttle=self.throttle)
         # if no output_directory_id or file_name specified, the tail call is
         # nope
         if self.output_directory_id is None or self.file_name is None:
-            self.tail = lambda: None
-
-    def tail(self):
-        if not self.url:
-            files = self.client.jobs.list_output_files(
-                self.resource_group, self.workspace_name, self.experiment_name, self.job_name,
-                models.JobsListOutputFilesOptions(outputdirectoryid=self.output_directory_id))
-            if not files:
-                return
-            else:
-                for f in list(files):
-                    if f.name == self.file_name:
-                        self.url = f.download_url
-        if self.url:
-            r = requests.get(self.url, headers={
-                'Range': 'bytes={0}-'.format(self.downloaded)})
-            if int(r.status_code / 100) == 2:
-                self.downloaded += len(r.content)
-                print(r.content.decode(), end='')
+            self.tail = lambda final=False: None
+
+    def tail(self, final=False):
+        text = self.reader.read(final)
+        if text:
+            print(text, end='')
 
 
 def wait_for_job_completion(client, resource_group, workspace_name, experiment_name, 
-                            job_name, cluster_name, output_directory_id=None, file_name=None):
+                            job_name, cluster_name, output_directory_id=None, file_name=None,
+                            throttle=None):
     """
     Waits for job completion and tails a file specified by output_directory_id
     and file_name.
     """
+    throttle = throttle or get_default_throttle()
     # Wait for job to start running
     while True:
-        cluster = client.clusters.get(resource_group, workspace_name, cluster_name)
+        cluster = throttle.call(client.clusters.get, resource_group, workspace_name, cluster_name)
         print_cluster_status(cluster)
-        job = client.jobs.get(resource_group, workspace_name, experiment_name, job_name)
+        job = throttle.call(client.jobs.get, resource_group, workspace_name, experiment_name, job_name)
         print_job_status(job)
         if job.execution_state != models.ExecutionState.queued:
             break
@@ -71,17 +232,232 @@ def wait_for_job_completion(client, resource_group, workspace_name, experiment_n
 
     # Tail the output file and wait for job to complete
     streamer = OutputStreamer(client, resource_group, workspace_name, experiment_name, 
-                              job_name, output_directory_id, file_name)
+                              job_name, output_directory_id, file_name, throttle=throttle)
     while True:
         streamer.tail()
-        job = client.jobs.get(resource_group, workspace_name, experiment_name, job_name)
+        job = throttle.call(client.jobs.get, resource_group, workspace_name, experiment_name, job_name)
         if job.execution_state in (models.ExecutionState.succeeded, models.ExecutionState.failed):
             break
         time.sleep(1)
-    streamer.tail()
+    streamer.tail(final=True)
     print_job_status(job)
 
 
+class JobOutputTailer(object):
+    """
+    Follows output files (by default the standard output and error) of many
+    jobs of an experiment at once, e.g. to watch a whole sweep live.
+
+    Files are read concurrently on a thread pool sharing pooled HTTP
+    connections, each with an OutputFileReader. The interval between reads
+    of a file doubles, up to max_interval, while nothing is appended to it,
+    and goes back to min_interval when output appears. Output is passed to
+    the callback line by line. Once a job completed, its files are read to
+    the end; a failed final read is retried with backoff, up to
+    TAIL_FINAL_RETRIES times.
+    """
+
+    def __init__(self, experiment_utils, output_directory_id=
+                 STDOUTERR_DIRECTORY_ID, file_names=STDOUTERR_FILES,
+                 job_names=None, callback=None, num_threads=TAIL_THREADS,
+                 min_interval=TAIL_MIN_INTERVAL_SECS,
+                 max_interval=TAIL_MAX_INTERVAL_SECS):
+        """
+        :param experiment_utils: the ExperimentUtils of the experiment
+        :param output_directory_id: the id of the output directory of the
+        files
+        :param file_names: names of the files to follow in each job
+        :param job_names: names of jobs to follow. If None, all jobs in the
+        experiment are followed.
+        :param callback: a function called with the job name, the file name
+        and a list of new complete lines. If None, lines are printed with
+        the job and file name as prefix.
+        :param num_threads: maximum number of files read concurrently
+        :param min_interval: minimum number of seconds between reads of a
+        file
+        :param max_interval: maximum number of seconds between reads of an
+        idle file
+        """
+        self.experiment_utils = experiment_utils
+        self.output_directory_id = output_directory_id
+        self.file_names = file_names
+        self.job_names = set(job_names) if job_names else None
+        self.callback = callback or _print_lines
+        self.num_threads = num_threads
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._files = {}  # (job name, file name) -> _TailedFile
+        self._completed = set()  # jobs whose files were read to the end
+        self._executor = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.logger = logging.getLogger('ExperimentUtils')
+
+    def poll(self):
+        """
+        Read the files which are due, once.
+
+        :return: the number of seconds until a file is due again
+        """
+        eu = self.experiment_utils
+        jobs = eu.job_cache.get_jobs(max_staleness=self.min_interval)
+        now = time.time()
+        due = []
+        final_jobs = []
+        for job in jobs:
+            if self.job_names is not None and job.name not in self.job_names:
+                continue
+            if job.name in self._completed or \
+                    job.execution_state == models.ExecutionState.queued:
+                continue
+            final = job.execution_state in COMPLETED_STATES
+            for file_name in self.file_names:
+                key = (job.name, file_name)
+                tailed = self._files.get(key)
+                if tailed is None:
+                    tailed = self._files[key] = _TailedFile(
+                        OutputFileReader(
+                            eu.client, eu.resource_group_name,
+                            eu.workspace_name, eu.experiment_name, job.name,
+                            self.output_directory_id, file_name,
+                            throttle=eu.throttle),
+                        self.min_interval)
+                if (final and not tailed.failures) or \
+                        tailed.next_read <= now:
+                    due.append((key, tailed, final))
+            if final:
+                final_jobs.append(job.name)
+        executor = self._get_executor()
+        futures = {executor.submit(tailed.read, final): (key, tailed, final)
+                   for key, tailed, final in due}
+        for future in concurrent.futures.as_completed(futures):
+            key, tailed, final = futures[future]
+            try:
+                lines = future.result()
+            except Exception as e:
+                self.logger.error("Reading %s of job %s failed: %s",
+                                  key[1], key[0], str(e))
+                if final:
+                    tailed.failures += 1
+                lines = None
+            if lines:
+                self.callback(key[0], key[1], lines)
+                tailed.interval = self.min_interval
+            else:
+                tailed.interval = min(self.max_interval,
+                                      tailed.interval * TAIL_BACKOFF)
+            tailed.next_read = time.time() + tailed.interval
+            if final and (lines is not None or
+                          tailed.failures > TAIL_FINAL_RETRIES):
+                del self._files[key]
+        for job_name in final_jobs:
+            if not any((job_name, file_name) in self._files
+                       for file_name in self.file_names):
+                self._completed.add(job_name)
+        if not self._files:
+            return self.min_interval
+        return max(0, min(t.next_read for t in self._files.values()) -
+                   time.time())
+
+    def run(self, timeout=None):
+        """
+        Follow the files until all followed jobs completed and their files
+        were read to the end.
+
+        :param timeout: number of seconds after which to stop
+        """
+        start = time.time()
+        try:
+            while not self._stop_event.is_set():
+                wait = max(self.poll(), self.min_interval / 2.0)
+                if self._all_completed():
+                    return
+                if timeout and time.time() - start + wait > timeout:
+                    return
+                self._stop_event.wait(wait)
+        finally:
+            self.close()
+
+    def start(self):
+        """Follow the files in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop following and wait for the background thread to exit."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.close()
+
+    def close(self):
+        """
+        Shut down the reading threads. They are started again by the next
+        poll.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        return self._executor
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.logger.error("Tailing job output failed: %s", str(e))
+
+    def _all_completed(self):
+        if self._files or not self._completed:
+            # Jobs may not have been created yet
+            return False
+        if self.job_names is None:
+            jobs = self.experiment_utils.job_cache.get_jobs(
+                max_staleness=self.min_interval)
+            return all(job.name in self._completed for job in jobs)
+        return self.job_names <= self._completed
+
+
+class _TailedFile(object):
+    """
+    A followed file: its reader, read schedule and incomplete last line.
+    """
+
+    def __init__(self, reader, interval):
+        self.reader = reader
+        self.interval = interval
+        self.next_read = 0
+        self.failures = 0  # failed reads after the job completed
+        self.remainder = ''
+
+    def read(self, final=False):
+        """
+        :return: the list of new complete lines, including the last line if
+        final is True
+        """
+        text = self.reader.read(final)
+        if not text and not (final and self.remainder):
+            return []
+        lines = (self.remainder + (text or '')).split('\n')
+        self.remainder = '' if final else lines.pop()
+        if final and not lines[-1]:
+            lines.pop()
+        return lines
+
+
+def _print_lines(job_name, file_name, lines):
+    for line in lines:
+        print('[{0}/{1}] {2}'.format(job_name, file_name, line))
+
+
 def print_job_status(job):
     failure_message = None
     exit_code = 'None'
@@ -102,7 +478,18 @@ def print_job_status(job):
         print('FailureDetails: {0}'.format(failure_message))
 
 
-def convert_job_to_jcp(job, client):
+def convert_job_to_jcp(job, client, storage_keys=None):
+    """
+    Returns JobCreateParameters to create the job again, with the keys of its
+    mounted storage accounts looked up with the management client.
+
+    :param job: an azure.mgmt.batchai.models.Job
+    :param client: instance of BatchAIManagementClient
+    :param storage_keys: a StorageKeyCache. If None, the cache shared by all
+    clients of the subscription is used.
+    """
+    if storage_keys is None:
+        storage_keys = get_storage_key_cache(client)
     jcp_kwargs = models.JobCreateParameters._attribute_map.keys()
     jcp_dict = {
         kwarg: getattr(job, kwarg)
@@ -111,32 +498,148 @@ def convert_job_to_jcp(job, client):
     new_jcp = models.JobCreateParameters(**jcp_dict)
     new_jcp.constraints = None
     for bfs in new_jcp.mount_volumes.azure_blob_file_systems:
-        bfs.credentials.account_key = _get_storage_account_key(
-            bfs.account_name, client)
+        bfs.credentials.account_key = storage_keys.get_key(bfs.account_name)
     for afs in new_jcp.mount_volumes.azure_file_shares:
-        afs.credentials.account_key = _get_storage_account_key(
-            afs.account_name, client)
+        afs.credentials.account_key = storage_keys.get_key(afs.account_name)
     return new_jcp
 
 
-def _get_storage_account_key(account_name, client):
-    storage_client = StorageManagementClient(
-        credentials=client.config.credentials,
-        subscription_id=client.config.subscription_id,
-        base_url=client.config.base_url)
-    accounts = [a.id for a in list(storage_client.storage_accounts.list())
-                if a.name == account_name]
-    if not accounts:
-        raise ValueError(
-            'Cannot find "{0}" storage account.'.format(account_name))
-    resource_group = parse_resource_id(accounts[0])['resource_group']
-    keys_list_result = storage_client.storage_accounts.list_keys(
-        resource_group, account_name)
-    if not keys_list_result or not keys_list_result.keys:
-        raise ValueError(
-            'Cannot find a key for "{0}" storage account.'.format(
-                account_name))
-    return keys_list_result.keys[0].value
+def get_output_directory_path(job, output_directory_id=None):
+    """
+    Returns the full path of an output directory of a job, as seen from the
+    nodes.
+
+    :param job: an azure.mgmt.batchai.models.Job
+    :param output_directory_id: the id of the output directory. If None,
+    the first output directory of the job is used.
+    """
+    for output_directory in job.output_directories or []:
+        if output_directory_id in (None, output_directory.id):
+            path = posixpath.join(output_directory.path_prefix,
+                                  job.job_output_directory_path_segment,
+                                  OUTPUTS_DIRECTORY)
+            if output_directory.path_suffix:
+                path = posixpath.join(path, output_directory.path_suffix)
+            return path
+    raise ValueError('Job "{0}" has no output directory "{1}"'.format(
+        job.name, output_directory_id))
+
+
+def set_resume_from(jcp, job, output_directory_id=None):
+    """
+    Make the job created from jcp resume from the output (e.g. checkpoints)
+    of a completed job: the output directory of job is added to jcp as the
+    RESUME_FROM input directory, and its path is set in the
+    PARAM_RESUME_FROM environment variable. The training script is
+    expected to load its latest checkpoint from there and only train the
+    remaining epochs.
+
+    :param jcp: an azure.mgmt.batchai.models.JobCreateParameters, e.g.
+    returned by convert_job_to_jcp. Its lists of input directories and
+    environment variables are replaced, not modified.
+    :param job: the azure.mgmt.batchai.models.Job to resume from
+    :param output_directory_id: the id of the output directory holding the
+    checkpoints. If None, the first output directory of job is used.
+    :return: jcp
+    """
+    path = get_output_directory_path(job, output_directory_id)
+    jcp.input_directories = [
+        d for d in jcp.input_directories or [] if d.id != RESUME_FROM_ID
+    ] + [models.InputDirectory(id=RESUME_FROM_ID, path=path)]
+    jcp.environment_variables = [
+        ev for ev in jcp.environment_variables or []
+        if ev.name != RESUME_FROM_ENV_VAR
+    ] + [models.EnvironmentVariable(name=RESUME_FROM_ENV_VAR, value=path)]
+    return jcp
+
+
+class StorageKeyCache(object):
+    """
+    Thread-safe cache of the resource groups and keys of the storage
+    accounts in a subscription, looked up with a single
+    StorageManagementClient.
+
+    One listing of the subscription resolves the resource groups of all its
+    storage accounts, and the key of each account is fetched once; both
+    expire after ttl seconds, so that rotated keys are eventually picked up.
+    """
+
+    def __init__(self, client, ttl=STORAGE_KEY_TTL_SECS):
+        """
+        :param client: instance of BatchAIManagementClient, whose credentials
+        and subscription are used
+        :param ttl: number of seconds after which cached resource groups and
+        keys are looked up again
+        """
+        self.ttl = ttl
+        self._storage_client = StorageManagementClient(
+            credentials=client.config.credentials,
+            subscription_id=client.config.subscription_id,
+            base_url=client.config.base_url)
+        self._resource_groups = {}  # account name -> resource group
+        self._listed_at = None
+        self._keys = {}  # account name -> (key, time)
+        self._lock = threading.Lock()
+
+    def get_key(self, account_name):
+        """
+        :return: the first key of the storage account
+        """
+        with self._lock:
+            key, fetched_at = self._keys.get(account_name, (None, None))
+            if key is not None and time.time() - fetched_at <= self.ttl:
+                return key
+            resource_group = self._get_resource_group(account_name)
+            keys_list_result = self._storage_client.storage_accounts.list_keys(
+                resource_group, account_name)
+            if not keys_list_result or not keys_list_result.keys:
+                raise ValueError(
+                    'Cannot find a key for "{0}" storage account.'.format(
+                        account_name))
+            key = keys_list_result.keys[0].value
+            self._keys[account_name] = (key, time.time())
+            return key
+
+    def invalidate(self, account_name=None):
+        """
+        Forget the cached key of a storage account (e.g. after rotating it),
+        or all cached resource groups and keys if account_name is None.
+        """
+        with self._lock:
+            if account_name is None:
+                self._keys = {}
+                self._listed_at = None
+            else:
+                self._keys.pop(account_name, None)
+
+    def _get_resource_group(self, account_name):
+        if self._listed_at is None or \
+                time.time() - self._listed_at > self.ttl or \
+                account_name not in self._resource_groups:
+            self._resource_groups = {
+                a.name: parse_resource_id(a.id)['resource_group']
+                for a in self._storage_client.storage_accounts.list()}
+            self._listed_at = time.time()
+        if account_name not in self._resource_groups:
+            raise ValueError(
+                'Cannot find "{0}" storage account.'.format(account_name))
+        return self._resource_groups[account_name]
+
+
+_storage_key_caches = {}
+_storage_key_caches_lock = threading.Lock()
+
+
+def get_storage_key_cache(client):
+    """
+    Returns the StorageKeyCache shared by all clients of the subscription of
+    client, creating it if needed.
+    """
+    key = (client.config.subscription_id, client.config.base_url)
+    with _storage_key_caches_lock:
+        if key not in _storage_key_caches:
+            _storage_key_caches[key] = StorageKeyCache(client)
+        return _storage_key_caches[key]
 
 
 class MetricExtractor:
@@ -145,39 +648,414 @@ class MetricExtractor:
     
     output_dir:  job list-file option used to obtain learning log file download URL
     logfile: the name of learning log file
-    regex: the regular expression to extract the desired metric from log text
+    regex: the regular expression to extract the desired metric from log text,
+    matching the value as a whole or with its only capture group
     metric: option to aggregate the desired metric, default is the last occurrence 
-    
+
+    The log of each job is read incrementally: every call only downloads the
+    bytes appended since the previous call for the same job, and the metric
+    values are aggregated as they are read. The regex is matched against
+    each line separately, so a match must not span lines. Pass the creation
+    time of the job, so that the log of a job resubmitted with the same name
+    is read from the start.
     """
+    CALCULATE_METHODS = ("last", "mean", "min", "max")
+
     def __init__(self, output_dir_id, logfile, regex, calculate_method="last"):
+        if calculate_method not in self.CALCULATE_METHODS:
+            raise ValueError(
+                'Invalid calculate method "{0}"'.format(calculate_method))
         self.output_dir_id = output_dir_id
         self.logfile = logfile
         self.regex = regex
         self.calculate_method = calculate_method
+        self._pattern = re.compile(regex, re.DOTALL)
+        if self._pattern.groups > 1:
+            raise ValueError(
+                'Regex "{0}" must have at most one capture group'.format(
+                    regex))
+        self._streams = {}  # (experiment, job name, directory) -> stream
+        self._lock = threading.Lock()
+
+    def get_metric(self, job_name, resource_group, workspace_name, experiment_name, client,
+                   throttle=None, directory='.', creation_time=None):
+        """
+        :param directory: directory of the log file, relative to the output
+        directory, e.g. the trial_<i> directory of a packed trial
+        :param creation_time: the creation_time of the job. If it differs
+        from that of the job previously read under the same name (e.g. the
+        job was resubmitted), the log is read from the start.
+        :return: the aggregated metric value, or inf if the log file does not
+        exist or does not contain the metric
+        """
+        stream = self._get_stream(job_name, resource_group, workspace_name,
+                                  experiment_name, client, throttle,
+                                  directory, creation_time)
+        with stream.lock:
+            stream.read()
+            return stream.get(self.calculate_method)
+
+    def get_new_values(self, job_name, resource_group, workspace_name,
+                       experiment_name, client, throttle=None, directory='.',
+                       final=False, creation_time=None):
+        """
+        Read the lines appended to the log file of a job since the previous
+        call for the job, e.g. to follow the metric while the job runs.
+
+        :param final: whether the job completed, in which case a last line
+        without trailing newline is read as well
+        :param creation_time: see get_metric
+        :return: the list of metric values in the new complete lines
+        """
+        stream = self._get_stream(job_name, resource_group, workspace_name,
+                                  experiment_name, client, throttle,
+                                  directory, creation_time)
+        with stream.lock:
+            return stream.read(final)
+
+    def reset(self, job_name=None):
+        """
+        Forget the read position and aggregated values of a job, or of all
+        jobs if job_name is None, e.g. after resubmitting the job.
+        """
+        with self._lock:
+            for key in list(self._streams):
+                if job_name is None or key[1] == job_name:
+                    del self._streams[key]
+
+    def _get_stream(self, job_name, resource_group, workspace_name,
+                    experiment_name, client, throttle, directory,
+                    creation_time):
+        key = ((resource_group, workspace_name, experiment_name), job_name,
+               directory)
+        with self._lock:
+            return _get_log_stream(
+                self._streams, key, creation_time,
+                lambda: _MetricStream(
+                    OutputFileReader(
+                        client, resource_group, workspace_name,
+                        experiment_name, job_name, self.output_dir_id,
+                        self.logfile, throttle=throttle,
+                        directory=directory),
+                    self._pattern))
+
+
+class TimeSeriesExtractor(object):
+    """
+    Extracts the time series of several metrics (e.g. step, loss, accuracy
+    and throughput) from a job's log file in a single pass.
+
+    Each line of the log is either matched against regexes with named groups
+    (a line matching several regexes gives a single record with the groups
+    of all of them), or parsed as a JSON object whose numeric fields are the
+    metrics. Every matching line is one record; the series of a job is a
+    dict of metric name to a numpy array with one value per record, NaN
+    where a record does not have the metric.
+
+    Like MetricExtractor, logs are read incrementally, and the extractor can
+    be used wherever a MetricExtractor is expected (e.g. early stopping or
+    ASHA) by naming the metric to aggregate.
+    """
+
+    def __init__(self, output_dir_id, logfile, patterns=None,
+                 json_lines=False, metric=None, calculate_method="last"):
+        """
+        :param output_dir_id: the id of the output directory of the log file
+        :param logfile: the name of the log file
+        :param patterns: a regex or a list of regexes with named groups,
+        e.g. r'step (?P<step>\\d+): loss=(?P<loss>[0-9.e-]+)'
+        :param json_lines: if True, lines which are JSON objects are parsed
+        instead, e.g. {"step": 10, "loss": 0.5}
+        :param metric: the metric returned by get_metric and get_new_values
+        :param calculate_method: how get_metric aggregates the values of
+        metric: "last", "mean", "min" or "max"
+        """
+        if isinstance(patterns, six.string_types):
+            patterns = [patterns]
+        if not patterns and not json_lines:
+            raise ValueError("Patterns or JSON lines mode must be given")
+        if calculate_method not in MetricExtractor.CALCULATE_METHODS:
+            raise ValueError(
+                'Invalid calculate method "{0}"'.format(calculate_method))
+        self.output_dir_id = output_dir_id
+        self.logfile = logfile
+        self.patterns = [re.compile(p) for p in patterns or []]
+        for pattern in self.patterns:
+            if not pattern.groupindex:
+                raise ValueError(
+                    'Pattern "{0}" has no named groups'.format(
+                        pattern.pattern))
+        self.json_lines = json_lines
+        self.metric = metric
+        self.calculate_method = calculate_method
+        self._streams = {}  # (experiment, job name, directory) -> stream
+        self._lock = threading.Lock()
+
+    def get_series(self, job_name, resource_group, workspace_name,
+                   experiment_name, client, throttle=None, directory='.',
+                   final=False, creation_time=None):
+        """
+        Read the lines appended to the log file of a job since the previous
+        call, and return its whole series.
+
+        :param directory: directory of the log file, relative to the output
+        directory, e.g. the trial_<i> directory of a packed trial
+        :param final: whether the job completed, in which case a last line
+        without trailing newline is read as well
+        :param creation_time: see MetricExtractor.get_metric
+        :return: a dict of metric name to numpy array of values, all arrays
+        having one value per record
+        """
+        stream = self._get_stream(job_name, resource_group, workspace_name,
+                                  experiment_name, client, throttle,
+                                  directory, creation_time)
+        with stream.lock:
+            stream.read(final)
+            return stream.get_series()
 
-    def get_metric(self, job_name, resource_group, workspace_name, experiment_name, client):
-        files = client.jobs.list_output_files(resource_group, workspace_name, experiment_name, job_name,
-                                              models.JobsListOutputFilesOptions(outputdirectoryid=self.output_dir_id))
-        val = float("inf")
-        for file in list(files):
-            if file.name == self.logfile:
-                text = ""
+    def get_metric(self, job_name, resource_group, workspace_name,
+                   experiment_name, client, throttle=None, directory='.',
+                   creation_time=None):
+        """
+        See MetricExtractor.get_metric. The aggregate of metric is returned.
+        """
+        stream = self._get_metric_stream(
+            job_name, resource_group, workspace_name, experiment_name,
+            client, throttle, directory, creation_time)
+        with stream.lock:
+            stream.read()
+            # The incomplete last line counts, as in MetricExtractor
+            pending = self.parse_line(stream.remainder).get(self.metric)
+            return stream.aggregate.get(
+                self.calculate_method,
+                [] if pending is None or np.isnan(pending) else [pending])
+
+    def get_new_values(self, job_name, resource_group, workspace_name,
+                       experiment_name, client, throttle=None, directory='.',
+                       final=False, creation_time=None):
+        """
+        See MetricExtractor.get_new_values. The new values of metric are
+        returned.
+        """
+        stream = self._get_metric_stream(
+            job_name, resource_group, workspace_name, experiment_name,
+            client, throttle, directory, creation_time)
+        with stream.lock:
+            return [record[self.metric] for record in stream.read(final)
+                    if self.metric in record]
+
+    def reset(self, job_name=None):
+        """
+        See MetricExtractor.reset.
+        """
+        with self._lock:
+            for key in list(self._streams):
+                if job_name is None or key[1] == job_name:
+                    del self._streams[key]
+
+    def parse_line(self, line):
+        """
+        :return: a dict of metric name to value of the metrics in line, empty
+        if the line does not match
+        """
+        record = {}
+        if self.json_lines:
+            line = line.strip()
+            if line.startswith('{'):
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    obj = {}
+                for name, value in obj.items():
+                    if isinstance(value, six.integer_types + (float,)) and \
+                            not isinstance(value, bool):
+                        record[name] = float(value)
+        for pattern in self.patterns:
+            match = pattern.search(line)
+            if match is None:
+                continue
+            for name, value in match.groupdict().items():
+                if value is None:
+                    continue
                 try:
-                    r = requests.get(file.download_url, stream=True)
-                    for chunk in r.iter_content(chunk_size=512 * 1024):
-                        if chunk:  # filter out keep-alive new chunks
-                            text += chunk.decode(encoding='UTF-8')
-                except Exception as e:
-                    print(e)
-                vals = re.findall(self.regex, text, re.DOTALL)
-                if self.calculate_method is "last":
-                    val = float(vals[len(vals) - 1])
-                elif self.calculate_method is "mean":
-                    val = sum([float(m) for m in vals])/len(vals)
-                elif self.calculate_method is "min":
-                    val = min([float(m) for m in vals])
-                elif self.calculate_method is "max":
-                    val = max([float(m) for m in vals])
-                break
-
-        return val
\ No newline at end of file
+                    record[name] = float(value)
+                except ValueError:
+                    pass
+        return record
+
+    def _get_metric_stream(self, *args):
+        if self.metric is None:
+            raise ValueError("No metric was given to the extractor")
+        return self._get_stream(*args)
+
+    def _get_stream(self, job_name, resource_group, workspace_name,
+                    experiment_name, client, throttle, directory,
+                    creation_time):
+        key = ((resource_group, workspace_name, experiment_name), job_name,
+               directory)
+        with self._lock:
+            return _get_log_stream(
+                self._streams, key, creation_time,
+                lambda: _SeriesStream(
+                    OutputFileReader(
+                        client, resource_group, workspace_name,
+                        experiment_name, job_name, self.output_dir_id,
+                        self.logfile, throttle=throttle,
+                        directory=directory),
+                    self.parse_line, self.metric))
+
+
+def _get_log_stream(streams, key, creation_time, create_stream):
+    """
+    Returns the stream of streams at key, replaced by a new stream from
+    create_stream() if there is none or if it was read from an older job
+    with the same name, i.e. with another creation time.
+    """
+    stream = streams.get(key)
+    if stream is None or (creation_time is not None and
+                          stream.creation_time is not None and
+                          stream.creation_time != creation_time):
+        stream = streams[key] = create_stream()
+    if creation_time is not None:
+        stream.creation_time = creation_time
+    return stream
+
+
+class _LogStream(object):
+    """
+    The read position in a log file and its incomplete last line.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.remainder = ''
+        self.creation_time = None  # of the job the log belongs to
+        self.lock = threading.Lock()
+
+    def read_lines(self, final=False):
+        """
+        :return: the new complete lines of the log, including the last line
+        if final is True
+        """
+        text = self.reader.read(final)
+        if not text and not (final and self.remainder):
+            return []
+        lines = (self.remainder + (text or '')).split('\n')
+        self.remainder = '' if final else lines.pop()
+        return [line for line in lines if line]
+
+
+class _MetricStream(_LogStream):
+    """
+    The read position in a log file and the running aggregates of the metric
+    values read from it.
+    """
+
+    def __init__(self, reader, pattern):
+        super(_MetricStream, self).__init__(reader)
+        self.pattern = pattern
+        self.aggregate = _Aggregate()
+
+    def read(self, final=False):
+        """
+        :return: the metric values in the new complete lines of the log
+        """
+        values = self._match(self.read_lines(final))
+        for value in values:
+            self.aggregate.add(value)
+        return values
+
+    def get(self, calculate_method):
+        """
+        :return: the aggregate of the values read so far and of the values
+        in the incomplete last line, or inf if there are none
+        """
+        return self.aggregate.get(calculate_method,
+                                  self._match([self.remainder]))
+
+    def _match(self, lines):
+        values = []
+        for line in lines:
+            values.extend(float(m) for m in self.pattern.findall(line))
+        return values
+
+
+class _SeriesStream(_LogStream):
+    """
+    The read position in a log file and the columns of the records read
+    from it, stored as arrays of doubles, with the running aggregates of
+    one of the metrics.
+    """
+
+    def __init__(self, reader, parse_line, metric=None):
+        super(_SeriesStream, self).__init__(reader)
+        self.parse_line = parse_line
+        self.metric = metric
+        self.aggregate = _Aggregate()  # of the values of metric
+        self.columns = {}  # metric name -> array.array of values
+        self.num_records = 0
+
+    def read(self, final=False):
+        """
+        :return: the list of records in the new complete lines of the log
+        """
+        records = []
+        for line in self.read_lines(final):
+            record = self.parse_line(line)
+            if not record:
+                continue
+            records.append(record)
+            for name in record:
+                if name not in self.columns:
+                    self.columns[name] = array.array(
+                        'd', [np.nan]) * self.num_records
+            for name, column in self.columns.items():
+                column.append(record.get(name, np.nan))
+            self.num_records += 1
+            value = record.get(self.metric)
+            if value is not None and not np.isnan(value):
+                self.aggregate.add(value)
+        return records
+
+    def get_series(self):
+        return {name: np.array(column)
+                for name, column in self.columns.items()}
+
+
+class _Aggregate(object):
+    """
+    Running count, sum, minimum, maximum and last of a sequence of values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.last = value
+
+    def get(self, calculate_method, pending=()):
+        """
+        :param calculate_method: "last", "mean", "min" or "max"
+        :param pending: values not added yet which are included, e.g. those
+        in the incomplete last line of a log
+        :return: the aggregate of the values, or inf if there are none
+        """
+        pending = list(pending)
+        count = self.count + len(pending)
+        if count == 0:
+            return float("inf")
+        if calculate_method == "last":
+            return pending[-1] if pending else self.last
+        elif calculate_method == "mean":
+            return (self.total + sum(pending)) / count
+        elif calculate_method == "min":
+            return min([self.min] + pending)
+        return max([self.max] + pending)
@@ -1,8 +1,12 @@
 from __future__ import print_function
 
+import concurrent.futures
 import copy
+import hashlib
+import heapq
 import itertools
 import json
+import math
 import posixpath
 import re
 from builtins import *
@@ -13,8 +17,23 @@ import numpy as np
 import six
 from azure.storage.blob import BlockBlobService
 from azure.storage.file import FileService
+from concurrent.futures import ThreadPoolExecutor
 from jsonschema import validate
 
+from utilities.listing_cache import MAX_AGE_SECS, ListingEntry, to_timestamp
+from utilities.sampling import get_sampler
+
+NUM_TRIALS_ENV_VAR = 'PARAM_NUM_TRIALS'
+TRIALS_ENV_VAR = 'PARAM_TRIALS'
+TRIAL_INDEX_ENV_VAR = 'PARAM_TRIAL_INDEX'
+TRIAL_DIRECTORY_FORMAT = 'trial_{0}'
+SAMPLE_BATCH_SIZE = 10000
+LISTING_THREADS = 16
+MANIFEST_DIRECTORY = '.manifests'
+MANIFEST_HASH_LENGTH = 16
+# Marker of the Substitution properties in a substitution plan
+_SUBSTITUTE_OBJECT = 'object'
+
 
 class Parameter(object):
     def __init__(self, parameter_name):
@@ -28,6 +47,18 @@ class Parameter(object):
     def get_random(self):
         return self.values[np.random.randint(0, len(self.values))]
 
+    def from_unit(self, u):
+        """
+        Map numbers in [0, 1] to values of this parameter, each value
+        covering an equal share of the interval.
+
+        :param u: a numpy array of numbers in [0, 1]
+        :return: a list of values
+        """
+        indices = np.minimum((np.asarray(u) * len(self.values)).astype(int),
+                             len(self.values) - 1)
+        return [self.values[i] for i in indices]
+
 
 class NumericParameter(Parameter):
     ENDPOINT_OFFSET = 0.001
@@ -95,6 +126,40 @@ class NumericParameter(Parameter):
             return np.exp(np.random.uniform(np.log(self.start),
                                             np.log(self.end)))
 
+    def from_unit(self, u):
+        """
+        Map numbers in [0, 1] to the range [start, end] of this parameter,
+        linearly or logarithmically depending on the scale. Values are
+        rounded if the data type is "INTEGER".
+
+        :param u: a numpy array of numbers in [0, 1]
+        :return: a list of values
+        """
+        u = np.asarray(u, dtype=float)
+        if self.scale == 'LINEAR':
+            values = self.start + u * (self.end - self.start)
+        else:
+            values = np.exp(np.log(self.start) + u * (
+                np.log(self.end) - np.log(self.start)))
+        if self.data_type == 'INTEGER':
+            return [int(v) for v in np.round(values)]
+        return [float(v) for v in values]
+
+    def to_unit(self, values):
+        """
+        Inverse of from_unit.
+
+        :param values: a sequence of values in the range [start, end]
+        :return: a numpy array of numbers in [0, 1]
+        """
+        values = np.asarray(values, dtype=float)
+        if self.scale == 'LINEAR':
+            u = (values - self.start) / float(self.end - self.start)
+        else:
+            u = (np.log(values) - np.log(self.start)) / (
+                np.log(self.end) - np.log(self.start))
+        return np.clip(u, 0, 1)
+
 
 class DiscreteParameter(Parameter):
     def __init__(self, parameter_name, values):
@@ -150,7 +215,8 @@ class FileParameter(Parameter):
     def __init__(self, parameter_name, storage_account_name,
                  storage_account_key, storage_type, mount_path, mount_method,
                  container=None, fileshare=None, directory=None,
-                 filter_str=None):
+                 filter_str=None, num_threads=LISTING_THREADS,
+                 listing_cache=None, max_listing_age=MAX_AGE_SECS):
         """
         For generating a list of files stored in an Azure File/Blob storage.
         The File share or Blob container must be mounted to the job (or the
@@ -179,7 +245,15 @@ class FileParameter(Parameter):
         may take a long time).
         :param filter_str: a regex, used with re.match, which must match the
         full path of the file for the file to be returned. If unspecified, all
-        files will be returned.
+        files will be returned. Only blobs, files and directories starting
+        with the literal text at the beginning of the regex (e.g. "images/cat"
+        for "images/cat_[0-9]+\\.jpg") are listed from the storage account.
+        :param num_threads: number of File share directories listed
+        concurrently
+        :param listing_cache: a utilities.listing_cache.ListingCache. If
+        given, listings younger than max_listing_age are read from it instead
+        of the storage account, and new listings are recorded in it.
+        :param max_listing_age: maximum age in seconds of cached listings
         """
         super().__init__(parameter_name)
         if mount_method == "JOB":
@@ -188,66 +262,212 @@ class FileParameter(Parameter):
             mount_root = "$AZ_BATCHAI_MOUNT_ROOT"
         else:
             raise ValueError('Invalid mount method')
+        self.storage_account_name = storage_account_name
+        self.listing_cache = listing_cache
+        self.max_listing_age = max_listing_age
+        prefix = _get_literal_prefix(filter_str) if filter_str else ''
         if storage_type == 'BLOB' and container:
             blob_service = BlockBlobService(
                 storage_account_name, storage_account_key)
-            blobs = blob_service.list_blobs(container)
-            blob_names = [b.name for b in blobs]
-            if filter_str:
-                blob_names = [
-                    b for b in blob_names
-                    if re.match(filter_str, b) is not None
-                ]
-            blob_paths = [
-                posixpath.join(mount_root, mount_path, blob_name)
-                for blob_name in blob_names
-            ]
-            self.values = blob_paths
+            files = self._iter_blobs(blob_service, container, prefix)
         elif storage_type == 'FILE' and fileshare:
             file_service = FileService(storage_account_name, storage_account_key)
-            file_paths = self._list_files_in_fileshare(
-                file_service, fileshare, root_dir=directory)
-            if filter_str:
-                file_paths = [
-                    f for f in file_paths
-                    if re.match(filter_str, f) is not None
-                ]
-            file_paths = [
-                posixpath.join(mount_root, mount_path, file_path)
-                for file_path in file_paths
-            ]
-            self.values = file_paths
+            files = self._iter_files_in_fileshare(
+                file_service, fileshare, root_dir=directory, prefix=prefix,
+                num_threads=num_threads)
         else:
             raise ValueError('Invalid options for file parameter sweep')
+        if filter_str:
+            filter_regex = re.compile(filter_str)
+            files = (f for f in files if filter_regex.match(f.name) is not None)
+        # Directories are listed concurrently; sorting keeps the order of the
+        # values, and therefore of the generated jobs, reproducible.
+        files = sorted(files)
+        self.mount_directory = posixpath.join(mount_root, mount_path)
+        self.values = [posixpath.join(self.mount_directory, f.name)
+                       for f in files]
+        # Sizes in bytes of the files in values, None if unknown
+        self.sizes = [f.size for f in files]
 
-    def _list_files_in_fileshare(self, service, fileshare, root_dir):
+    def _iter_blobs(self, service, container, prefix):
         """
-        List the paths of all files in share.
+        List the blobs in a container, or read their listing from the
+        listing cache.
 
-        :param client: instance of azure.storage.file.FileService
+        :param service: instance of azure.storage.blob.BlockBlobService
+        :param container: container name
+        :param prefix: prefix of the names of the listed blobs
+        :return: a generator of ListingEntry of the blobs
+        """
+        location = 'BLOB/' + container
+        if self.listing_cache is not None:
+            entries = self.listing_cache.get(
+                self.storage_account_name, location, '', prefix,
+                max_age=self.max_listing_age)
+            if entries is not None:
+                for entry in entries:
+                    yield entry
+                return
+        entries = []
+        for b in service.list_blobs(container, prefix=prefix or None):
+            entry = ListingEntry(b.name, False, b.properties.content_length,
+                                 to_timestamp(b.properties.last_modified))
+            entries.append(entry)
+            yield entry
+        if self.listing_cache is not None:
+            self.listing_cache.put(self.storage_account_name, location, '',
+                                   prefix, entries)
+
+    def _iter_files_in_fileshare(self, service, fileshare, root_dir,
+                                 prefix='', num_threads=LISTING_THREADS):
+        """
+        List the paths of the files in a share, listing directories
+        concurrently.
+
+        :param service: instance of azure.storage.file.FileService
         :param fileshare: file share name
         :param root_dir: root directory. If None, all files in fileshare
         are listed
-        :return: list of paths of files in the file share
-        """
-        files = []
-        dirs = [root_dir]
-        while dirs:
-            current_dir = dirs.pop()
-            files_in_dir = service.list_directories_and_files(
-                share_name=fileshare,
-                directory_name=current_dir
-            )
-            for f in files_in_dir:
-                if current_dir is not None:
-                    file_path = posixpath.join(current_dir, f.name)
-                else:
-                    file_path = f.name
-                if isinstance(f, azure.storage.file.models.File):
-                    files.append(file_path)
-                else:  # f is a directory
-                    dirs.append(file_path)
-        return files
+        :param prefix: only directories which may contain paths starting
+        with prefix are listed
+        :param num_threads: number of directories listed concurrently
+        :return: a generator of ListingEntry of the files in the file share,
+        named by their path, in no particular order
+        """
+        location = 'FILE/' + fileshare
+
+        def list_directory(directory):
+            if directory is None:
+                remaining = prefix
+            else:
+                directory_prefix = directory.rstrip('/') + '/'
+                remaining = prefix[len(directory_prefix):] \
+                    if prefix.startswith(directory_prefix) else ''
+            name_prefix = remaining.split('/')[0]
+            if self.listing_cache is not None:
+                entries = self.listing_cache.get(
+                    self.storage_account_name, location, directory or '',
+                    name_prefix, max_age=self.max_listing_age)
+                if entries is not None:
+                    return directory, entries
+            entries = [_get_share_entry(f) for f in
+                       service.list_directories_and_files(
+                           share_name=fileshare, directory_name=directory,
+                           prefix=name_prefix or None)]
+            if self.listing_cache is not None:
+                self.listing_cache.put(self.storage_account_name, location,
+                                       directory or '', name_prefix, entries)
+            return directory, entries
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            pending = {executor.submit(list_directory, root_dir)}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    directory, entries = future.result()
+                    for f in entries:
+                        if directory is not None:
+                            file_path = posixpath.join(directory, f.name)
+                        else:
+                            file_path = f.name
+                        if not f.is_directory:
+                            yield f._replace(name=file_path)
+                        elif prefix.startswith(file_path + '/') or \
+                                (file_path + '/').startswith(prefix):
+                            pending.add(executor.submit(
+                                list_directory, file_path))
+
+
+class FileBatchParameter(FileParameter):
+
+    def __init__(self, parameter_name, storage_account_name,
+                 storage_account_key, storage_type, mount_path, mount_method,
+                 container=None, fileshare=None, directory=None,
+                 filter_str=None, num_batches=None, max_batch_size=None,
+                 manifest_directory=MANIFEST_DIRECTORY,
+                 num_threads=LISTING_THREADS, **kwargs):
+        """
+        For generating batches of the files listed by FileParameter, so that
+        each job processes several files. Files are grouped into batches of
+        similar total size: each file, from the largest to the smallest, is
+        added to the batch with the smallest total size.
+
+        The paths of the files of each batch are written, one per line, to a
+        manifest file uploaded to the Blob container or File share, and the
+        values of the parameter are the mounted paths of the manifests.
+        Manifests are named after a hash of their content, so the same
+        batches always get the same manifests.
+
+        The paths in a manifest are relative to the mounted container or
+        share (i.e. they are the blob names or share paths of the files), as
+        the mount root variables are only expanded in the command line of a
+        job, not in files. A job resolves them against the directory the
+        storage is mounted on, e.g. with the manifest passed as
+        $PARAM_FILES and the storage mounted on "data":
+        while read f; do process "$AZ_BATCHAI_JOB_MOUNT_ROOT/data/$f"; done
+        < $PARAM_FILES
+
+        See FileParameter.__init__ for the other parameters.
+
+        :param num_batches: number of batches
+        :param max_batch_size: maximum total size in bytes of the files of a
+        batch, unless the batch has a single file. If num_batches is also
+        given, more than num_batches batches are created if necessary.
+        :param manifest_directory: directory of the container or share to
+        which manifests are uploaded. Files in it are not batched.
+        """
+        if not num_batches and not max_batch_size:
+            raise ValueError("Num batches or max batch size must be given")
+        super().__init__(
+            parameter_name, storage_account_name, storage_account_key,
+            storage_type, mount_path, mount_method, container=container,
+            fileshare=fileshare, directory=directory, filter_str=filter_str,
+            num_threads=num_threads, **kwargs)
+        manifest_prefix = posixpath.join(
+            self.mount_directory, manifest_directory) + '/'
+        files = [(path, size or 0) for path, size in zip(self.values,
+                                                         self.sizes)
+                 if not path.startswith(manifest_prefix)]
+        if not files:
+            raise ValueError("No files to batch in file parameter sweep")
+        self.batches = _pack_files(files, num_batches, max_batch_size)
+        # Total sizes in bytes of the files of the batches
+        self.sizes = [sum(size for _, size in batch)
+                      for batch in self.batches]
+        # Mounted paths of the files of the batches
+        self.batches = [[path for path, _ in batch] for batch in self.batches]
+        mount_prefix = self.mount_directory + '/'
+        manifests = []
+        for batch in self.batches:
+            text = ''.join(path[len(mount_prefix):] + '\n'
+                           for path in batch)
+            name = '{0}_{1}.txt'.format(parameter_name, hashlib.sha1(
+                text.encode()).hexdigest()[:MANIFEST_HASH_LENGTH])
+            manifests.append((name, text))
+        if storage_type == 'BLOB':
+            service = BlockBlobService(storage_account_name,
+                                       storage_account_key)
+
+            def upload(name, text):
+                service.create_blob_from_text(
+                    container, posixpath.join(manifest_directory, name), text)
+        else:
+            service = FileService(storage_account_name, storage_account_key)
+            path = ''
+            for part in manifest_directory.strip('/').split('/'):
+                path = posixpath.join(path, part)
+                service.create_directory(fileshare, path)
+
+            def upload(name, text):
+                service.create_file_from_text(
+                    fileshare, manifest_directory, name, text)
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for future in [executor.submit(upload, name, text)
+                           for name, text in manifests]:
+                future.result()
+        self.values = [posixpath.join(manifest_prefix, name)
+                       for name, _ in manifests]
 
 
 class ParameterSweep(object):
@@ -263,6 +483,7 @@ class ParameterSweep(object):
         if not param_specs:
             raise ValueError("No params in ParameterSweep init")
         self.param_specs = param_specs
+        template_names = []
         for param_spec in param_specs:
             if isinstance(param_spec, DictParameter):
                 sub = Substitution(param_spec.parameter_name)
@@ -272,9 +493,13 @@ class ParameterSweep(object):
                     setattr(self, dict_parameter_name, Substitution(
                         dict_parameter_name))
                     sub.dictParams[key] = Substitution(dict_parameter_name)
+                    template_names.append(str(sub.dictParams[key]))
             else:
                 setattr(self, param_spec.parameter_name, Substitution(
                     param_spec.parameter_name))
+                template_names.append(Substitution.convert_name(
+                    param_spec.parameter_name))
+        self._template_regex = _compile_template_regex(template_names)
 
     @classmethod
     def from_json(cls, param_specs_json):
@@ -345,21 +570,179 @@ class ParameterSweep(object):
         """
         return self._generate_jobs(job_create_parameters)
 
-    def generate_jobs_random_search(self, job_create_parameters, num_jobs):
+    def grid(self, job_create_parameters=None):
+        """
+        Lazy view of the grid search. Unlike generate_jobs, no combination
+        is generated before it is accessed: the view supports len(),
+        iteration, access to the i-th combination in constant time, and
+        slicing, e.g. to let several processes each submit a disjoint shard
+        of the grid with view.shard(index, count).
+
+        :param job_create_parameters: an instance of JobCreateParameters. If
+        given, items of the view are JobCreateParameters with parameters
+        substituted, otherwise they are parameter combinations (dicts).
+        :return: a GridView
+        """
+        return GridView(self, job_create_parameters)
+
+    def generate_jobs_random_search(self, job_create_parameters, num_jobs,
+                                    seed=None, sampler='RANDOM'):
         """
         Generate jobs with random search. Jobs will be generated with each
         parameter value being randomly generated.
 
         :param job_create_parameters: an instance of JobCreateParameters
         :param num_jobs: the number of jobs to generate.
+        :param seed: seed of the random number generator. If None, the
+        global numpy.random state is used.
+        :param sampler: "RANDOM" for independent uniform samples, or "SOBOL"
+        or "HALTON" for a scrambled low-discrepancy sequence, which covers
+        the parameter space more evenly
         :return: a list of JobCreateParameters with parameters substituted
         through random search
         """
         if num_jobs <= 0:
             raise ValueError("Num jobs must be greater than 0")
-        return self._generate_jobs(job_create_parameters, num_jobs=num_jobs)
+        return self._generate_jobs(job_create_parameters, num_jobs=num_jobs,
+                                   seed=seed, sampler=sampler)
+
+    def iter_jobs(self, job_create_parameters, num_jobs=None, seed=None,
+                  sampler='RANDOM', with_parameters=False):
+        """
+        Lazily generate jobs. Unlike generate_jobs and
+        generate_jobs_random_search, JobCreateParameters are created one at a
+        time as the returned generator is consumed, so the generator can be
+        passed directly to ExperimentUtils.submit_jobs without holding the
+        whole sweep in memory. The parameters of each job are available in
+        its environment_variables.
+
+        :param job_create_parameters: an instance of JobCreateParameters
+        :param num_jobs: the number of jobs to generate with random search. If
+        None, grid search will be performed.
+        :param seed: see generate_jobs_random_search
+        :param sampler: see generate_jobs_random_search
+        :param with_parameters: if True, yield tuples of JobCreateParameters
+        and the parameter combination (dict) used to create it
+        :return: a generator of JobCreateParameters
+        """
+        if num_jobs is not None and num_jobs <= 0:
+            raise ValueError("Num jobs must be greater than 0")
+        for jcp, param_dict in self._iter_jobs(job_create_parameters,
+                                               num_jobs, seed=seed,
+                                               sampler=sampler):
+            yield (jcp, param_dict) if with_parameters else jcp
+
+    def generate_packed_jobs(self, job_create_parameters, trials_per_job,
+                             num_jobs=None, parallel=False, seed=None,
+                             sampler='RANDOM'):
+        """
+        Generate jobs which each run several parameter combinations (trials),
+        so that container start-up, volume mounting and framework imports are
+        paid once per job instead of once per combination.
+
+        Each trial runs the command of job_create_parameters with its own
+        parameters, exported as environment variables, and with every
+        $AZ_BATCHAI_OUTPUT_<ID> pointing to a trial_<i> subdirectory of the
+        job's output directory. Only the command line may depend on the
+        parameters; other properties are taken from the first trial. The
+        job's PARAM_TRIALS environment variable holds the JSON list of the
+        trials' parameters, which ExperimentUtils.get_metrics_for_jobs uses to
+        report one result per trial.
+
+        :param job_create_parameters: an instance of JobCreateParameters
+        using custom_toolkit_settings on a single node. Other toolkits set up
+        their own environment and process launch (e.g. MPI), which cannot be
+        reproduced in a packed command line.
+        :param trials_per_job: maximum number of trials to pack into one job
+        :param num_jobs: the number of trials to generate with random search.
+        If None, grid search will be performed.
+        :param parallel: if True, the trials of a job run concurrently,
+        otherwise one after another
+        :param seed: see generate_jobs_random_search
+        :param sampler: see generate_jobs_random_search
+        :return: a tuple of the list of packed JobCreateParameters and the
+        list of the parameter combinations of each job
+        """
+        if trials_per_job <= 0:
+            raise ValueError("Trials per job must be greater than 0")
+        if num_jobs is not None and num_jobs <= 0:
+            raise ValueError("Num jobs must be greater than 0")
+        _check_packable(job_create_parameters)
+        jcps = []
+        param_dict_groups = []
+        trials = self._iter_jobs(job_create_parameters, num_jobs, seed,
+                                 sampler)
+        while True:
+            group = list(itertools.islice(trials, trials_per_job))
+            if not group:
+                break
+            jcps.append(self._pack_jobs(group, parallel))
+            param_dict_groups.append([param_dict for _, param_dict in group])
+        return jcps, param_dict_groups
+
+    def _pack_jobs(self, trials, parallel):
+        """
+        Combine (JobCreateParameters, parameter combination) tuples into one
+        JobCreateParameters with a custom toolkit command line running every
+        trial.
+        """
+        output_ids = [d.id for d in
+                      trials[0][0].output_directories or []]
+        commands = ['status=0;']
+        for i, (jcp, _) in enumerate(trials):
+            _check_packable(jcp)
+            trial_directory = TRIAL_DIRECTORY_FORMAT.format(i)
+            exports = ['{0}={1}'.format(ev.name, six.moves.shlex_quote(
+                ev.value)) for ev in jcp.environment_variables]
+            exports.append('{0}={1}'.format(TRIAL_INDEX_ENV_VAR, i))
+            exports.extend('AZ_BATCHAI_OUTPUT_{0}="$AZ_BATCHAI_OUTPUT_{0}/'
+                           '{1}"'.format(output_id, trial_directory)
+                           for output_id in output_ids)
+            trial = '(export {0}; {1}{2})'.format(
+                ' '.join(exports),
+                ''.join('mkdir -p "$AZ_BATCHAI_OUTPUT_{0}"; '.format(
+                    output_id) for output_id in output_ids),
+                jcp.custom_toolkit_settings.command_line)
+            if parallel:
+                commands.append('{0} & pid_{1}=$!;'.format(trial, i))
+            else:
+                commands.append('{0} || status=1;'.format(trial))
+        if parallel:
+            commands.extend('wait $pid_{0} || status=1;'.format(i)
+                            for i in range(len(trials)))
+        commands.append('exit $status')
+        packed = copy.deepcopy(trials[0][0])
+        packed.custom_toolkit_settings = models.CustomToolkitSettings(
+            command_line=' '.join(commands))
+        packed.environment_variables = [
+            models.EnvironmentVariable(name=NUM_TRIALS_ENV_VAR,
+                                       value=str(len(trials))),
+            models.EnvironmentVariable(
+                name=TRIALS_ENV_VAR,
+                value=json.dumps([param_dict for _, param_dict in trials],
+                                 default=str))
+        ]
+        return packed
+
+    def generate_jobs_from_param_dicts(self, job_create_parameters,
+                                       param_dicts):
+        """
+        Generate jobs for given parameter combinations, e.g. proposed by
+        utilities.search.TPESearch.
+
+        :param job_create_parameters: an instance of JobCreateParameters
+        :param param_dicts: a list of dictionaries of parameter names (with
+        the PARAM_ prefix) to values, as returned by the generate methods
+        :return: a list of JobCreateParameters with parameters substituted
+        """
+        jcps = []
+        param_dicts = list(param_dicts)
+        for jcp, _ in self._create_jobs(job_create_parameters, param_dicts):
+            jcps.append(jcp)
+        return jcps, param_dicts
 
-    def _generate_jobs(self, job_create_parameters, num_jobs=None):
+    def _generate_jobs(self, job_create_parameters, num_jobs=None, seed=None,
+                       sampler='RANDOM'):
         """
         Creates copies of job_create_parameters with the template strings
         and Substitution objects substituted with combinations of parameters
@@ -368,86 +751,275 @@ class ParameterSweep(object):
         :param job_create_parameters: an instance of JobCreateParameters
         :param num_jobs: the number of jobs to generate with random search. If
         None, grid search will be performed.
+        :param seed: seed of the random search
+        :param sampler: sampling method of the random search
         """
         jcps = []
         param_dicts = []
-        for param_dict in self._generate_param_dicts(num_jobs):
-            jcp_substituted = self._substitute_params(
-                job_create_parameters, param_dict)
-            environment_variables = [models.EnvironmentVariable(
-                name=parameter_name,
-                value=str(value)
-            ) for parameter_name, value in param_dict.items()]
-            jcp_substituted.environment_variables = environment_variables
-            jcps.append(jcp_substituted)
+        for jcp, param_dict in self._iter_jobs(job_create_parameters,
+                                               num_jobs, seed, sampler):
+            jcps.append(jcp)
             param_dicts.append(param_dict)
         return jcps, param_dicts
 
-    def _generate_param_dicts(self, num=None):
+    def _iter_jobs(self, job_create_parameters, num_jobs=None, seed=None,
+                   sampler='RANDOM'):
+        """
+        Generator version of _generate_jobs, yielding tuples of
+        JobCreateParameters and the parameter combination used to create it.
+        """
+        return self._create_jobs(
+            job_create_parameters,
+            self._generate_param_dicts(num_jobs, seed, sampler))
+
+    def _create_jobs(self, job_create_parameters, param_dicts):
+        """
+        Generator of tuples of JobCreateParameters and the parameter
+        combination used to create it, for each combination in param_dicts.
+        """
+        plan = self.compile_substitution_plan(job_create_parameters)
+        for param_dict in param_dicts:
+            yield self.create_job(job_create_parameters, param_dict,
+                                  plan), param_dict
+
+    def compile_substitution_plan(self, job_create_parameters):
+        """
+        Find the properties of job_create_parameters to substitute, so that
+        jobs can be created from it with create_job without searching it
+        again for every parameter combination.
+
+        :param job_create_parameters: an instance of JobCreateParameters
+        :return: an opaque plan to pass to create_job
+        """
+        return self._compile_substitution_plan(job_create_parameters)
+
+    def create_job(self, job_create_parameters, param_dict, plan=None):
+        """
+        Create a job for one parameter combination.
+
+        :param job_create_parameters: an instance of JobCreateParameters
+        :param param_dict: a dictionary of parameter names (with the PARAM_
+        prefix) to values, as returned by the generate methods
+        :param plan: the result of compile_substitution_plan for
+        job_create_parameters. If None, it is compiled.
+        :return: a JobCreateParameters with parameters substituted
+        """
+        jcp_substituted = self._substitute_params(
+            job_create_parameters, param_dict, plan)
+        environment_variables = [models.EnvironmentVariable(
+            name=parameter_name,
+            value=str(value)
+        ) for parameter_name, value in param_dict.items()]
+        jcp_substituted.environment_variables = environment_variables
+        return jcp_substituted
+
+    def _generate_param_dicts(self, num=None, seed=None, sampler='RANDOM'):
         """
         Generates a dict with parameter combinations from the Cartesian
         product of possible parameter values specified by param_specs.
 
         :param num: the number of jobs to generate with random search. If None,
         grid search will be performed.
+        :param seed: seed of the random search
+        :param sampler: "RANDOM", "SOBOL" or "HALTON"
         """
-        num_params = len(self.param_specs)
-        param_names = [ps.parameter_name for ps in self.param_specs]
         param_values = [ps.values for ps in self.param_specs]
         if num:
-            param_combinations = [[p.get_random() for p in self.param_specs]
-                                  for _ in range(num)]
+            param_combinations = self._sample_param_combinations(
+                get_sampler(sampler, len(self.param_specs), seed), num)
         else:
             param_combinations = itertools.product(*param_values)
         for param_combination in param_combinations:
-            param_dict = {}
-            for i in range(num_params):
-                param = param_combination[i]
-                param_name = param_names[i]
-                if isinstance(param, dict):  # Handling DictParameter
-                    for key, value in param.items():
-                        dict_param_name = param_name + '__' + key
-                        param_dict[Substitution.convert_name(
-                            dict_param_name)] = value
-                else:
-                    param_dict[Substitution.convert_name(param_name)] = param
-            yield param_dict
-
-    def _substitute_params(self, job_create_parameters, param_dict):
+            yield self.to_param_dict(param_combination)
+
+    def _sample_param_combinations(self, sampler, num):
+        """
+        Generator of num parameter combinations, mapped from points in the
+        unit hypercube drawn in batches from sampler.
+        """
+        for start in range(0, num, SAMPLE_BATCH_SIZE):
+            points = sampler.sample(min(SAMPLE_BATCH_SIZE, num - start))
+            columns = [param_spec.from_unit(points[:, i])
+                       for i, param_spec in enumerate(self.param_specs)]
+            for param_combination in zip(*columns):
+                yield param_combination
+
+    def to_param_dict(self, param_combination):
+        """
+        Convert a sequence with one value per parameter in param_specs to a
+        dict of parameter names to values, as returned by the generate
+        methods.
+
+        :param param_combination: a sequence with one value per parameter,
+        in the order of param_specs
+        :return: a dict of parameter names (with the PARAM_ prefix) to values
+        """
+        param_dict = {}
+        for param_spec, param in zip(self.param_specs, param_combination):
+            param_name = param_spec.parameter_name
+            if isinstance(param, dict):  # Handling DictParameter
+                for key, value in param.items():
+                    dict_param_name = param_name + '__' + key
+                    param_dict[Substitution.convert_name(
+                        dict_param_name)] = value
+            else:
+                param_dict[Substitution.convert_name(param_name)] = param
+        return param_dict
+
+    def _substitute_params(self, job_create_parameters, param_dict,
+                           plan=None):
         """
         Creates a copy of job_create_parameters and substitutes properties in
-        it with the parameter combination in param_dict.
+        it with the parameter combination in param_dict. Only the objects on
+        the path to a substituted property are copied; other sub-objects are
+        shared with job_create_parameters.
+
+        :param plan: the result of compile_substitution_plan for
+        job_create_parameters. If None, it is compiled.
         """
-        jcp_copy = copy.deepcopy(job_create_parameters)
-        self._replace_properties_with_params(jcp_copy, param_dict)
-        return jcp_copy
+        if plan is None:
+            plan = self._compile_substitution_plan(job_create_parameters)
+        return self._apply_substitution_plan(job_create_parameters, plan,
+                                             param_dict)
 
-    def _replace_properties_with_params(self, obj, param_dict):
+    def _compile_substitution_plan(self, obj):
         """
-        Do a recursive search through the object's properties, substituting
-        Substitution objects and strings which are parameter templates
-        with a parameter combination specified by param_dict.
+        Do a recursive search through the object's properties, recording
+        which of them are Substitution objects or strings which are parameter
+        templates.
+
+        :return: a dict mapping the names of those properties to their
+        compiled _Template or _SUBSTITUTE_OBJECT, and the names of properties
+        holding such properties to their own plan
         """
         try:
-            for prop, val in vars(obj).items():
-                if isinstance(val, six.string_types):
-                    setattr(obj, prop, self._replace_str_with_params(
-                        val, param_dict))
-                elif isinstance(val, Substitution):
-                    setattr(obj, prop, param_dict[val.__str__()])
-                else:
-                    self._replace_properties_with_params(val, param_dict)
+            properties = vars(obj).items()
         except TypeError:
-            pass  # Item is not an object
+            return {}  # Item is not an object
+        plan = {}
+        for prop, val in properties:
+            if isinstance(val, six.string_types):
+                if Substitution.ENV_VAR_PREFIX in val:
+                    template = _Template(val, self._template_regex)
+                    if template.names:
+                        plan[prop] = template
+            elif isinstance(val, Substitution):
+                plan[prop] = _SUBSTITUTE_OBJECT
+            else:
+                sub_plan = self._compile_substitution_plan(val)
+                if sub_plan:
+                    plan[prop] = sub_plan
+        return plan
+
+    def _apply_substitution_plan(self, obj, plan, param_dict):
+        """
+        Returns a shallow copy of obj with the properties in plan
+        substituted with the parameter combination in param_dict.
+        """
+        obj_copy = copy.copy(obj)
+        for prop, sub_plan in plan.items():
+            val = getattr(obj, prop)
+            if isinstance(sub_plan, _Template):
+                val = sub_plan.render(param_dict)
+            elif sub_plan == _SUBSTITUTE_OBJECT:
+                val = param_dict[val.__str__()]
+            else:
+                val = self._apply_substitution_plan(val, sub_plan, param_dict)
+            setattr(obj_copy, prop, val)
+        return obj_copy
+
+
+class GridView(object):
+    """
+    Lazy, indexable view of (a slice of) the Cartesian product of the
+    parameter values of a ParameterSweep, in the order of generate_jobs.
+    The i-th combination is computed from i with mixed-radix arithmetic, the
+    last parameter varying fastest.
+    """
 
-    def _replace_str_with_params(self, string, param_dict):
+    def __init__(self, parameter_sweep, job_create_parameters=None, start=0,
+                 stop=None, step=1, plan=None):
         """
-        Find any parameter template strings in string and replace them with
-        them with the corresponding parameter values from param_dict.
+        :param parameter_sweep: a ParameterSweep
+        :param job_create_parameters: an instance of JobCreateParameters. If
+        None, items are parameter combinations.
+        :param start, stop, step: the combinations of the full grid in the
+        view, as in range()
+        :param plan: the result of parameter_sweep.compile_substitution_plan
+        for job_create_parameters. If None, it is compiled.
         """
-        for parameter_name, value in param_dict.items():
-            string = string.replace(parameter_name, str(value))
-        return string
+        self.parameter_sweep = parameter_sweep
+        self.job_create_parameters = job_create_parameters
+        if plan is None and job_create_parameters is not None:
+            plan = parameter_sweep.compile_substitution_plan(
+                job_create_parameters)
+        self._plan = plan
+        self._sizes = [len(ps.values) for ps in parameter_sweep.param_specs]
+        grid_size = 1
+        for size in self._sizes:
+            grid_size *= size
+        if stop is None:
+            stop = grid_size
+        self._start, self._stop, self._step = start, stop, step
+
+    def __len__(self):
+        if self._stop <= self._start:
+            return 0
+        return (self._stop - self._start + self._step - 1) // self._step
+
+    def __iter__(self):
+        for i in six.moves.range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        """
+        :param key: an integer, or a slice with a positive step
+        :return: the item at index key, or a GridView for a slice
+        """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step <= 0:
+                raise ValueError("Slice step must be positive")
+            return GridView(self.parameter_sweep, self.job_create_parameters,
+                            start=self._start + start * self._step,
+                            stop=self._start + max(start, stop) * self._step,
+                            step=self._step * step, plan=self._plan)
+        param_dict = self.get_param_dict(key)
+        if self.job_create_parameters is None:
+            return param_dict
+        return self.parameter_sweep.create_job(
+            self.job_create_parameters, param_dict, self._plan)
+
+    def get_param_dict(self, i):
+        """
+        :return: the parameter combination at index i of the view
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Grid index out of range")
+        index = self._start + i * self._step
+        param_combination = []
+        for param_spec, size in zip(
+                reversed(self.parameter_sweep.param_specs),
+                reversed(self._sizes)):
+            index, digit = divmod(index, size)
+            param_combination.append(param_spec.values[digit])
+        param_combination.reverse()
+        return self.parameter_sweep.to_param_dict(param_combination)
+
+    def shard(self, index, count):
+        """
+        Split the view into count contiguous parts of (almost) equal size.
+
+        :param index: index of the part to return, from 0 to count - 1
+        :param count: number of parts
+        :return: a GridView
+        """
+        if not 0 <= index < count:
+            raise ValueError("Shard index must be between 0 and count - 1")
+        return self[len(self) * index // count:
+                    len(self) * (index + 1) // count]
 
 
 class Substitution(object):
@@ -468,3 +1040,135 @@ class Substitution(object):
 
     def __str__(self):
         return Substitution.convert_name(self.parameter_name)
+
+
+def _get_share_entry(f):
+    """
+    Returns the ListingEntry of a File or Directory listed from a File share.
+    """
+    last_modified = to_timestamp(f.properties.last_modified)
+    if isinstance(f, azure.storage.file.models.File):
+        return ListingEntry(f.name, False, f.properties.content_length,
+                            last_modified)
+    return ListingEntry(f.name, True, None, last_modified)
+
+
+def _pack_files(files, num_batches=None, max_batch_size=None):
+    """
+    Group files into batches of similar total size, with the longest
+    processing time first heuristic.
+
+    :param files: list of (path, size) tuples
+    :param num_batches: number of batches
+    :param max_batch_size: maximum total size of a batch with several files.
+    The number of batches is increased until all batches respect it.
+    :return: list of batches, each a list of (path, size) tuples sorted by
+    path, sorted by their first path
+    """
+    files = sorted(files, key=lambda f: (-f[1], f[0]))
+    total_size = sum(size for _, size in files)
+    num_batches = max(num_batches or 1, int(math.ceil(
+        total_size / float(max_batch_size))) if max_batch_size else 1)
+    while True:
+        num_batches = min(num_batches, len(files))
+        batches = [[] for _ in range(num_batches)]
+        heap = [(0, i) for i in range(num_batches)]
+        for f in files:
+            batch_size, i = heapq.heappop(heap)
+            batches[i].append(f)
+            heapq.heappush(heap, (batch_size + f[1], i))
+        if not max_batch_size or num_batches == len(files) or all(
+                batch_size <= max_batch_size or len(batches[i]) == 1
+                for batch_size, i in heap):
+            break
+        num_batches += 1
+    return sorted(sorted(batch) for batch in batches)
+
+
+def _get_literal_prefix(regex):
+    """
+    Returns the literal text which every string matched by regex with
+    re.match starts with, or '' if it cannot be determined.
+    """
+    if '|' in regex:
+        return ''
+    prefix = []
+    i = 1 if regex.startswith('^') else 0
+    while i < len(regex):
+        char = regex[i]
+        if char == '\\':
+            if i + 1 == len(regex) or regex[i + 1].isalnum():
+                break  # A character class such as \d, or a back reference
+            char = regex[i + 1]
+            i += 2
+        elif char in '.^$*+?{}[]()':
+            break
+        else:
+            i += 1
+        if i < len(regex) and regex[i] in '*?{':
+            break  # The character is optional or repeated
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class _Template(object):
+    """
+    A string compiled into literal segments and parameter placeholders.
+    Placeholders are found in a single left-to-right pass, taking the longest
+    parameter name at each position, so that e.g. PARAM_LR does not match
+    the start of PARAM_LR_DECAY, and values are never substituted again.
+    """
+
+    def __init__(self, string, regex):
+        """
+        :param string: the template string
+        :param regex: the result of _compile_template_regex
+        """
+        # Literals at even indices, parameter names at odd indices
+        self.segments = regex.split(string)
+        self.names = self.segments[1::2]
+
+    def render(self, param_dict):
+        """
+        :return: the template string with each placeholder replaced by the
+        value of the parameter in param_dict
+        """
+        segments = list(self.segments)
+        segments[1::2] = [str(param_dict[name]) for name in self.names]
+        return ''.join(segments)
+
+
+def _compile_template_regex(names):
+    """
+    Returns a regex matching the given parameter names, trying longer names
+    first, with the name as its only group.
+    """
+    names = sorted(names, key=len, reverse=True)
+    return re.compile('({0})'.format('|'.join(re.escape(n) for n in names)))
+
+
+def get_packed_trials(job):
+    """
+    Returns the list of parameter combinations of the trials packed into a
+    job by ParameterSweep.generate_packed_jobs, or None if the job is not a
+    packed job.
+
+    :param job: an azure.mgmt.batchai.models.Job or JobCreateParameters
+    """
+    for ev in job.environment_variables or []:
+        if ev.name == TRIALS_ENV_VAR:
+            return json.loads(ev.value)
+    return None
+
+
+def _check_packable(jcp):
+    """
+    Raises ValueError if the trials of jcp cannot be packed into one job:
+    only single-node jobs using custom_toolkit_settings run the same command
+    line when packed.
+    """
+    if jcp.custom_toolkit_settings is None:
+        raise ValueError(
+            "Only jobs using custom toolkit settings can be packed")
+    if (jcp.node_count or 1) > 1:
+        raise ValueError("Only single-node jobs can be packed")
@@ -0,0 +1,458 @@
+from __future__ import print_function
+
+import collections
+import concurrent.futures
+import datetime
+import threading
+import time
+
+import azure.mgmt.batchai.models as models
+
+from utilities.throttling import get_default_throttle
+
+MIN_POLL_INTERVAL_SECS = 2
+MAX_STALENESS_SECS = 10
+OPERATION_POLL_INTERVAL_SECS = 2
+OPERATION_TIMEOUT_SECS = 30 * 60
+MAX_POLL_INTERVAL_SECS = 30
+POLL_BACKOFF = 1.5
+EXPECTED_COMPLETION_RATIO = 0.8
+MAX_EXPECTED_COMPLETION_RATIO = 1.5
+COMPLETED_STATES = (models.ExecutionState.succeeded,
+                    models.ExecutionState.failed)
+
+JobStateChange = collections.namedtuple('JobStateChange', [
+    'job_name',
+    'old_state',  # None if the job was not seen before
+    'new_state',  # None if the job was deleted
+    'job'
+])
+
+
+class JobWatcher(object):
+    """
+    Tracks the execution state of the jobs in an experiment by diffing
+    consecutive listings of the experiment, and reports per-job state
+    transitions.
+
+    State counts are updated incrementally from the transitions. The poll
+    interval shrinks to min_interval while jobs change state or are expected
+    to complete soon (based on the run time of jobs which already completed),
+    and grows up to max_interval while nothing happens. A job running for
+    much longer than the median run time no longer counts as about to
+    complete, so that a straggler does not keep the interval short.
+    """
+
+    def __init__(self, list_jobs, job_names=None,
+                 min_interval=MIN_POLL_INTERVAL_SECS,
+                 max_interval=MAX_POLL_INTERVAL_SECS):
+        """
+        :param list_jobs: a function returning the list of
+        azure.mgmt.batchai.models.Job in the experiment, e.g.
+        ExperimentUtils._list_jobs
+        :param job_names: names of jobs to watch. If None, all jobs in the
+        experiment are watched.
+        :param min_interval: minimum number of seconds between polls
+        :param max_interval: maximum number of seconds between polls
+        """
+        self._list_jobs = list_jobs
+        self.job_names = set(job_names) if job_names else None
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.jobs = {}
+        self._states = {}
+        self.state_counts = collections.Counter()
+        self._running_since = {}
+        self._durations = []
+
+    @property
+    def num_completed(self):
+        """Number of watched jobs which succeeded or failed."""
+        return sum(self.state_counts[s] for s in COMPLETED_STATES)
+
+    def all_completed(self):
+        """Whether all watched jobs succeeded or failed."""
+        return self.num_completed == len(self.jobs)
+
+    def poll(self):
+        """
+        List the experiment once and update the state of the watched jobs.
+
+        :return: list of JobStateChange, one per job whose execution state
+        changed since the last poll
+        """
+        changes = []
+        seen = set()
+        for job in self._list_jobs():
+            if self.job_names is not None and job.name not in self.job_names:
+                continue
+            seen.add(job.name)
+            is_new = job.name not in self._states
+            old_state = self._states.get(job.name)
+            self.jobs[job.name] = job
+            if is_new or old_state != job.execution_state:
+                self._states[job.name] = job.execution_state
+                changes.append(self._apply(JobStateChange(
+                    job.name, old_state, job.execution_state, job)))
+        if len(seen) != len(self.jobs):
+            for job_name in set(self.jobs) - seen:
+                job = self.jobs.pop(job_name)
+                changes.append(self._apply(JobStateChange(
+                    job_name, self._states.pop(job_name), None, job)))
+        self._adjust_interval(changes)
+        return changes
+
+    def events(self, timeout=None):
+        """
+        Poll the experiment until all watched jobs are completed, yielding
+        each state transition as it is observed.
+
+        :param timeout: number of seconds after which to stop watching
+        :return: a generator of JobStateChange
+        """
+        start = time.time()
+        for change in self.poll():
+            yield change
+        while not self.all_completed():
+            delay = self.interval
+            if timeout:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    return
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            for change in self.poll():
+                yield change
+
+    def _apply(self, change):
+        if change.old_state is not None:
+            self.state_counts[change.old_state] -= 1
+        if change.new_state is not None:
+            self.state_counts[change.new_state] += 1
+        # Run times reported by the service are preferred, so that jobs
+        # which completed before the first poll also count.
+        duration = _get_run_duration(change.job)
+        if change.new_state == models.ExecutionState.running:
+            self._running_since[change.job_name] = time.time() - (
+                duration or 0)
+        else:
+            started = self._running_since.pop(change.job_name, None)
+            if change.new_state in COMPLETED_STATES:
+                if duration is None and started is not None:
+                    duration = time.time() - started
+                if duration is not None:
+                    self._durations.append(duration)
+        return change
+
+    def _adjust_interval(self, changes):
+        if changes or self._completion_expected():
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval,
+                                self.interval * POLL_BACKOFF)
+
+    def _completion_expected(self):
+        """
+        Whether a running job has been running for about as long as the
+        median run time of the jobs completed so far, i.e. between
+        EXPECTED_COMPLETION_RATIO and MAX_EXPECTED_COMPLETION_RATIO times the
+        median.
+        """
+        if not self._durations or not self._running_since:
+            return False
+        durations = sorted(self._durations)
+        median = durations[len(durations) // 2]
+        now = time.time()
+        return any(EXPECTED_COMPLETION_RATIO * median <= now - started <=
+                   MAX_EXPECTED_COMPLETION_RATIO * median
+                   for started in self._running_since.values())
+
+
+def _get_run_duration(job):
+    """
+    Returns the number of seconds the job has been running (or ran for, if
+    it is completed), or None if the job has not started.
+    """
+    info = job.execution_info
+    if info is None or info.start_time is None:
+        return None
+    end_time = info.end_time or datetime.datetime.now(info.start_time.tzinfo)
+    return (end_time - info.start_time).total_seconds()
+
+
+class JobStateCache(object):
+    """
+    In-process cache of the jobs in an experiment, keyed by job name.
+
+    The cache is refreshed with a full listing of the experiment when its
+    content is older than the requested staleness bound. Jobs created or
+    deleted through this process are recorded immediately, and are not
+    overwritten by a listing which started before the change was made.
+    """
+
+    def __init__(self, list_jobs, max_staleness=MAX_STALENESS_SECS):
+        """
+        :param list_jobs: a function returning the list of
+        azure.mgmt.batchai.models.Job in the experiment, e.g.
+        ExperimentUtils._list_jobs
+        :param max_staleness: default maximum age in seconds of the cached
+        jobs returned by get_jobs
+        """
+        self._list_jobs = list_jobs
+        self.max_staleness = max_staleness
+        self._jobs = {}
+        self._local_changes = {}  # job name -> (time, job or None)
+        self._refreshed_at = None
+        self._lock = threading.RLock()
+
+    def is_stale(self, max_staleness=None):
+        """
+        Whether the cache was refreshed more than max_staleness seconds ago
+        (or never).
+        """
+        if max_staleness is None:
+            max_staleness = self.max_staleness
+        refreshed_at = self._refreshed_at
+        return (refreshed_at is None or
+                time.time() - refreshed_at > max_staleness)
+
+    def get_jobs(self, max_staleness=None):
+        """
+        Get the jobs in the experiment, refreshing the cache first if it is
+        stale.
+
+        :param max_staleness: maximum age in seconds of the returned jobs. If
+        None, the max_staleness of the cache is used.
+        :return: list of azure.mgmt.batchai.models.Job
+        """
+        if self.is_stale(max_staleness):
+            return self.refresh()
+        with self._lock:
+            return list(self._jobs.values())
+
+    def get(self, job_name, max_staleness=None):
+        """
+        Get a job by name, refreshing the cache first if it is stale.
+
+        :return: an azure.mgmt.batchai.models.Job, or None if there is no job
+        with that name
+        """
+        if self.is_stale(max_staleness):
+            self.refresh()
+        with self._lock:
+            return self._jobs.get(job_name)
+
+    def refresh(self):
+        """
+        List the experiment and replace the content of the cache.
+
+        :return: list of azure.mgmt.batchai.models.Job
+        """
+        started = time.time()
+        listed_jobs = self._list_jobs()
+        with self._lock:
+            if self._refreshed_at is not None and \
+                    started < self._refreshed_at:
+                # A listing which started later completed first
+                return list(self._jobs.values())
+            jobs = {job.name: job for job in listed_jobs}
+            for job_name, (changed_at, job) in list(
+                    self._local_changes.items()):
+                if changed_at < started:
+                    # The listing already reflects this change
+                    del self._local_changes[job_name]
+                elif job is None:
+                    jobs.pop(job_name, None)
+                else:
+                    jobs.setdefault(job_name, job)
+            self._jobs = jobs
+            self._refreshed_at = started
+            return list(jobs.values())
+
+    def put(self, job):
+        """Record a job created or updated by this process."""
+        with self._lock:
+            self._jobs[job.name] = job
+            self._local_changes[job.name] = (time.time(), job)
+
+    def remove(self, job_name):
+        """Record a job deleted by this process."""
+        with self._lock:
+            self._jobs.pop(job_name, None)
+            self._local_changes[job_name] = (time.time(), None)
+
+    def invalidate(self):
+        """Force the next get_jobs call to list the experiment."""
+        self._refreshed_at = None
+
+
+class BatchOperationPoller(object):
+    """
+    Tracks outstanding job create and delete operations and resolves all of
+    them from a single listing of the experiment per poll, instead of
+    polling every long-running operation separately.
+
+    A background thread polls while operations are outstanding and exits
+    when there are none left. A listing which fails with a retryable error
+    is retried with backoff; meanwhile, only the operations which exceed
+    their timeout fail.
+    """
+
+    _CREATE = 'create'
+    _DELETE = 'delete'
+
+    def __init__(self, job_cache, interval=OPERATION_POLL_INTERVAL_SECS,
+                 timeout=OPERATION_TIMEOUT_SECS, throttle=None):
+        """
+        :param job_cache: the JobStateCache of the experiment, used to list
+        the jobs
+        :param interval: number of seconds between polls
+        :param timeout: number of seconds after which an operation which has
+        not completed fails with concurrent.futures.TimeoutError
+        :param throttle: the utilities.throttling.RequestThrottle whose retry
+        policy decides how failed listings are retried. If None, the
+        throttle shared by all utilities in this process is used.
+        """
+        self.job_cache = job_cache
+        self.interval = interval
+        self.timeout = timeout
+        self.throttle = throttle or get_default_throttle()
+        self._pending = {}  # job name -> (operation, future, start time)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def num_pending(self):
+        """Number of operations which have not completed yet."""
+        return len(self._pending)
+
+    def track_create(self, job_name):
+        """
+        Track the creation of a job whose create request was accepted.
+
+        :return: a concurrent.futures.Future resolved with the created
+        azure.mgmt.batchai.models.Job
+        """
+        return self._track(job_name, self._CREATE)
+
+    def track_delete(self, job_name):
+        """
+        Track the deletion of a job whose delete request was accepted.
+
+        :return: a concurrent.futures.Future resolved with None once the job
+        no longer exists
+        """
+        return self._track(job_name, self._DELETE)
+
+    def _track(self, job_name, operation):
+        with self._lock:
+            previous = self._pending.get(job_name)
+            if previous is not None and previous[0] == operation:
+                # The same operation is already tracked, e.g. when a create
+                # request is retried after a timeout.
+                return previous[1]
+            future = concurrent.futures.Future()
+            self._pending[job_name] = (operation, future, time.time())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        if previous is not None:
+            # The service accepted an operation on the job which supersedes
+            # the previous one: a create implies that the job was deleted,
+            # while a delete means that a created job will not be returned.
+            if previous[0] == self._DELETE:
+                previous[1].set_result(None)
+            else:
+                previous[1].set_exception(RuntimeError(
+                    'Job "{0}" was deleted before its creation was '
+                    'observed.'.format(job_name)))
+        return future
+
+    def _run(self):
+        failures = 0
+        delay = self.interval
+        while True:
+            time.sleep(delay)
+            try:
+                self.poll()
+            except Exception as e:
+                if not self.throttle.retry_policy.is_retryable(e):
+                    # Polling again cannot succeed; fail every outstanding
+                    # operation rather than leaving callers blocked.
+                    self._fail(e)
+                else:
+                    self._fail(e, expired_only=True)
+                    delay = max(self.interval,
+                                self.throttle.backoff(e, failures))
+                    failures += 1
+            else:
+                failures = 0
+                delay = self.interval
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+
+    def _fail(self, error, expired_only=False):
+        """
+        Fail the outstanding operations, or only those which exceeded the
+        timeout, with error.
+        """
+        now = time.time()
+        failed = []
+        with self._lock:
+            for job_name, (_, future, started) in list(
+                    self._pending.items()):
+                if not expired_only or now - started > self.timeout:
+                    del self._pending[job_name]
+                    failed.append(future)
+        for future in failed:
+            future.set_exception(error)
+
+    def poll(self):
+        """
+        List the experiment once and resolve the operations which completed.
+        """
+        jobs = {job.name: job for job in self.job_cache.get_jobs(
+            max_staleness=self.interval / 2.0)}
+        now = time.time()
+        resolved = []
+        with self._lock:
+            for job_name, (operation, future, started) in list(
+                    self._pending.items()):
+                job = jobs.get(job_name)
+                if operation == self._CREATE:
+                    state = job.provisioning_state if job else None
+                    if state == models.ProvisioningState.succeeded:
+                        resolved.append((future, job, None))
+                    elif state == models.ProvisioningState.failed:
+                        resolved.append((future, None, RuntimeError(
+                            'Job "{0}" failed to be created.'.format(
+                                job_name))))
+                    elif now - started > self.timeout:
+                        resolved.append((future, None, _timeout_error(
+                            job_name, operation)))
+                    else:
+                        continue
+                elif job is None:
+                    self.job_cache.remove(job_name)
+                    resolved.append((future, None, None))
+                elif now - started > self.timeout:
+                    resolved.append((future, None, _timeout_error(
+                        job_name, operation)))
+                else:
+                    continue
+                del self._pending[job_name]
+        for future, result, error in resolved:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+def _timeout_error(job_name, operation):
+    return concurrent.futures.TimeoutError(
+        'Timed out waiting for job "{0}" {1} operation to complete.'.format(
+            job_name, operation))
@@ -0,0 +1,93 @@
+from __future__ import print_function
+
+import sqlite3
+import threading
+import time
+
+INTENT = 'intent'
+SUBMITTED = 'submitted'
+CONFIRMED = 'confirmed'
+
+
+class SubmissionJournal(object):
+    """
+    On-disk record of job submissions, so that an interrupted
+    ExperimentUtils.submit_jobs call can be resumed without listing the
+    experiment or creating jobs which already exist.
+
+    For every job name (job_name_prefix + '_' + hash of the
+    JobCreateParameters), the journal records one of three states:
+    - intent: the create request for the job is about to be sent
+    - submitted: the create request was accepted by the service
+    - confirmed: the service reported that the job was created
+    """
+
+    def __init__(self, path):
+        """
+        Open the journal stored in the SQLite database at path, creating it
+        if it does not exist.
+
+        :param path: path of the journal file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'job_name TEXT PRIMARY KEY, state TEXT NOT NULL, '
+                'updated REAL NOT NULL)')
+
+    def get_state(self, job_name):
+        """
+        :return: the state of the job, or None if it is not in the journal
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT state FROM jobs WHERE job_name = ?',
+                (job_name,)).fetchone()
+        return row[0] if row else None
+
+    def get_job_names(self, state=None):
+        """
+        :param state: if given, only return jobs in this state
+        :return: list of names of the jobs in the journal
+        """
+        with self._lock:
+            if state is None:
+                rows = self._connection.execute('SELECT job_name FROM jobs')
+            else:
+                rows = self._connection.execute(
+                    'SELECT job_name FROM jobs WHERE state = ?', (state,))
+            return [row[0] for row in rows]
+
+    def record_intent(self, job_name):
+        """Record that the job is about to be submitted."""
+        self._set_state(job_name, INTENT)
+
+    def record_submitted(self, job_name):
+        """Record that the create request for the job was accepted."""
+        self._set_state(job_name, SUBMITTED)
+
+    def record_confirmed(self, job_name):
+        """Record that the job was created."""
+        self._set_state(job_name, CONFIRMED)
+
+    def remove(self, job_name):
+        """Remove the job from the journal, e.g. after deleting the job."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM jobs WHERE job_name = ?', (job_name,))
+
+    def close(self):
+        """Close the journal file."""
+        with self._lock:
+            self._connection.close()
+
+    def _set_state(self, job_name, state):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO jobs (job_name, state, updated) '
+                'VALUES (?, ?, ?)', (job_name, state, time.time()))
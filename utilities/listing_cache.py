@@ -0,0 +1,164 @@
+from __future__ import print_function
+
+import calendar
+import collections
+import sqlite3
+import threading
+import time
+
+MAX_AGE_SECS = 60 * 60
+
+ListingEntry = collections.namedtuple('ListingEntry', [
+    'name',
+    'is_directory',
+    'size',  # in bytes, None for directories or if unknown
+    'last_modified'  # seconds since the epoch, None if unknown
+])
+
+
+class ListingCache(object):
+    """
+    On-disk cache of Azure Blob container and File share listings, so that
+    file parameters over the same storage can be re-created without listing
+    it again.
+
+    A listing is identified by storage account, location (container or
+    share), directory and name prefix, and is reused while it is younger
+    than the requested maximum age. A listing with a shorter prefix of the
+    same directory also answers requests for longer prefixes. The
+    directories of a File share are cached separately, so that refreshing a
+    share only lists again the directories whose listing expired.
+
+    Container and directory ETags do not change when blobs or files are
+    added or removed, so listings cannot be validated with the storage
+    service; invalidate the cache after changing the listed storage.
+    """
+
+    def __init__(self, path):
+        """
+        Open the cache stored in the SQLite database at path, creating it if
+        it does not exist.
+
+        :param path: path of the cache file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS listings ('
+                'id INTEGER PRIMARY KEY, account TEXT NOT NULL, '
+                'location TEXT NOT NULL, directory TEXT NOT NULL, '
+                'prefix TEXT NOT NULL, listed REAL NOT NULL, '
+                'UNIQUE (account, location, directory, prefix))')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'listing_id INTEGER NOT NULL, name TEXT NOT NULL, '
+                'is_directory INTEGER NOT NULL, size INTEGER, '
+                'last_modified REAL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS entries_listing_id '
+                'ON entries (listing_id)')
+
+    def get(self, account, location, directory='', prefix='',
+            max_age=MAX_AGE_SECS):
+        """
+        :param account: name of the storage account
+        :param location: the container or share, e.g. "BLOB/<container>"
+        :param directory: the listed directory, '' for the root of a share
+        or for a container
+        :param prefix: prefix of the names of the listed entries
+        :param max_age: maximum age in seconds of the listing. If None,
+        listings never expire.
+        :return: the list of ListingEntry of the directory with names
+        starting with prefix, or None if no fresh listing is cached
+        """
+        min_listed = 0 if max_age is None else time.time() - max_age
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT id FROM listings WHERE account = ? AND location = ? '
+                'AND directory = ? AND listed >= ? '
+                'AND substr(?, 1, length(prefix)) = prefix '
+                'ORDER BY length(prefix) DESC LIMIT 1',
+                (account, location, directory, min_listed,
+                 prefix)).fetchone()
+            if row is None:
+                return None
+            rows = self._connection.execute(
+                'SELECT name, is_directory, size, last_modified FROM entries '
+                'WHERE listing_id = ? AND substr(name, 1, length(?)) = ?',
+                (row[0], prefix, prefix)).fetchall()
+        return [ListingEntry(name, bool(is_directory), size, last_modified)
+                for name, is_directory, size, last_modified in rows]
+
+    def put(self, account, location, directory, prefix, entries):
+        """
+        Record a listing, replacing the listings of the same directory which
+        it covers.
+
+        :param entries: list of ListingEntry, all of which have names
+        starting with prefix
+        """
+        with self._lock, self._connection:
+            covered = (account, location, directory, prefix, prefix)
+            self._connection.execute(
+                'DELETE FROM entries WHERE listing_id IN (SELECT id FROM '
+                'listings WHERE account = ? AND location = ? AND '
+                'directory = ? AND substr(prefix, 1, length(?)) = ?)',
+                covered)
+            self._connection.execute(
+                'DELETE FROM listings WHERE account = ? AND location = ? AND '
+                'directory = ? AND substr(prefix, 1, length(?)) = ?',
+                covered)
+            listing_id = self._connection.execute(
+                'INSERT INTO listings (account, location, directory, prefix, '
+                'listed) VALUES (?, ?, ?, ?, ?)',
+                (account, location, directory, prefix,
+                 time.time())).lastrowid
+            self._connection.executemany(
+                'INSERT INTO entries (listing_id, name, is_directory, size, '
+                'last_modified) VALUES (?, ?, ?, ?, ?)',
+                [(listing_id, e.name, int(e.is_directory), e.size,
+                  e.last_modified) for e in entries])
+
+    def invalidate(self, account=None, location=None):
+        """
+        Remove cached listings.
+
+        :param account: if given, only remove listings of this storage
+        account
+        :param location: if given, only remove listings of this container or
+        share
+        """
+        condition, args = '1', ()
+        if account is not None:
+            condition, args = condition + ' AND account = ?', args + (account,)
+        if location is not None:
+            condition, args = condition + ' AND location = ?', args + (
+                location,)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM entries WHERE listing_id IN (SELECT id FROM '
+                'listings WHERE {0})'.format(condition), args)
+            self._connection.execute(
+                'DELETE FROM listings WHERE {0}'.format(condition), args)
+
+    def close(self):
+        """Close the cache file."""
+        with self._lock:
+            self._connection.close()
+
+
+def to_timestamp(last_modified):
+    """
+    Convert a last modified time returned by the storage SDK to seconds
+    since the epoch.
+
+    :param last_modified: a datetime.datetime in UTC, or None
+    """
+    if last_modified is None:
+        return None
+    return calendar.timegm(last_modified.utctimetuple()) + \
+        last_modified.microsecond / 1e6
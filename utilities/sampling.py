@@ -0,0 +1,195 @@
+from __future__ import print_function
+
+import numpy as np
+
+NUM_BITS = 32
+# Direction numbers for dimensions 2 to 21 of the Sobol sequence (Joe and
+# Kuo, "new-joe-kuo-6.21201"): degree s of the primitive polynomial, its
+# coefficients a, and initial direction numbers m.
+SOBOL_DIRECTIONS = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+    (6, 19, [1, 1, 1, 15, 7, 5]),
+    (6, 22, [1, 3, 1, 15, 13, 25]),
+    (6, 25, [1, 1, 5, 5, 19, 61]),
+    (7, 1, [1, 3, 7, 11, 23, 15, 103]),
+    (7, 4, [1, 3, 7, 13, 13, 15, 69]),
+]
+MAX_SOBOL_DIMS = len(SOBOL_DIRECTIONS) + 1
+
+
+class RandomSampler(object):
+    """
+    Draws batches of points uniformly at random from the unit hypercube.
+    """
+
+    def __init__(self, num_dims, seed=None):
+        """
+        :param num_dims: number of dimensions of the points
+        :param seed: seed of the random number generator. If None, the
+        global numpy.random state is used.
+        """
+        self.num_dims = num_dims
+        if seed is None:
+            self.random_state = np.random
+        else:
+            self.random_state = np.random.RandomState(seed)
+
+    def sample(self, num):
+        """
+        Draw the next points.
+
+        :param num: number of points to draw
+        :return: a numpy array of shape (num, num_dims) with values in [0, 1)
+        """
+        return self.random_state.uniform(size=(num, self.num_dims))
+
+
+class SobolSampler(RandomSampler):
+    """
+    Draws consecutive points of a Sobol sequence, scrambled with a random
+    digital shift. The first 2**k points of the sequence are evenly spread
+    over the unit hypercube. Supports up to MAX_SOBOL_DIMS dimensions.
+    """
+
+    def __init__(self, num_dims, seed=None, scramble=True):
+        """
+        :param num_dims: number of dimensions of the points
+        :param seed: seed of the random number generator used to scramble
+        :param scramble: whether to scramble the sequence. The first point
+        of an unscrambled sequence is 0.
+        """
+        if num_dims > MAX_SOBOL_DIMS:
+            raise ValueError(
+                "Sobol sampling supports at most {0} parameters, use "
+                "HALTON instead".format(MAX_SOBOL_DIMS))
+        super(SobolSampler, self).__init__(num_dims, seed)
+        self._directions = np.array(
+            [_get_sobol_directions(dim) for dim in range(num_dims)],
+            dtype=np.uint64)
+        if scramble:
+            self._shift = self.random_state.randint(
+                0, 2 ** NUM_BITS, size=num_dims).astype(np.uint64)
+        else:
+            self._shift = np.zeros(num_dims, dtype=np.uint64)
+        self._index = 0
+
+    def sample(self, num):
+        indices = np.arange(self._index, self._index + num, dtype=np.uint64)
+        self._index += num
+        gray = indices ^ (indices >> np.uint64(1))
+        points = np.zeros((num, self.num_dims), dtype=np.uint64)
+        for bit in range(NUM_BITS):
+            mask = ((gray >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+            points[mask] ^= self._directions[:, bit]
+        points ^= self._shift
+        return points.astype(float) / 2 ** NUM_BITS
+
+
+class HaltonSampler(RandomSampler):
+    """
+    Draws consecutive points of a Halton sequence (one prime base per
+    dimension), scrambled with a random permutation of the digits of each
+    base.
+    """
+
+    def __init__(self, num_dims, seed=None, scramble=True):
+        """
+        :param num_dims: number of dimensions of the points
+        :param seed: seed of the random number generator used to scramble
+        :param scramble: whether to scramble the sequence
+        """
+        super(HaltonSampler, self).__init__(num_dims, seed)
+        self._bases = _get_primes(num_dims)
+        if scramble:
+            self._permutations = [self.random_state.permutation(base)
+                                  for base in self._bases]
+        else:
+            self._permutations = [np.arange(base) for base in self._bases]
+        self._index = 1  # 0 is a corner of the hypercube
+
+    def sample(self, num):
+        indices = np.arange(self._index, self._index + num, dtype=np.int64)
+        self._index += num
+        points = np.empty((num, self.num_dims))
+        for dim, (base, permutation) in enumerate(
+                zip(self._bases, self._permutations)):
+            points[:, dim] = _radical_inverse(indices, base, permutation)
+        return points
+
+
+def get_sampler(method, num_dims, seed=None):
+    """
+    Create a sampler of points in the unit hypercube.
+
+    :param method: "RANDOM", "SOBOL" or "HALTON"
+    :param num_dims: number of dimensions of the points
+    :param seed: seed of the random number generator
+    :return: an object with a sample(num) method
+    """
+    if method == 'RANDOM':
+        return RandomSampler(num_dims, seed)
+    elif method == 'SOBOL':
+        return SobolSampler(num_dims, seed)
+    elif method == 'HALTON':
+        return HaltonSampler(num_dims, seed)
+    raise ValueError("Invalid sampling method {0}".format(method))
+
+
+def _get_sobol_directions(dim):
+    """
+    Returns the NUM_BITS direction numbers of a dimension of the Sobol
+    sequence.
+    """
+    if dim == 0:
+        m = [1] * NUM_BITS
+    else:
+        s, a, m = SOBOL_DIRECTIONS[dim - 1]
+        m = list(m)
+        for i in range(s, NUM_BITS):
+            value = m[i - s] ^ (m[i - s] << s)
+            for k in range(1, s):
+                if (a >> (s - 1 - k)) & 1:
+                    value ^= m[i - k] << k
+            m.append(value)
+    return [m[i] << (NUM_BITS - 1 - i) for i in range(NUM_BITS)]
+
+
+def _radical_inverse(indices, base, permutation):
+    """
+    Reverse the digits of indices in the given base behind the radix point,
+    mapping each digit through permutation.
+    """
+    result = np.zeros(len(indices))
+    factor = 1.0 / base
+    remaining = indices.copy()
+    # Enough digits for double precision
+    for _ in range(int(np.ceil(53 * np.log(2) / np.log(base)))):
+        result += permutation[remaining % base] * factor
+        remaining //= base
+        factor /= base
+    return result
+
+
+def _get_primes(num):
+    """Returns the first num prime numbers."""
+    primes = []
+    candidate = 2
+    while len(primes) < num:
+        if all(candidate % p for p in primes if p * p <= candidate):
+            primes.append(candidate)
+        candidate += 1
+    return primes
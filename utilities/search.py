@@ -0,0 +1,237 @@
+from __future__ import print_function
+
+import math
+
+import numpy as np
+
+from utilities.job_factory import DictParameter, NumericParameter, \
+    Substitution
+
+GAMMA = 0.25
+NUM_CANDIDATES = 24
+NUM_STARTUP_JOBS = 10
+MIN_BANDWIDTH = 0.05
+PRIOR_WEIGHT = 1.0
+
+
+class TPESearch(object):
+    """
+    Sequential model-based search with a Tree-structured Parzen Estimator.
+
+    The results of completed jobs are split into the best gamma fraction and
+    the rest, and each parameter is modelled by one density per group:
+    a mixture of Gaussians over the unit interval for NumericParameter
+    (linear or log scale), and smoothed frequencies for other parameters.
+    New parameter combinations are chosen among candidates sampled from the
+    density of the best jobs, by maximizing the ratio of the two densities.
+    Candidates for a whole batch of jobs are sampled and scored at once with
+    NumPy.
+    """
+
+    def __init__(self, parameter_sweep, maximize=False, gamma=GAMMA,
+                 num_candidates=NUM_CANDIDATES,
+                 num_startup_jobs=NUM_STARTUP_JOBS, seed=None):
+        """
+        :param parameter_sweep: a utilities.job_factory.ParameterSweep
+        :param maximize: whether larger metric values are better
+        :param gamma: fraction of the results considered good
+        :param num_candidates: number of candidates scored per proposed job
+        :param num_startup_jobs: number of results needed before proposals
+        are based on them; until then, proposals are random
+        :param seed: seed of the random number generator
+        """
+        if not 0 < gamma < 1:
+            raise ValueError("Gamma must be between 0 and 1")
+        self.parameter_sweep = parameter_sweep
+        self.param_specs = parameter_sweep.param_specs
+        self.maximize = maximize
+        self.gamma = gamma
+        self.num_candidates = num_candidates
+        self.num_startup_jobs = num_startup_jobs
+        self.random_state = np.random.RandomState(seed)
+        # one list of encoded values per parameter
+        self._observations = [[] for _ in self.param_specs]
+        self._metrics = []
+
+    @property
+    def num_observations(self):
+        """Number of results the search is based on."""
+        return len(self._metrics)
+
+    def observe(self, param_dict, metric_value):
+        """
+        Add the result of a job. Results which are not finite numbers (e.g.
+        the metric could not be extracted) are ignored.
+
+        :param param_dict: the parameter combination of the job, as returned
+        by the generate methods of ParameterSweep. Values may be strings, as
+        in the environment variables of a job.
+        :param metric_value: the metric value of the job
+        """
+        if metric_value is None or not np.isfinite(metric_value):
+            return
+        for observations, param_spec in zip(self._observations,
+                                            self.param_specs):
+            observations.append(_encode(param_spec, param_dict))
+        self._metrics.append(float(metric_value))
+
+    def observe_results(self, results):
+        """
+        Add the results returned by ExperimentUtils.get_metrics_for_jobs. The
+        parameters of each job are read from its environment variables.
+
+        :param results: a list of dictionaries with keys "job" and
+        "metric_value", and optionally "parameters"
+        """
+        for result in results:
+            param_dict = result.get("parameters")
+            if param_dict is None:
+                param_dict = {ev.name: ev.value for ev in
+                              result["job"].environment_variables or []}
+            self.observe(param_dict, result["metric_value"])
+
+    def propose(self, num_jobs):
+        """
+        Propose new parameter combinations.
+
+        :param num_jobs: the number of combinations to propose
+        :return: a list of dictionaries of parameter names to values
+        """
+        if num_jobs <= 0:
+            raise ValueError("Num jobs must be greater than 0")
+        if self.num_observations < self.num_startup_jobs:
+            columns = [self._sample_prior(param_spec, num_jobs)
+                       for param_spec in self.param_specs]
+        else:
+            columns = self._propose_tpe(num_jobs)
+        return [self.parameter_sweep.to_param_dict(combination)
+                for combination in zip(*columns)]
+
+    def generate_jobs(self, job_create_parameters, num_jobs):
+        """
+        Generate jobs for new proposed parameter combinations.
+
+        :param job_create_parameters: an instance of JobCreateParameters
+        :param num_jobs: the number of jobs to generate
+        :return: a tuple of the list of JobCreateParameters and the list of
+        parameter combinations of the jobs
+        """
+        return self.parameter_sweep.generate_jobs_from_param_dicts(
+            job_create_parameters, self.propose(num_jobs))
+
+    def _propose_tpe(self, num_jobs):
+        metrics = np.array(self._metrics)
+        order = np.argsort(-metrics if self.maximize else metrics)
+        num_good = int(math.ceil(self.gamma * len(metrics)))
+        good, bad = order[:num_good], order[num_good:]
+        size = num_jobs * self.num_candidates
+        scores = np.zeros(size)
+        samples = []
+        for param_spec, observations in zip(self.param_specs,
+                                            self._observations):
+            observations = np.array(observations)
+            if isinstance(param_spec, NumericParameter):
+                sample, score = self._score_numeric(
+                    observations[good], observations[bad], size)
+            else:
+                sample, score = self._score_categorical(
+                    observations[good], observations[bad],
+                    len(param_spec.values), size)
+            samples.append(sample)
+            scores += score
+        # Each job gets the best of its own candidates
+        best = np.argmax(scores.reshape(num_jobs, self.num_candidates),
+                         axis=1)
+        selected = np.arange(num_jobs) * self.num_candidates + best
+        columns = []
+        for param_spec, sample in zip(self.param_specs, samples):
+            if isinstance(param_spec, NumericParameter):
+                columns.append(param_spec.from_unit(sample[selected]))
+            else:
+                columns.append([param_spec.values[i]
+                                for i in sample[selected]])
+        return columns
+
+    def _score_numeric(self, good, bad, size):
+        """
+        Sample candidates in the unit interval from the density of the good
+        results, and return them with their log density ratio.
+        """
+        good_mixture = _ParzenEstimator(good)
+        bad_mixture = _ParzenEstimator(bad)
+        sample = good_mixture.sample(self.random_state, size)
+        return sample, (good_mixture.log_density(sample) -
+                        bad_mixture.log_density(sample))
+
+    def _score_categorical(self, good, bad, num_values, size):
+        """
+        Sample candidate value indices from the frequencies of the good
+        results, and return them with their log frequency ratio.
+        """
+        # Either split may be empty, and np.array([]) is a float array,
+        # which np.bincount rejects.
+        good_p = np.bincount(np.asarray(good, dtype=int),
+                             minlength=num_values) + PRIOR_WEIGHT
+        good_p = good_p / good_p.sum()
+        bad_p = np.bincount(np.asarray(bad, dtype=int),
+                            minlength=num_values) + PRIOR_WEIGHT
+        bad_p = bad_p / bad_p.sum()
+        sample = self.random_state.choice(num_values, size=size, p=good_p)
+        return sample, np.log(good_p[sample]) - np.log(bad_p[sample])
+
+    def _sample_prior(self, param_spec, size):
+        if isinstance(param_spec, NumericParameter):
+            return param_spec.from_unit(self.random_state.uniform(size=size))
+        indices = self.random_state.randint(0, len(param_spec.values), size)
+        return [param_spec.values[i] for i in indices]
+
+
+class _ParzenEstimator(object):
+    """
+    Mixture of Gaussians centered on observations in the unit interval,
+    plus a wide prior component, with a bandwidth from Scott's rule.
+    """
+
+    def __init__(self, observations):
+        n = len(observations)
+        if n > 1:
+            bandwidth = 1.06 * np.std(observations) * n ** -0.2
+        else:
+            bandwidth = 1.0
+        bandwidth = np.clip(bandwidth, MIN_BANDWIDTH, 1.0)
+        self.means = np.append(observations, 0.5)
+        self.sigmas = np.append(np.full(n, bandwidth), 1.0)
+
+    def sample(self, random_state, size):
+        components = random_state.randint(0, len(self.means), size)
+        return np.clip(random_state.normal(self.means[components],
+                                           self.sigmas[components]), 0, 1)
+
+    def log_density(self, x):
+        z = (x[:, None] - self.means[None, :]) / self.sigmas[None, :]
+        log_p = -0.5 * z ** 2 - np.log(self.sigmas) - 0.5 * np.log(2 * np.pi)
+        max_log_p = log_p.max(axis=1)
+        return (max_log_p + np.log(np.exp(
+            log_p - max_log_p[:, None]).sum(axis=1)) -
+                np.log(len(self.means)))
+
+
+def _encode(param_spec, param_dict):
+    """
+    Encode the value of a parameter in param_dict: a number in [0, 1] for
+    NumericParameter, the index of the value for other parameters.
+    """
+    name = Substitution.convert_name(param_spec.parameter_name)
+    if isinstance(param_spec, NumericParameter):
+        return float(param_spec.to_unit([float(param_dict[name])])[0])
+    if isinstance(param_spec, DictParameter):
+        for i, value in enumerate(param_spec.values):
+            if all(str(param_dict[name + '__' + key]) == str(v)
+                   for key, v in value.items()):
+                return i
+    else:
+        for i, value in enumerate(param_spec.values):
+            if str(param_dict[name]) == str(value):
+                return i
+    raise ValueError("Value of parameter {0} is not one of its values".format(
+        param_spec.parameter_name))
@@ -0,0 +1,296 @@
+from __future__ import print_function
+
+import collections
+import posixpath
+import threading
+import time
+
+import azure.mgmt.batchai.models as models
+import azure.storage.file.models
+from msrestazure.azure_exceptions import CloudError
+
+from utilities.experiment import ExperimentUtils
+from utilities.throttling import RequestThrottle, RetryPolicy, TokenBucket
+
+CLUSTER_ID = ('/subscriptions/sub/resourceGroups/group/providers/'
+              'Microsoft.BatchAI/workspaces/workspace/clusters/cluster')
+
+
+class FakeObject(object):
+    """An object with the attributes given as keyword arguments."""
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None, content=b''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.reason = 'reason'
+        self.text = ''
+        self.content = content
+
+    def json(self):
+        return {}
+
+    def raise_for_status(self):
+        pass
+
+
+def cloud_error(status_code, headers=None):
+    """
+    :return: a CloudError as raised by the SDK for a response with the given
+    status code and headers
+    """
+    return CloudError(FakeResponse(status_code, headers),
+                      error='Error {0}'.format(status_code))
+
+
+def make_job(name, provisioning_state=models.ProvisioningState.succeeded,
+             execution_state=models.ExecutionState.queued,
+             cluster_id=CLUSTER_ID):
+    job = models.Job()
+    job.name = name
+    job.provisioning_state = provisioning_state
+    job.execution_state = execution_state
+    job.cluster = models.ResourceId(id=cluster_id)
+    return job
+
+
+def make_jcp(value, cluster_id=CLUSTER_ID):
+    """
+    :return: JobCreateParameters with the environment variable PARAM_X set
+    to value
+    """
+    return models.JobCreateParameters(
+        cluster=models.ResourceId(id=cluster_id), node_count=1,
+        std_out_err_path_prefix='$AZ_BATCHAI_MOUNT_ROOT/output',
+        environment_variables=[
+            models.EnvironmentVariable(name='PARAM_X', value=str(value))])
+
+
+def make_throttle():
+    """
+    :return: a RequestThrottle which neither limits the request rate nor
+    waits between retries
+    """
+    return RequestThrottle(TokenBucket(rate=1e6, capacity=1e6),
+                           RetryPolicy(base_delay=0, max_delay=0))
+
+
+class FakeJobList(object):
+    """
+    The jobs of an experiment, listed by list_jobs. Errors put in
+    self.errors are raised by the next listings, one per listing.
+    """
+
+    def __init__(self, jobs=()):
+        self.jobs = {job.name: job for job in jobs}
+        self.errors = []
+        self.num_listings = 0
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self.jobs[job.name] = job
+
+    def remove(self, job_name):
+        with self._lock:
+            self.jobs.pop(job_name, None)
+
+    def list_jobs(self):
+        with self._lock:
+            self.num_listings += 1
+            if self.errors:
+                raise self.errors.pop(0)
+            return list(self.jobs.values())
+
+
+def output_file_url(job_name, output_directory_id, file_name,
+                    directory='.'):
+    """:return: the download URL of an output file in FakeJobs"""
+    return 'https://storage/{0}/{1}/{2}/{3}'.format(
+        job_name, output_directory_id, directory, file_name)
+
+
+class FakeSession(object):
+    """
+    A requests.Session serving the files in self.files, a dict of URLs to
+    bytes, from the offset in the Range header. Errors put in self.errors are
+    raised by the next requests, one per request.
+    """
+
+    def __init__(self, files=None):
+        self.files = files if files is not None else {}
+        self.errors = []
+        self.timeouts = []
+        self._lock = threading.Lock()
+
+    def get(self, url, headers=None, timeout=None):
+        with self._lock:
+            self.timeouts.append(timeout)
+            if self.errors:
+                raise self.errors.pop(0)
+            content = self.files[url]
+        offset = int(headers['Range'][len('bytes='):-1])
+        if offset >= len(content):
+            return FakeResponse(416)
+        return FakeResponse(206, content=content[offset:])
+
+
+class FakeClusters(object):
+    def __init__(self, idle_node_count=0, preparing_node_count=0):
+        self.node_state_counts = FakeObject(
+            idle_node_count=idle_node_count,
+            preparing_node_count=preparing_node_count)
+        self.num_gets = 0
+
+    def get(self, resource_group, workspace_name, cluster_name):
+        self.num_gets += 1
+        return FakeObject(name=cluster_name,
+                          node_state_counts=self.node_state_counts)
+
+
+class FakeJobs(object):
+    """
+    The jobs operations of a BatchAIManagementClient, over a FakeJobList.
+    Errors put in self.create_errors[job_name] are raised by the next create
+    requests for the job, one per request. The output files of jobs are the
+    URLs made with output_file_url in self.output_files, a dict of URLs to
+    bytes.
+    """
+
+    def __init__(self, job_list=None, latency=0,
+                 execution_state=models.ExecutionState.queued):
+        """
+        :param execution_state: the execution state of created jobs
+        """
+        self.job_list = job_list or FakeJobList()
+        self.latency = latency
+        self.execution_state = execution_state
+        self.create_errors = {}
+        self.output_files = {}
+        self.calls = collections.Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def create(self, resource_group, workspace_name, experiment_name,
+               job_name, parameters, polling=True):
+        with self._lock:
+            self.calls['create'] += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            errors = self.create_errors.get(job_name)
+            error = errors.pop(0) if errors else None
+        try:
+            time.sleep(self.latency)
+            if error is not None:
+                raise error
+            job = make_job(job_name, execution_state=self.execution_state)
+            job.environment_variables = parameters.environment_variables
+            job.output_directories = parameters.output_directories
+            job.job_output_directory_path_segment = 'segment/' + job_name
+            self.job_list.add(job)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def get(self, resource_group, workspace_name, experiment_name,
+            job_name):
+        self.calls['get'] += 1
+        job = self.job_list.jobs.get(job_name)
+        if job is None:
+            raise cloud_error(404)
+        return job
+
+    def delete(self, resource_group, workspace_name, experiment_name,
+               job_name, polling=True):
+        self.calls['delete'] += 1
+        self.job_list.remove(job_name)
+
+    def terminate(self, resource_group, workspace_name, experiment_name,
+                  job_name, polling=True):
+        self.calls['terminate'] += 1
+        self.job_list.jobs[job_name].execution_state = \
+            models.ExecutionState.failed
+
+    def list_by_experiment(self, resource_group, workspace_name,
+                           experiment_name):
+        return self.job_list.list_jobs()
+
+    def list_output_files(self, resource_group, workspace_name,
+                          experiment_name, job_name, jobs_list_output_files):
+        self.calls['list_output_files'] += 1
+        prefix = output_file_url(
+            job_name, jobs_list_output_files.outputdirectoryid, '',
+            jobs_list_output_files.directory)
+        return [FakeObject(name=url[len(prefix):], download_url=url)
+                for url in sorted(self.output_files) if url.startswith(prefix)]
+
+
+class FakeClient(object):
+    """A BatchAIManagementClient with fake jobs and clusters operations."""
+
+    def __init__(self, jobs=None, clusters=None):
+        self.jobs = jobs or FakeJobs()
+        self.clusters = clusters or FakeClusters()
+        self.experiments = FakeObject(get=lambda *args: None)
+
+
+class FakeFileService(object):
+    """
+    A FileService with one File share holding the files in self.files, a
+    dict of paths to sizes. Listing requests are recorded in self.listings
+    as (directory, prefix) tuples, and uploaded texts in self.uploads.
+    """
+
+    def __init__(self, files):
+        self.files = dict(files)
+        self.listings = []
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+    def list_directories_and_files(self, share_name, directory_name=None,
+                                   prefix=None):
+        with self._lock:
+            self.listings.append((directory_name, prefix))
+        directory = directory_name.rstrip('/') + '/' if directory_name else ''
+        sizes = {}
+        for path, size in self.files.items():
+            if path.startswith(directory):
+                name, separator, _ = path[len(directory):].partition('/')
+                if name.startswith(prefix or ''):
+                    sizes[name] = None if separator else size
+        entries = []
+        for name, size in sorted(sizes.items()):
+            if size is None:
+                entries.append(azure.storage.file.models.Directory(name))
+            else:
+                properties = azure.storage.file.models.FileProperties()
+                properties.content_length = size
+                entries.append(azure.storage.file.models.File(
+                    name, props=properties))
+        return entries
+
+    def create_directory(self, share_name, directory_name):
+        pass
+
+    def create_file_from_text(self, share_name, directory_name, file_name,
+                              text):
+        with self._lock:
+            self.uploads[posixpath.join(directory_name, file_name)] = text
+
+
+def make_experiment_utils(client=None):
+    """
+    :return: an ExperimentUtils over client (a new FakeClient if None)
+    which polls operations every 10 ms and never waits between retries
+    """
+    experiment_utils = ExperimentUtils(
+        client or FakeClient(), 'group', 'workspace', 'experiment',
+        log_to_stdout=False, throttle=make_throttle())
+    experiment_utils.operations.interval = 0.01
+    return experiment_utils
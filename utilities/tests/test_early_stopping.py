@@ -0,0 +1,94 @@
+from __future__ import print_function
+
+import datetime
+import unittest
+
+import azure.mgmt.batchai.models as models
+
+from utilities.early_stopping import EarlyStoppingMonitor, \
+    MedianStoppingRule, ThresholdRule
+from utilities.tests.fakes import make_experiment_utils, make_job
+
+RUNNING = models.ExecutionState.running
+SUCCEEDED = models.ExecutionState.succeeded
+
+
+class FakeMetricExtractor(object):
+    """
+    Returns the values put in self.values[(job name, creation time)] as the
+    new values of the job.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get_new_values(self, job_name, resource_group, workspace_name,
+                       experiment_name, client, throttle=None, directory='.',
+                       final=False, creation_time=None):
+        return self.values.pop((job_name, creation_time), [])
+
+
+class RulesTest(unittest.TestCase):
+    def test_median_stopping_rule(self):
+        rule = MedianStoppingRule(min_steps=2, min_jobs=2)
+        all_series = {'a': [1, 1, 1], 'b': [2, 2, 2], 'c': [5, 5, 5]}
+        self.assertTrue(rule.should_stop('c', all_series['c'], all_series))
+        self.assertFalse(rule.should_stop('a', all_series['a'], all_series))
+        # Too few steps, and too few other jobs with as many steps
+        self.assertFalse(rule.should_stop('c', [5], all_series))
+        self.assertFalse(rule.should_stop('c', [5, 5, 5, 5], all_series))
+
+    def test_median_stopping_rule_maximize(self):
+        rule = MedianStoppingRule(min_steps=1, min_jobs=2, maximize=True)
+        all_series = {'a': [1], 'b': [2], 'c': [5]}
+        self.assertTrue(rule.should_stop('a', all_series['a'], all_series))
+        self.assertFalse(rule.should_stop('c', all_series['c'], all_series))
+
+    def test_threshold_rule(self):
+        rule = ThresholdRule(lambda step: 1.0 / step, min_steps=2)
+        self.assertFalse(rule.should_stop('a', [2], {}))
+        self.assertTrue(rule.should_stop('a', [2, 0.6], {}))
+        self.assertFalse(rule.should_stop('a', [2, 0.4], {}))
+
+
+class EarlyStoppingMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.experiment_utils = make_experiment_utils()
+        self.job_list = self.experiment_utils.client.jobs.job_list
+        self.extractor = FakeMetricExtractor()
+        self.monitor = EarlyStoppingMonitor(
+            self.experiment_utils, self.extractor,
+            ThresholdRule(1.0, min_steps=2), interval=0)
+
+    def add_job(self, name, execution_state, created, values):
+        job = make_job(name, execution_state=execution_state)
+        job.creation_time = datetime.datetime(2018, 1, 1, created)
+        self.job_list.add(job)
+        self.extractor.values[(name, job.creation_time)] = values
+        return job
+
+    def test_terminate(self):
+        good = self.add_job('good', RUNNING, 0, [0.5, 0.5])
+        bad = self.add_job('bad', RUNNING, 0, [2.0, 2.0])
+        self.assertEqual(self.monitor.poll(), ['bad'])
+        self.assertEqual(bad.execution_state, models.ExecutionState.failed)
+        self.assertEqual(good.execution_state, RUNNING)
+        self.assertEqual(self.monitor.stopped_jobs, ['bad'])
+        self.assertEqual(self.experiment_utils.stopped_jobs, {'bad'})
+        self.assertEqual(self.monitor.poll(), [])
+
+    def test_resubmitted_job_gets_new_series(self):
+        old = self.add_job('job', SUCCEEDED, 0, [2.0, 2.0])
+        self.assertEqual(self.monitor.poll(), [])
+        new = self.add_job('job', RUNNING, 1, [0.5])
+        self.assertEqual(self.monitor.poll(), [])
+        self.assertEqual(
+            self.monitor.series,
+            {('job', old.creation_time): [2.0, 2.0],
+             ('job', new.creation_time): [0.5]})
+        self.extractor.values[('job', new.creation_time)] = [2.0]
+        self.assertEqual(self.monitor.poll(), ['job'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+from __future__ import print_function
+
+import time
+import unittest
+
+import azure.mgmt.batchai.models as models
+from msrestazure.azure_exceptions import CloudError
+
+from utilities.experiment import JobToSubmit, SubmissionWindow
+from utilities.job_state import JobStateCache
+from utilities.tests.fakes import CLUSTER_ID, FakeClient, FakeClusters, \
+    FakeJobList, FakeJobs, FakeObject, cloud_error, make_experiment_utils, \
+    make_jcp, make_job, make_throttle
+
+TIMEOUT_SECS = 10
+
+
+def make_job_to_submit(name, cluster_id=CLUSTER_ID):
+    return JobToSubmit(name, FakeObject(
+        cluster=models.ResourceId(id=cluster_id)))
+
+
+class SubmitJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.experiment_utils = make_experiment_utils(self.client)
+
+    def submit(self, jcps, **kwargs):
+        return self.experiment_utils.submit_jobs(
+            jcps, 'prefix', **kwargs).result(TIMEOUT_SECS)
+
+    def test_submit(self):
+        jcps = [make_jcp(i) for i in range(20)]
+        jobs = self.submit(jcps)
+        self.assertEqual(
+            sorted(job.name for job in jobs),
+            sorted(self.experiment_utils.get_job_name(jcp, 'prefix')
+                   for jcp in jcps))
+        self.assertEqual(self.client.jobs.calls['create'], 20)
+        self.assertEqual(len(self.experiment_utils.submitted_jcps), 20)
+
+    def test_submit_generator_and_named_jobs(self):
+        jobs = self.submit(
+            JobToSubmit('job_{0}'.format(i), make_jcp(i)) for i in range(5))
+        self.assertEqual(sorted(job.name for job in jobs),
+                         ['job_{0}'.format(i) for i in range(5)])
+
+    def test_retry_retryable_errors(self):
+        jcp = make_jcp(0)
+        job_name = self.experiment_utils.get_job_name(jcp, 'prefix')
+        self.client.jobs.create_errors[job_name] = [
+            cloud_error(429), cloud_error(503)]
+        jobs = self.submit([jcp, make_jcp(1)])
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(self.client.jobs.calls['create'], 4)
+
+    def test_give_up_after_max_retries(self):
+        jcp = make_jcp(0)
+        job_name = self.experiment_utils.get_job_name(jcp, 'prefix')
+        self.client.jobs.create_errors[job_name] = [
+            cloud_error(503) for _ in range(3)]
+        jobs = self.submit([jcp, make_jcp(1)], max_retries=2)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(self.client.jobs.calls['create'], 4)
+
+    def test_non_retryable_error(self):
+        jcp = make_jcp(0)
+        job_name = self.experiment_utils.get_job_name(jcp, 'prefix')
+        self.client.jobs.create_errors[job_name] = [cloud_error(400)]
+        with self.assertRaises(CloudError):
+            self.submit([jcp])
+
+    def test_concurrency_is_bounded(self):
+        self.client.jobs = FakeJobs(latency=0.01)
+        self.submit([make_jcp(i) for i in range(50)], num_threads=4)
+        self.assertEqual(self.client.jobs.calls['create'], 50)
+        self.assertLessEqual(self.client.jobs.max_in_flight, 4)
+
+    def test_do_not_wait_for_creation(self):
+        jobs = self.submit([make_jcp(i) for i in range(3)],
+                           wait_for_creation=False)
+        self.assertEqual(len(jobs), 3)
+        self.assertTrue(all(isinstance(job, JobToSubmit) for job in jobs))
+
+    def test_latency_excludes_rate_limiter(self):
+        self.client.jobs.latency = 0.01
+        self.experiment_utils.throttle.rate_limiter.pause(0.2)
+        started = time.time()
+        _, latency = self.experiment_utils._submit_job(
+            'job', make_jcp(0), track=False)
+        self.assertGreaterEqual(time.time() - started, 0.19)
+        self.assertLess(latency, 0.1)
+
+
+class ConfirmJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.experiment_utils = make_experiment_utils()
+        self.job_list = self.experiment_utils.client.jobs.job_list
+        self.jobs = [JobToSubmit(name, make_jcp(name))
+                     for name in ['created', 'failed', 'missing']]
+
+    def test_confirm(self):
+        self.job_list.add(make_job('created'))
+        self.job_list.add(make_job(
+            'failed', provisioning_state=models.ProvisioningState.failed))
+        created, missing = self.experiment_utils.confirm_jobs(
+            self.jobs, timeout=0.1)
+        self.assertEqual([job.name for job in created], ['created'])
+        self.assertEqual([job.name for job in missing], ['failed', 'missing'])
+
+    def test_report_failed_provisioning_immediately(self):
+        self.job_list.add(make_job('created'))
+        self.job_list.add(make_job(
+            'failed', provisioning_state=models.ProvisioningState.failed))
+        started = time.time()
+        created, missing = self.experiment_utils.confirm_jobs(
+            self.jobs[:2], timeout=TIMEOUT_SECS)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual([job.name for job in missing], ['failed'])
+
+
+class SubmissionWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.job_list = FakeJobList()
+        self.clusters = FakeClusters(idle_node_count=1,
+                                     preparing_node_count=1)
+        self.experiment_utils = FakeObject(
+            job_cache=JobStateCache(self.job_list.list_jobs),
+            throttle=make_throttle(),
+            client=FakeObject(clusters=self.clusters))
+
+    def acquire(self, window, names):
+        return [window.try_acquire(make_job_to_submit(name))
+                for name in names]
+
+    def test_free_nodes_and_queue_buffer(self):
+        window = SubmissionWindow(self.experiment_utils, queue_buffer=1)
+        self.assertEqual(self.acquire(window, ['a', 'b', 'c', 'd']),
+                         [True, True, True, False])
+        self.assertEqual(self.clusters.num_gets, 1)
+        window.release(make_job_to_submit('a'))
+        self.assertEqual(self.acquire(window, ['d']), [True])
+
+    def test_queued_jobs_count_against_cluster(self):
+        self.job_list.add(make_job('queued'))
+        self.job_list.add(make_job(
+            'running', execution_state=models.ExecutionState.running))
+        window = SubmissionWindow(self.experiment_utils, queue_buffer=1)
+        self.assertEqual(self.acquire(window, ['a', 'b', 'c']),
+                         [True, True, False])
+
+    def test_missing_node_counts(self):
+        self.clusters.node_state_counts = None
+        window = SubmissionWindow(self.experiment_utils, queue_buffer=1)
+        self.assertEqual(self.acquire(window, ['a', 'b']), [True, False])
+
+    def test_max_in_flight(self):
+        self.job_list.add(make_job(
+            'running', execution_state=models.ExecutionState.running))
+        self.job_list.add(make_job(
+            'done', execution_state=models.ExecutionState.succeeded))
+        window = SubmissionWindow(self.experiment_utils, max_in_flight=3)
+        self.assertEqual(self.acquire(window, ['a', 'b', 'c']),
+                         [True, True, False])
+        self.assertEqual(self.clusters.num_gets, 0)
+
+    def test_listed_jobs_leave_pending(self):
+        window = SubmissionWindow(self.experiment_utils, queue_buffer=0,
+                                  refresh_interval=0)
+        self.assertEqual(self.acquire(window, ['a', 'b', 'c']),
+                         [True, True, False])
+        # Once listed, running jobs no longer occupy the queue
+        for name in ['a', 'b']:
+            self.job_list.add(make_job(
+                name, execution_state=models.ExecutionState.running))
+        self.experiment_utils.job_cache.invalidate()
+        self.assertEqual(self.acquire(window, ['c']), [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
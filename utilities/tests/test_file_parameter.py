@@ -0,0 +1,142 @@
+from __future__ import print_function
+
+import unittest
+
+import utilities.job_factory as job_factory
+from utilities.job_factory import FileBatchParameter, FileParameter, \
+    _get_literal_prefix, _pack_files
+from utilities.tests.fakes import FakeFileService
+
+MOUNT_DIRECTORY = '$AZ_BATCHAI_JOB_MOUNT_ROOT/data'
+FILES = {
+    'images/cat_1.jpg': 1,
+    'images/cat_2.jpg': 2,
+    'images/cat_dir/cat_3.jpg': 3,
+    'images/dog_1.jpg': 4,
+    'other/cat_1.jpg': 5,
+}
+
+
+class LiteralPrefixTest(unittest.TestCase):
+    def test_literal_prefix(self):
+        cases = [
+            ('images/cat_[0-9]+\\.jpg', 'images/cat_'),
+            ('^data/a.b', 'data/a'),
+            ('data/a\\.b', 'data/a.b'),
+            ('data/a\\d', 'data/a'),
+            ('data/ab*', 'data/a'),
+            ('data/ab?', 'data/a'),
+            ('data/ab{2}', 'data/a'),
+            ('data/(a|b)', ''),
+            ('data/a|b', ''),
+            ('.*', ''),
+        ]
+        for regex, prefix in cases:
+            self.assertEqual(_get_literal_prefix(regex), prefix, regex)
+
+
+class FileParameterTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeFileService(FILES)
+        self.file_service = job_factory.FileService
+        job_factory.FileService = lambda account, key: self.service
+
+    def tearDown(self):
+        job_factory.FileService = self.file_service
+
+    def make_parameter(self, **kwargs):
+        return FileParameter('FILE', 'account', 'key', 'FILE', 'data', 'JOB',
+                             fileshare='share', **kwargs)
+
+    def test_all_files(self):
+        parameter = self.make_parameter()
+        self.assertEqual(parameter.values,
+                         [MOUNT_DIRECTORY + '/' + path
+                          for path in sorted(FILES)])
+        self.assertEqual(parameter.sizes,
+                         [FILES[path] for path in sorted(FILES)])
+
+    def test_filter_prefix_is_pushed_down(self):
+        parameter = self.make_parameter(filter_str='images/cat_[0-9]+\\.jpg')
+        self.assertEqual(parameter.values,
+                         [MOUNT_DIRECTORY + '/images/cat_1.jpg',
+                          MOUNT_DIRECTORY + '/images/cat_2.jpg'])
+        # Neither "other" nor the files of "images" not starting with "cat_"
+        # are listed
+        self.assertEqual(set(self.service.listings),
+                         {(None, 'images'), ('images', 'cat_'),
+                          ('images/cat_dir', None)})
+
+    def test_root_directory(self):
+        parameter = self.make_parameter(directory='images',
+                                        filter_str='images/dog')
+        self.assertEqual(parameter.values,
+                         [MOUNT_DIRECTORY + '/images/dog_1.jpg'])
+        self.assertEqual(self.service.listings, [('images', 'dog')])
+
+
+class PackFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.files = [('a', 5), ('b', 4), ('c', 3), ('d', 2), ('e', 1)]
+
+    def test_num_batches(self):
+        self.assertEqual(_pack_files(self.files, num_batches=2),
+                         [[('a', 5), ('d', 2), ('e', 1)],
+                          [('b', 4), ('c', 3)]])
+        self.assertEqual(len(_pack_files(self.files, num_batches=10)), 5)
+
+    def test_max_batch_size(self):
+        self.assertEqual(_pack_files(self.files, max_batch_size=6),
+                         [[('a', 5)], [('b', 4), ('e', 1)],
+                          [('c', 3), ('d', 2)]])
+        # A file larger than the maximum gets a batch of its own
+        self.assertEqual(_pack_files([('big', 10), ('small', 1)],
+                                     max_batch_size=5),
+                         [[('big', 10)], [('small', 1)]])
+
+
+class FileBatchParameterTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeFileService(dict(FILES, **{
+            '.manifests/FILES_old.txt': 100}))
+        self.file_service = job_factory.FileService
+        job_factory.FileService = lambda account, key: self.service
+
+    def tearDown(self):
+        job_factory.FileService = self.file_service
+
+    def make_parameter(self, **kwargs):
+        return FileBatchParameter('FILES', 'account', 'key', 'FILE', 'data',
+                                  'JOB', fileshare='share', **kwargs)
+
+    def test_manifests(self):
+        parameter = self.make_parameter(num_batches=2)
+        self.assertEqual(len(parameter.values), 2)
+        self.assertEqual(sorted(parameter.sizes), [7, 8])
+        self.assertEqual(
+            sorted(self.service.uploads),
+            sorted(value[len(MOUNT_DIRECTORY) + 1:]
+                   for value in parameter.values))
+        for value, batch in zip(parameter.values, parameter.batches):
+            self.assertTrue(value.startswith(
+                MOUNT_DIRECTORY + '/.manifests/FILES_'))
+            # Manifests hold paths relative to the mounted share
+            text = self.service.uploads[value[len(MOUNT_DIRECTORY) + 1:]]
+            self.assertEqual(
+                text.splitlines(),
+                [path[len(MOUNT_DIRECTORY) + 1:] for path in batch])
+        self.assertEqual(sorted(sum(parameter.batches, [])),
+                         [MOUNT_DIRECTORY + '/' + path
+                          for path in sorted(FILES)])
+
+    def test_same_batches_get_same_manifests(self):
+        self.assertEqual(self.make_parameter(max_batch_size=6).values,
+                         self.make_parameter(max_batch_size=6).values)
+
+    def test_batch_size_is_required(self):
+        with self.assertRaises(ValueError):
+            self.make_parameter()
+
+
+if __name__ == '__main__':
+    unittest.main()
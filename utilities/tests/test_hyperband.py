@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+import collections
+import unittest
+
+import azure.mgmt.batchai.models as models
+
+from utilities.hyperband import ASHA, HyperBand
+from utilities.job import RESUME_FROM_ENV_VAR
+from utilities.job_factory import DiscreteParameter, ParameterSweep
+from utilities.tests.fakes import FakeClient, FakeJobs, \
+    make_experiment_utils, make_jcp
+
+BROKEN = 9
+
+
+class FakeMetricExtractor(object):
+    """
+    The metric of a job is its PARAM_X, or inf (no metric) if PARAM_X is
+    BROKEN.
+    """
+
+    def __init__(self, job_list):
+        self.job_list = job_list
+
+    def get_metric(self, job_name, resource_group, workspace_name,
+                   experiment_name, client, throttle=None, directory='.',
+                   creation_time=None):
+        job = self.job_list.jobs[job_name]
+        x = int({ev.name: ev.value
+                 for ev in job.environment_variables}['PARAM_X'])
+        return float('inf') if x == BROKEN else float(x)
+
+
+class ASHATest(unittest.TestCase):
+    def setUp(self):
+        # Jobs succeed as soon as they are created
+        self.client = FakeClient(FakeJobs(
+            execution_state=models.ExecutionState.succeeded))
+        self.experiment_utils = make_experiment_utils(self.client)
+        self.parameter_sweep = ParameterSweep([
+            DiscreteParameter('X', list(range(1, BROKEN + 1)))])
+        self.metric_extractor = FakeMetricExtractor(self.client.jobs.job_list)
+
+    def run_asha(self, cls=ASHA, jcp=None, **kwargs):
+        asha = cls(self.experiment_utils, self.parameter_sweep,
+                   jcp or make_jcp(0),
+                   self.metric_extractor, 'asha', min_resource=1,
+                   max_resource=9, max_concurrent_jobs=3, poll_interval=0,
+                   **kwargs)
+        return asha, asha.run()
+
+    def test_promotions(self):
+        asha, results = self.run_asha()
+        self.assertEqual(len(asha.configs), BROKEN)
+        rungs = collections.Counter(r["rung"] for r in results)
+        self.assertEqual(rungs[0], BROKEN - 1)
+        self.assertEqual(rungs[1], 2)
+        self.assertEqual(rungs[2], 0)
+        for result in results:
+            self.assertEqual(result["resource"], 3 ** result["rung"])
+            self.assertEqual(result["parameters"]["PARAM_X"],
+                             result["metric_value"])
+        self.assertEqual(len(set(r["job_name"] for r in results)),
+                         len(results))
+        self.assertEqual(asha.get_best()["rung"], 1)
+
+    def test_jobs_without_metric_are_not_promoted(self):
+        asha, results = self.run_asha(maximize=True)
+        self.assertNotIn(BROKEN,
+                         [r["parameters"]["PARAM_X"] for r in results])
+        best = asha.get_best()
+        self.assertEqual(best["resource"], 9)
+        self.assertLess(best["metric_value"], BROKEN)
+
+    def test_failed_jobs_are_not_promoted(self):
+        self.client.jobs.execution_state = models.ExecutionState.failed
+        asha, results = self.run_asha()
+        self.assertEqual(results, [])
+        self.assertIsNone(asha.get_best())
+        self.assertEqual(self.client.jobs.calls['create'], BROKEN)
+
+    def test_resume_from_previous_rung(self):
+        jcp = make_jcp(0)
+        jcp.output_directories = [models.OutputDirectory(
+            id='MODEL', path_prefix='/model')]
+        asha, results = self.run_asha(jcp=jcp, resume=True,
+                                      checkpoint_directory_id='MODEL')
+        jobs = self.client.jobs.job_list.jobs
+        rung_0 = {r["parameters"]["PARAM_X"]: r["job_name"] for r in results
+                  if r["rung"] == 0}
+        promoted = [r for r in results if r["rung"] == 1]
+        self.assertEqual(len(promoted), 2)
+        for result in promoted:
+            env = {ev.name: ev.value
+                   for ev in jobs[result["job_name"]].environment_variables}
+            self.assertEqual(
+                env[RESUME_FROM_ENV_VAR], '/model/segment/{0}/outputs'.format(
+                    rung_0[result["parameters"]["PARAM_X"]]))
+        for job_name in rung_0.values():
+            env = {ev.name for ev in jobs[job_name].environment_variables}
+            self.assertNotIn(RESUME_FROM_ENV_VAR, env)
+
+    def test_hyperband_brackets(self):
+        asha, results = self.run_asha(cls=HyperBand)
+        self.assertEqual(asha.num_brackets, 3)
+        # New configs start round-robin in the first rung of each bracket
+        first_rungs = sorted(r["resource"] for r in results
+                             if r["rung"] == 0)
+        self.assertEqual(first_rungs, [1, 1, 1, 3, 3, 3, 9, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
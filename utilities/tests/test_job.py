@@ -0,0 +1,399 @@
+from __future__ import print_function
+
+import collections
+import datetime
+import json
+import unittest
+
+import azure.mgmt.batchai.models as models
+import numpy as np
+import requests
+from msrest.authentication import BasicTokenAuthentication
+
+import utilities.job as job_module
+from utilities.job import DOWNLOAD_CONNECT_TIMEOUT_SECS, \
+    DOWNLOAD_READ_TIMEOUT_SECS, JobOutputTailer, MetricExtractor, \
+    OutputFileReader, RESUME_FROM_ENV_VAR, RESUME_FROM_ID, \
+    STDOUTERR_DIRECTORY_ID, StorageKeyCache, TimeSeriesExtractor, \
+    set_resume_from
+from utilities.job_factory import TRIALS_ENV_VAR
+from utilities.tests.fakes import FakeClient, FakeObject, FakeSession, \
+    make_experiment_utils, make_jcp, make_job, make_throttle, \
+    output_file_url
+
+DOWNLOAD_TIMEOUT = (DOWNLOAD_CONNECT_TIMEOUT_SECS, DOWNLOAD_READ_TIMEOUT_SECS)
+
+
+class ResumeFromTest(unittest.TestCase):
+    def setUp(self):
+        self.job = make_job('job')
+        self.job.job_output_directory_path_segment = 'segment'
+        self.job.output_directories = [
+            models.OutputDirectory(id='LOGS', path_prefix='/logs'),
+            models.OutputDirectory(id='MODEL', path_prefix='/model',
+                                   path_suffix='checkpoints')]
+
+    def test_resume_from(self):
+        jcp = make_jcp(0)
+        jcp.input_directories = [
+            models.InputDirectory(id='DATA', path='/data'),
+            models.InputDirectory(id=RESUME_FROM_ID, path='/old')]
+        set_resume_from(jcp, self.job, 'MODEL')
+        path = '/model/segment/outputs/checkpoints'
+        self.assertEqual([(d.id, d.path) for d in jcp.input_directories],
+                         [('DATA', '/data'), (RESUME_FROM_ID, path)])
+        self.assertEqual(
+            {ev.name: ev.value for ev in jcp.environment_variables},
+            {'PARAM_X': '0', RESUME_FROM_ENV_VAR: path})
+        set_resume_from(jcp, self.job)
+        self.assertEqual(jcp.input_directories[-1].path,
+                         '/logs/segment/outputs')
+        self.assertEqual(len(jcp.environment_variables), 2)
+
+    def test_missing_output_directory(self):
+        with self.assertRaises(ValueError):
+            set_resume_from(make_jcp(0), self.job, 'OTHER')
+
+
+class FakeStorageAccounts(object):
+    def __init__(self, account_names):
+        self.account_names = account_names
+        self.calls = collections.Counter()
+
+    def list(self):
+        self.calls['list'] += 1
+        return [FakeObject(name=name, id=(
+            '/subscriptions/sub/resourceGroups/group/providers/'
+            'Microsoft.Storage/storageAccounts/{0}'.format(name)))
+            for name in self.account_names]
+
+    def list_keys(self, resource_group, account_name):
+        self.calls['list_keys'] += 1
+        return FakeObject(keys=[FakeObject(value='{0}_{1}_key_{2}'.format(
+            resource_group, account_name, self.calls['list_keys']))])
+
+
+class StorageKeyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.storage_accounts = FakeStorageAccounts(['account', 'other'])
+        self.cache = StorageKeyCache(FakeObject(config=FakeObject(
+            credentials=BasicTokenAuthentication({'access_token': 'token'}),
+            subscription_id='sub', base_url='https://management.azure.com')))
+        self.cache._storage_client = FakeObject(
+            storage_accounts=self.storage_accounts)
+
+    def test_keys_are_cached(self):
+        self.assertEqual(self.cache.get_key('account'), 'group_account_key_1')
+        self.assertEqual(self.cache.get_key('account'), 'group_account_key_1')
+        self.assertEqual(self.cache.get_key('other'), 'group_other_key_2')
+        self.assertEqual(self.storage_accounts.calls,
+                         {'list': 1, 'list_keys': 2})
+
+    def test_invalidate(self):
+        self.cache.get_key('account')
+        self.cache.invalidate('account')
+        self.assertEqual(self.cache.get_key('account'), 'group_account_key_2')
+        self.assertEqual(self.storage_accounts.calls['list'], 1)
+        self.cache.invalidate()
+        self.cache.get_key('account')
+        self.assertEqual(self.storage_accounts.calls['list'], 2)
+
+    def test_expiry(self):
+        self.cache.ttl = -1
+        self.cache.get_key('account')
+        self.assertEqual(self.cache.get_key('account'), 'group_account_key_2')
+
+    def test_unknown_account(self):
+        with self.assertRaises(ValueError):
+            self.cache.get_key('unknown')
+
+
+class OutputFileReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.files = self.client.jobs.output_files
+        self.session = FakeSession(self.files)
+        self.reader = OutputFileReader(
+            self.client, 'group', 'workspace', 'experiment', 'job',
+            STDOUTERR_DIRECTORY_ID, 'stdout.txt', throttle=make_throttle(),
+            session=self.session)
+        self.url = output_file_url('job', STDOUTERR_DIRECTORY_ID,
+                                   'stdout.txt')
+
+    def test_missing_file(self):
+        self.assertIsNone(self.reader.read())
+
+    def test_incremental_reads(self):
+        self.files[self.url] = b'ab'
+        self.assertEqual(self.reader.read(), 'ab')
+        self.assertEqual(self.reader.read(), '')
+        self.files[self.url] = b'abcd'
+        self.assertEqual(self.reader.read(), 'cd')
+        self.assertEqual(self.client.jobs.calls['list_output_files'], 1)
+        self.assertEqual(self.session.timeouts, [DOWNLOAD_TIMEOUT] * 3)
+
+    def test_split_character(self):
+        self.files[self.url] = b'x\xc3'
+        self.assertEqual(self.reader.read(), 'x')
+        self.files[self.url] = b'x\xc3\xa9\xc3'
+        self.assertEqual(self.reader.read(), u'\xe9')
+        self.assertEqual(self.reader.read(final=True), u'\ufffd')
+
+    def test_retry_timeouts(self):
+        self.files[self.url] = b'ab'
+        self.session.errors = [requests.exceptions.ConnectTimeout(),
+                               requests.exceptions.ReadTimeout(),
+                               requests.exceptions.ConnectionError()]
+        self.assertEqual(self.reader.read(), 'ab')
+        self.assertEqual(len(self.session.timeouts), 4)
+
+    def test_give_up_after_max_retries(self):
+        self.files[self.url] = b'ab'
+        self.session.errors = [requests.exceptions.ReadTimeout()
+                               for _ in range(6)]
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.reader.read()
+        self.assertEqual(self.reader.read(), 'ab')
+
+    def test_non_retryable_error(self):
+        self.files[self.url] = b'ab'
+        self.session.errors = [requests.exceptions.InvalidURL()]
+        with self.assertRaises(requests.exceptions.InvalidURL):
+            self.reader.read()
+        self.assertEqual(len(self.session.timeouts), 1)
+
+
+class OutputFilesTestCase(unittest.TestCase):
+    """
+    Serves the output files of self.jobs over the shared HTTP session.
+    """
+
+    def setUp(self):
+        self.experiment_utils = make_experiment_utils()
+        self.client = self.experiment_utils.client
+        self.jobs = self.client.jobs
+        self.session = FakeSession(self.jobs.output_files)
+        self.shared_session = job_module._session
+        job_module._session = self.session
+
+    def tearDown(self):
+        job_module._session = self.shared_session
+
+    def set_output(self, job_name, output, file_name='stdout.txt',
+                   directory='.'):
+        self.jobs.output_files[output_file_url(
+            job_name, STDOUTERR_DIRECTORY_ID, file_name, directory)] = output
+
+
+class JobOutputTailerTest(OutputFilesTestCase):
+    def setUp(self):
+        super(JobOutputTailerTest, self).setUp()
+        self.lines = []
+        self.tailer = JobOutputTailer(
+            self.experiment_utils, file_names=('stdout.txt',),
+            callback=lambda *args: self.lines.append(args), min_interval=0,
+            max_interval=0)
+
+    def tearDown(self):
+        self.tailer.close()
+        super(JobOutputTailerTest, self).tearDown()
+
+    def add_job(self, name, execution_state, output):
+        self.jobs.job_list.add(make_job(name,
+                                        execution_state=execution_state))
+        self.set_output(name, output)
+
+    def test_lines(self):
+        self.add_job('job', models.ExecutionState.running, b'hel')
+        self.add_job('queued', models.ExecutionState.queued, b'queued\n')
+        self.tailer.poll()
+        self.assertEqual(self.lines, [])
+        self.add_job('job', models.ExecutionState.running, b'hello\nwor')
+        self.tailer.poll()
+        self.assertEqual(self.lines, [('job', 'stdout.txt', ['hello'])])
+        self.add_job('job', models.ExecutionState.succeeded, b'hello\nworld')
+        self.tailer.poll()
+        self.assertEqual(self.lines[1:], [('job', 'stdout.txt', ['world'])])
+        self.tailer.poll()
+        self.assertEqual(len(self.lines), 2)
+
+    def test_run_until_completed(self):
+        self.add_job('a', models.ExecutionState.succeeded, b'a\n')
+        self.add_job('b', models.ExecutionState.failed, b'b')
+        self.tailer.run(timeout=5)
+        self.assertEqual(sorted(self.lines), [('a', 'stdout.txt', ['a']),
+                                              ('b', 'stdout.txt', ['b'])])
+
+    def test_timeout_is_retried(self):
+        self.add_job('job', models.ExecutionState.running, b'line\n')
+        self.session.errors = [requests.exceptions.ReadTimeout()]
+        self.tailer.poll()
+        self.assertEqual(self.lines, [('job', 'stdout.txt', ['line'])])
+
+    def test_failed_final_read_is_retried(self):
+        self.add_job('job', models.ExecutionState.succeeded, b'line')
+        self.session.errors = [requests.exceptions.InvalidURL()]
+        self.tailer.poll()
+        self.assertEqual(self.lines, [])
+        self.tailer.poll()
+        self.assertEqual(self.lines, [('job', 'stdout.txt', ['line'])])
+
+
+class MetricExtractorTest(OutputFilesTestCase):
+    def make_extractor(self, regex='loss=([0-9.]+)', calculate_method='last'):
+        return MetricExtractor(STDOUTERR_DIRECTORY_ID, 'stdout.txt', regex,
+                               calculate_method)
+
+    def get_metric(self, extractor, creation_time=None):
+        return extractor.get_metric(
+            'job', 'group', 'workspace', 'experiment', self.client,
+            throttle=make_throttle(), creation_time=creation_time)
+
+    def get_new_values(self, extractor, final=False):
+        return extractor.get_new_values(
+            'job', 'group', 'workspace', 'experiment', self.client,
+            throttle=make_throttle(), final=final)
+
+    def test_aggregates(self):
+        self.set_output('job', b'loss=4\nacc=1\nloss=2\nloss=3')
+        for calculate_method, value in [('last', 3), ('mean', 3), ('min', 2),
+                                        ('max', 4)]:
+            self.assertEqual(
+                self.get_metric(self.make_extractor(
+                    calculate_method=calculate_method)),
+                value, calculate_method)
+
+    def test_whole_match_without_group(self):
+        self.set_output('job', b'loss=4 acc=0.5\n')
+        self.assertEqual(self.get_metric(self.make_extractor(
+            regex='(?<=acc=)[0-9.]+')), 0.5)
+
+    def test_regex_with_several_groups(self):
+        with self.assertRaises(ValueError):
+            self.make_extractor(regex='(loss)=([0-9.]+)')
+
+    def test_missing_metric(self):
+        extractor = self.make_extractor()
+        self.assertEqual(self.get_metric(extractor), float('inf'))
+        self.set_output('job', b'acc=1\n')
+        self.assertEqual(self.get_metric(extractor), float('inf'))
+
+    def test_incremental_reads(self):
+        extractor = self.make_extractor(calculate_method='mean')
+        self.set_output('job', b'loss=4\nloss=')
+        self.assertEqual(self.get_new_values(extractor), [4])
+        self.set_output('job', b'loss=4\nloss=2\nloss=6')
+        self.assertEqual(self.get_new_values(extractor), [2])
+        self.assertEqual(self.get_metric(extractor), 4)
+        self.assertEqual(self.get_new_values(extractor, final=True), [6])
+        self.assertEqual(self.get_metric(extractor), 4)
+        self.assertEqual(len(self.session.timeouts), 5)
+
+    def test_resubmitted_job_is_read_again(self):
+        extractor = self.make_extractor(calculate_method='min')
+        self.set_output('job', b'loss=1\n')
+        self.assertEqual(self.get_metric(extractor, datetime.datetime(
+            2018, 1, 1, 0)), 1)
+        self.set_output('job', b'loss=3\n')
+        self.assertEqual(self.get_metric(extractor, datetime.datetime(
+            2018, 1, 1, 1)), 3)
+        self.set_output('job', b'loss=5\n')
+        extractor.reset('job')
+        self.assertEqual(self.get_metric(extractor), 5)
+
+
+class TimeSeriesExtractorTest(OutputFilesTestCase):
+    PATTERNS = [r'step (?P<step>\d+): loss=(?P<loss>[0-9.]+)',
+                r'acc=(?P<acc>[0-9.]+)']
+
+    def make_extractor(self, patterns=PATTERNS, **kwargs):
+        return TimeSeriesExtractor(STDOUTERR_DIRECTORY_ID, 'stdout.txt',
+                                   patterns, **kwargs)
+
+    def get_series(self, extractor, final=False):
+        return extractor.get_series(
+            'job', 'group', 'workspace', 'experiment', self.client,
+            throttle=make_throttle(), final=final)
+
+    def assert_series(self, series, expected):
+        self.assertEqual(sorted(series), sorted(expected))
+        for name, values in expected.items():
+            np.testing.assert_array_equal(series[name], values)
+
+    def test_patterns(self):
+        self.set_output('job', b'start\nstep 1: loss=4 acc=0.5\n'
+                               b'step 2: loss=3\nacc=0.7\nstep 3: lo')
+        extractor = self.make_extractor()
+        self.assert_series(self.get_series(extractor), {
+            'step': [1, 2, np.nan], 'loss': [4, 3, np.nan],
+            'acc': [0.5, np.nan, 0.7]})
+        self.set_output('job', b'start\nstep 1: loss=4 acc=0.5\n'
+                               b'step 2: loss=3\nacc=0.7\nstep 3: loss=1')
+        self.assert_series(self.get_series(extractor, final=True), {
+            'step': [1, 2, np.nan, 3], 'loss': [4, 3, np.nan, 1],
+            'acc': [0.5, np.nan, 0.7, np.nan]})
+
+    def test_json_lines(self):
+        self.set_output('job', b'{"step": 1, "loss": 2.5, "tag": "a"}\n'
+                               b'{"step": 2, "done": true}\n'
+                               b'{not json}\nacc=0.5\n')
+        extractor = self.make_extractor(patterns=None, json_lines=True)
+        self.assert_series(self.get_series(extractor), {
+            'step': [1, 2], 'loss': [2.5, np.nan]})
+        extractor = self.make_extractor(patterns=self.PATTERNS[1:],
+                                        json_lines=True)
+        self.assertEqual(len(self.get_series(extractor)['acc']), 3)
+
+    def test_metric(self):
+        extractor = self.make_extractor(metric='loss',
+                                        calculate_method='min')
+        self.assertEqual(extractor.get_metric(
+            'job', 'group', 'workspace', 'experiment', self.client,
+            throttle=make_throttle()), float('inf'))
+        self.set_output('job', b'step 1: loss=4\nacc=1\nstep 2: loss=2')
+        self.assertEqual(extractor.get_new_values(
+            'job', 'group', 'workspace', 'experiment', self.client,
+            throttle=make_throttle()), [4])
+        # The incomplete last line counts
+        self.assertEqual(extractor.get_metric(
+            'job', 'group', 'workspace', 'experiment', self.client,
+            throttle=make_throttle()), 2)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            self.make_extractor(patterns=None)
+        with self.assertRaises(ValueError):
+            self.make_extractor(patterns=r'loss=([0-9.]+)')
+        with self.assertRaises(ValueError):
+            self.make_extractor(calculate_method='median')
+        with self.assertRaises(ValueError):
+            self.make_extractor().get_metric(
+                'job', 'group', 'workspace', 'experiment', self.client)
+
+    def test_table(self):
+        job = make_job('job', execution_state=models.ExecutionState.succeeded)
+        packed = make_job('packed',
+                          execution_state=models.ExecutionState.succeeded)
+        packed.environment_variables = [models.EnvironmentVariable(
+            name=TRIALS_ENV_VAR, value=json.dumps([{}, {}]))]
+        for j in [job, packed]:
+            self.jobs.job_list.add(j)
+        self.set_output('job', b'step 1: loss=4\nstep 2: loss=3\n')
+        self.set_output('packed', b'acc=0.5', directory='trial_0')
+        self.set_output('packed', b'step 1: loss=2\n', directory='trial_1')
+        table = self.experiment_utils.get_metrics_for_jobs(
+            [job, packed], self.make_extractor(), table=True)
+        self.assertEqual(list(table['job_name']),
+                         ['job', 'job', 'packed', 'packed'])
+        self.assertEqual(list(table['trial']), [-1, -1, 0, 1])
+        np.testing.assert_array_equal(table['loss'], [4, 3, np.nan, 2])
+        np.testing.assert_array_equal(table['acc'],
+                                      [np.nan, np.nan, 0.5, np.nan])
+        with self.assertRaises(ValueError):
+            self.experiment_utils.get_metrics_for_jobs(
+                [job], MetricExtractor(STDOUTERR_DIRECTORY_ID, 'stdout.txt',
+                                       'loss=([0-9.]+)'), table=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import azure.mgmt.batchai.models as models
+
+from utilities.job_factory import DictParameter, DiscreteParameter, \
+    ParameterSweep, _compile_template_regex, _Template, get_packed_trials
+
+
+def make_template():
+    """
+    :return: JobCreateParameters whose command line depends on the
+    parameters MODEL, DEPTH and WIDTH
+    """
+    return models.JobCreateParameters(
+        cluster=models.ResourceId(id='cluster'), node_count=1,
+        std_out_err_path_prefix='$AZ_BATCHAI_MOUNT_ROOT/output',
+        custom_toolkit_settings=models.CustomToolkitSettings(
+            command_line='train.py --model PARAM_MODEL '
+                         '--depth PARAM_DEPTH --width PARAM_WIDTH'))
+
+
+class GridViewTest(unittest.TestCase):
+    def setUp(self):
+        self.parameter_sweep = ParameterSweep([
+            DiscreteParameter('MODEL', ['a', 'b']),
+            DiscreteParameter('DEPTH', [1, 2, 3]),
+            DiscreteParameter('WIDTH', [8, 16])])
+        self.jcp = make_template()
+
+    def test_same_order_as_generate_jobs(self):
+        _, param_dicts = self.parameter_sweep.generate_jobs(self.jcp)
+        grid = self.parameter_sweep.grid()
+        self.assertEqual(len(grid), 12)
+        self.assertEqual(list(grid), param_dicts)
+        self.assertEqual(grid[-1], param_dicts[-1])
+        with self.assertRaises(IndexError):
+            grid[12]
+
+    def test_jobs(self):
+        jcps, _ = self.parameter_sweep.generate_jobs(self.jcp)
+        grid = self.parameter_sweep.grid(self.jcp)
+        self.assertEqual(
+            [jcp.custom_toolkit_settings.command_line for jcp in grid],
+            [jcp.custom_toolkit_settings.command_line for jcp in jcps])
+        self.assertEqual(
+            {ev.name: ev.value for ev in grid[5].environment_variables},
+            {'PARAM_MODEL': 'a', 'PARAM_DEPTH': '3', 'PARAM_WIDTH': '16'})
+        self.assertEqual(self.jcp.custom_toolkit_settings.command_line,
+                         make_template().custom_toolkit_settings.command_line)
+
+    def test_slices(self):
+        param_dicts = list(self.parameter_sweep.grid())
+        grid = self.parameter_sweep.grid()
+        self.assertEqual(list(grid[3:10:2]), param_dicts[3:10:2])
+        self.assertEqual(list(grid[3:10:2][1::2]), param_dicts[3:10:2][1::2])
+        self.assertEqual(len(grid[10:3]), 0)
+        with self.assertRaises(ValueError):
+            grid[::-1]
+
+    def test_shards(self):
+        grid = self.parameter_sweep.grid()
+        shards = [list(grid.shard(i, 5)) for i in range(5)]
+        self.assertEqual([len(shard) for shard in shards], [2, 2, 3, 2, 3])
+        self.assertEqual(sum(shards, []), list(grid))
+        with self.assertRaises(ValueError):
+            grid.shard(5, 5)
+
+    def test_plan_is_compiled_once(self):
+        compiled = []
+        compile_substitution_plan = \
+            self.parameter_sweep.compile_substitution_plan
+
+        def count_compilations(job_create_parameters):
+            compiled.append(job_create_parameters)
+            return compile_substitution_plan(job_create_parameters)
+        self.parameter_sweep.compile_substitution_plan = count_compilations
+        grid = self.parameter_sweep.grid(self.jcp)
+        self.assertEqual(len(list(grid)), 12)
+        self.assertEqual(len(list(grid.shard(1, 3))), 4)
+        self.assertEqual(compiled, [self.jcp])
+
+    def test_dict_parameter(self):
+        parameter_sweep = ParameterSweep([
+            DictParameter('OPTIMIZER', [{'NAME': 'sgd', 'LR': 0.1},
+                                        {'NAME': 'adam', 'LR': 0.001}])])
+        self.assertEqual(parameter_sweep.grid()[1],
+                         {'PARAM_OPTIMIZER__NAME': 'adam',
+                          'PARAM_OPTIMIZER__LR': 0.001})
+
+
+class SubstitutionPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.parameter_sweep = ParameterSweep([
+            DiscreteParameter('MODEL', ['a']),
+            DiscreteParameter('DEPTH', [2]),
+            DiscreteParameter('WIDTH', [8])])
+        self.jcp = make_template()
+        self.jcp.node_count = self.parameter_sweep.DEPTH
+        self.param_dict = {'PARAM_MODEL': 'a', 'PARAM_DEPTH': 2,
+                           'PARAM_WIDTH': 8}
+
+    def test_substitute(self):
+        jcp = self.parameter_sweep.create_job(self.jcp, self.param_dict)
+        self.assertEqual(jcp.custom_toolkit_settings.command_line,
+                         'train.py --model a --depth 2 --width 8')
+        self.assertEqual(jcp.node_count, 2)
+        self.assertEqual(jcp.std_out_err_path_prefix,
+                         '$AZ_BATCHAI_MOUNT_ROOT/output')
+        self.assertEqual(sorted(ev.name for ev in jcp.environment_variables),
+                         sorted(self.param_dict))
+
+    def test_only_substituted_objects_are_copied(self):
+        plan = self.parameter_sweep.compile_substitution_plan(self.jcp)
+        jcp = self.parameter_sweep.create_job(self.jcp, self.param_dict,
+                                              plan)
+        self.assertIs(jcp.cluster, self.jcp.cluster)
+        self.assertIsNot(jcp.custom_toolkit_settings,
+                         self.jcp.custom_toolkit_settings)
+        self.assertIs(self.jcp.node_count, self.parameter_sweep.DEPTH)
+        self.assertIn('PARAM_MODEL',
+                      self.jcp.custom_toolkit_settings.command_line)
+
+    def test_generate_jobs_from_param_dicts(self):
+        jcps, _ = self.parameter_sweep.generate_jobs_from_param_dicts(
+            self.jcp, [self.param_dict, dict(self.param_dict, PARAM_DEPTH=4)])
+        self.assertEqual([jcp.node_count for jcp in jcps], [2, 4])
+
+
+class TemplateTest(unittest.TestCase):
+    def setUp(self):
+        self.regex = _compile_template_regex(
+            ['PARAM_LR', 'PARAM_LR_DECAY', 'PARAM_NAME'])
+
+    def render(self, string, param_dict):
+        return _Template(string, self.regex).render(param_dict)
+
+    def test_longest_name_is_substituted(self):
+        self.assertEqual(
+            self.render('--lr=PARAM_LR --decay=PARAM_LR_DECAY',
+                        {'PARAM_LR': 0.1, 'PARAM_LR_DECAY': 0.9}),
+            '--lr=0.1 --decay=0.9')
+
+    def test_values_are_not_substituted_again(self):
+        self.assertEqual(
+            self.render('PARAM_NAME PARAM_LR',
+                        {'PARAM_NAME': 'PARAM_LR', 'PARAM_LR': 0.1}),
+            'PARAM_LR 0.1')
+
+    def test_names(self):
+        template = _Template('PARAM_LR_DECAY/PARAM_LR/PARAM_LR', self.regex)
+        self.assertEqual(template.names,
+                         ['PARAM_LR_DECAY', 'PARAM_LR', 'PARAM_LR'])
+        self.assertEqual(_Template('no parameters', self.regex).names, [])
+
+    def test_dict_parameter_names(self):
+        parameter_sweep = ParameterSweep([
+            DiscreteParameter('LR', [0.1]),
+            DictParameter('LR_SCHEDULE', [{'DECAY': 0.9}])])
+        jcp = make_template()
+        jcp.custom_toolkit_settings.command_line = \
+            'train.py PARAM_LR PARAM_LR_SCHEDULE__DECAY'
+        jcps, _ = parameter_sweep.generate_jobs(jcp)
+        self.assertEqual(jcps[0].custom_toolkit_settings.command_line,
+                         'train.py 0.1 0.9')
+
+
+class PackedJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.parameter_sweep = ParameterSweep([
+            DiscreteParameter('MODEL', ['a', 'b']),
+            DiscreteParameter('DEPTH', [1, 2, 3])])
+        self.jcp = make_template()
+        self.jcp.output_directories = [models.OutputDirectory(
+            id='OUT', path_prefix='$AZ_BATCHAI_MOUNT_ROOT/out')]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_job(self, jcp):
+        """
+        :return: the exit status of the command line of jcp, run with its
+        environment variables and the output directory OUT
+        """
+        env = dict(os.environ, AZ_BATCHAI_OUTPUT_OUT=self.directory)
+        env.update((ev.name, ev.value) for ev in jcp.environment_variables)
+        return subprocess.call(
+            ['bash', '-c', jcp.custom_toolkit_settings.command_line],
+            env=env)
+
+    def read_output(self, trial):
+        with open(os.path.join(self.directory, 'trial_{0}'.format(trial),
+                               'out.txt')) as f:
+            return f.read()
+
+    def test_groups(self):
+        jcps, param_dict_groups = self.parameter_sweep.generate_packed_jobs(
+            self.jcp, trials_per_job=4)
+        self.assertEqual([len(group) for group in param_dict_groups], [4, 2])
+        self.assertEqual([get_packed_trials(jcp) for jcp in jcps],
+                         param_dict_groups)
+        self.assertEqual(
+            {ev.name: ev.value for ev in jcps[1].environment_variables}[
+                'PARAM_NUM_TRIALS'], '2')
+
+    def test_trials_run_with_own_parameters_and_output(self):
+        self.jcp.custom_toolkit_settings.command_line = \
+            'echo -n PARAM_MODEL PARAM_DEPTH $PARAM_TRIAL_INDEX ' \
+            '> $AZ_BATCHAI_OUTPUT_OUT/out.txt'
+        for parallel in [False, True]:
+            jcps, _ = self.parameter_sweep.generate_packed_jobs(
+                self.jcp, trials_per_job=3, parallel=parallel)
+            self.assertEqual(self.run_job(jcps[1]), 0)
+            self.assertEqual([self.read_output(i) for i in range(3)],
+                             ['b 1 0', 'b 2 1', 'b 3 2'])
+
+    def test_failed_trial_fails_job(self):
+        self.jcp.custom_toolkit_settings.command_line = \
+            'test PARAM_DEPTH != 2'
+        for parallel in [False, True]:
+            jcps, _ = self.parameter_sweep.generate_packed_jobs(
+                self.jcp, trials_per_job=3, parallel=parallel)
+            self.assertNotEqual(self.run_job(jcps[0]), 0)
+
+    def test_only_single_node_custom_toolkit_jobs_are_packed(self):
+        self.jcp.node_count = 2
+        with self.assertRaises(ValueError):
+            self.parameter_sweep.generate_packed_jobs(self.jcp, 2)
+        self.jcp.node_count = 1
+        self.jcp.custom_toolkit_settings = None
+        self.jcp.tensor_flow_settings = models.TensorFlowSettings(
+            python_script_file_path='train.py')
+        with self.assertRaises(ValueError):
+            self.parameter_sweep.generate_packed_jobs(self.jcp, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
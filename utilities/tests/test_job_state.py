@@ -0,0 +1,273 @@
+from __future__ import print_function
+
+import concurrent.futures
+import datetime
+import time
+import unittest
+
+import azure.mgmt.batchai.models as models
+from msrest.exceptions import ClientRequestError
+
+from utilities.job_state import BatchOperationPoller, JobStateCache, \
+    JobWatcher
+from utilities.tests.fakes import FakeJobList, FakeObject, cloud_error, \
+    make_experiment_utils, make_jcp, make_job, make_throttle
+
+QUEUED = models.ExecutionState.queued
+RUNNING = models.ExecutionState.running
+SUCCEEDED = models.ExecutionState.succeeded
+FAILED = models.ExecutionState.failed
+TIMEOUT_SECS = 5
+
+
+def set_run_time(job, seconds, completed=False):
+    """Make job report that it started running seconds ago."""
+    now = datetime.datetime.now()
+    job.execution_info = FakeObject(
+        start_time=now - datetime.timedelta(seconds=seconds),
+        end_time=now if completed else None)
+
+
+class JobWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.job_list = FakeJobList([make_job('a'), make_job('b')])
+        self.watcher = JobWatcher(self.job_list.list_jobs, min_interval=1,
+                                  max_interval=4)
+
+    def set_state(self, job_name, state):
+        self.job_list.add(make_job(job_name, execution_state=state))
+
+    def test_state_changes(self):
+        changes = self.watcher.poll()
+        self.assertEqual(sorted((c.job_name, c.old_state, c.new_state)
+                                for c in changes),
+                         [('a', None, QUEUED), ('b', None, QUEUED)])
+        self.assertEqual(self.watcher.poll(), [])
+        self.set_state('a', RUNNING)
+        self.job_list.remove('b')
+        changes = self.watcher.poll()
+        self.assertEqual(sorted((c.job_name, c.old_state, c.new_state)
+                                for c in changes),
+                         [('a', QUEUED, RUNNING), ('b', QUEUED, None)])
+        self.assertEqual(self.watcher.state_counts[RUNNING], 1)
+        self.assertEqual(self.watcher.state_counts[QUEUED], 0)
+
+    def test_completion(self):
+        self.watcher.poll()
+        self.set_state('a', SUCCEEDED)
+        self.watcher.poll()
+        self.assertFalse(self.watcher.all_completed())
+        self.set_state('b', FAILED)
+        self.watcher.poll()
+        self.assertTrue(self.watcher.all_completed())
+        self.assertEqual(self.watcher.num_completed, 2)
+
+    def test_watch_some_jobs(self):
+        watcher = JobWatcher(self.job_list.list_jobs, job_names=['a'])
+        self.assertEqual([c.job_name for c in watcher.poll()], ['a'])
+        self.assertEqual(list(watcher.jobs), ['a'])
+
+    def test_interval_backoff(self):
+        self.watcher.poll()
+        self.assertEqual(self.watcher.interval, 1)
+        for _ in range(5):
+            self.watcher.poll()
+        self.assertEqual(self.watcher.interval, 4)
+        self.set_state('a', RUNNING)
+        self.watcher.poll()
+        self.assertEqual(self.watcher.interval, 1)
+
+    def test_expected_completion_keeps_interval_short(self):
+        done = make_job('a', execution_state=SUCCEEDED)
+        set_run_time(done, 100, completed=True)
+        running = make_job('b', execution_state=RUNNING)
+        set_run_time(running, 90)
+        self.job_list.add(done)
+        self.job_list.add(running)
+        self.watcher.poll()
+        self.watcher.poll()
+        self.assertEqual(self.watcher.interval, 1)
+
+    def test_straggler_does_not_keep_interval_short(self):
+        done = make_job('a', execution_state=SUCCEEDED)
+        set_run_time(done, 100, completed=True)
+        running = make_job('b', execution_state=RUNNING)
+        set_run_time(running, 1000)
+        self.job_list.add(done)
+        self.job_list.add(running)
+        self.watcher.poll()
+        self.watcher.poll()
+        self.assertGreater(self.watcher.interval, 1)
+
+    def test_events(self):
+        watcher = JobWatcher(self.job_list.list_jobs, min_interval=0.01,
+                             max_interval=0.01)
+        events = watcher.events(timeout=5)
+        self.assertEqual(len([next(events), next(events)]), 2)
+        self.set_state('a', SUCCEEDED)
+        self.set_state('b', FAILED)
+        self.assertEqual(sorted(c.new_state for c in events),
+                         [FAILED, SUCCEEDED])
+
+    def test_events_timeout(self):
+        started = time.time()
+        self.assertEqual(len(list(self.watcher.events(timeout=0.2))), 2)
+        self.assertGreaterEqual(time.time() - started, 0.19)
+        self.assertLess(time.time() - started, 0.9)
+
+
+class WaitAllJobsTest(unittest.TestCase):
+    def test_timeout_shorter_than_poll_interval(self):
+        experiment_utils = make_experiment_utils()
+        experiment_utils.client.jobs.job_list.add(make_job('job'))
+        started = time.time()
+        jobs = experiment_utils.wait_all_jobs(timeout=0.2)
+        self.assertEqual([job.name for job in jobs], ['job'])
+        self.assertGreaterEqual(time.time() - started, 0.19)
+        self.assertLess(time.time() - started, 0.9)
+
+    def test_completed(self):
+        experiment_utils = make_experiment_utils()
+        experiment_utils.client.jobs.job_list.add(
+            make_job('job', execution_state=SUCCEEDED))
+        jobs = experiment_utils.wait_all_jobs(timeout=5)
+        self.assertEqual(jobs[0].execution_state, SUCCEEDED)
+
+
+class JobStateCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.job_list = FakeJobList([make_job('listed')])
+        self.cache = JobStateCache(self.job_list.list_jobs, max_staleness=60)
+
+    def names(self, jobs):
+        return sorted(job.name for job in jobs)
+
+    def test_reuse_listing(self):
+        self.assertEqual(self.names(self.cache.get_jobs()), ['listed'])
+        self.assertEqual(self.cache.get('listed').name, 'listed')
+        self.assertEqual(self.job_list.num_listings, 1)
+        self.assertEqual(self.names(self.cache.get_jobs(max_staleness=0)),
+                         ['listed'])
+        self.assertEqual(self.job_list.num_listings, 2)
+        self.cache.invalidate()
+        self.cache.get_jobs()
+        self.assertEqual(self.job_list.num_listings, 3)
+
+    def test_local_changes(self):
+        self.cache.get_jobs()
+        self.cache.put(make_job('created'))
+        self.cache.remove('listed')
+        self.assertEqual(self.names(self.cache.get_jobs()), ['created'])
+        self.assertEqual(self.job_list.num_listings, 1)
+
+    def test_local_changes_survive_older_listing(self):
+        listings = []
+
+        def list_jobs():
+            # The job is created while the listing is in progress
+            if not listings:
+                self.cache.put(make_job('created'))
+            listings.append(None)
+            return self.job_list.list_jobs()
+        self.cache = JobStateCache(list_jobs)
+        self.assertEqual(self.names(self.cache.refresh()),
+                         ['created', 'listed'])
+        self.assertEqual(self.names(self.cache.refresh()), ['listed'])
+
+    def test_accepted_create_is_cached(self):
+        experiment_utils = make_experiment_utils()
+        job_list = experiment_utils.client.jobs.job_list
+        self.assertEqual(experiment_utils.job_cache.get_jobs(), [])
+        experiment_utils._submit_job('job', make_jcp(0), track=False)
+        job = experiment_utils.job_cache.get('job')
+        self.assertEqual(job.provisioning_state,
+                         models.ProvisioningState.creating)
+        self.assertEqual(job_list.num_listings, 1)
+        job = experiment_utils.job_cache.get('job', max_staleness=0)
+        self.assertEqual(job.provisioning_state,
+                         models.ProvisioningState.succeeded)
+
+
+class BatchOperationPollerTest(unittest.TestCase):
+    def setUp(self):
+        self.job_list = FakeJobList()
+        self.job_cache = JobStateCache(self.job_list.list_jobs)
+        self.poller = BatchOperationPoller(
+            self.job_cache, interval=0.01, timeout=TIMEOUT_SECS,
+            throttle=make_throttle())
+
+    def test_create(self):
+        future = self.poller.track_create('job')
+        self.job_list.add(make_job(
+            'job', provisioning_state=models.ProvisioningState.creating))
+        self.poller.poll()
+        self.assertFalse(future.done())
+        self.job_list.add(make_job('job'))
+        self.assertEqual(future.result(TIMEOUT_SECS).name, 'job')
+        self.assertEqual(self.poller.num_pending, 0)
+
+    def test_failed_create(self):
+        future = self.poller.track_create('job')
+        self.job_list.add(make_job(
+            'job', provisioning_state=models.ProvisioningState.failed))
+        with self.assertRaises(RuntimeError):
+            future.result(TIMEOUT_SECS)
+
+    def test_delete(self):
+        self.job_list.add(make_job('job'))
+        future = self.poller.track_delete('job')
+        self.poller.poll()
+        self.assertFalse(future.done())
+        self.job_list.remove('job')
+        self.assertIsNone(future.result(TIMEOUT_SECS))
+
+    def test_same_operation_is_tracked_once(self):
+        future = self.poller.track_create('job')
+        self.assertIs(self.poller.track_create('job'), future)
+        self.assertEqual(self.poller.num_pending, 1)
+
+    def test_create_supersedes_delete(self):
+        self.job_list.add(make_job('job'))
+        deleted = self.poller.track_delete('job')
+        created = self.poller.track_create('job')
+        self.assertIsNone(deleted.result(0))
+        self.assertEqual(created.result(TIMEOUT_SECS).name, 'job')
+
+    def test_delete_supersedes_create(self):
+        created = self.poller.track_create('job')
+        deleted = self.poller.track_delete('job')
+        with self.assertRaises(RuntimeError):
+            created.result(0)
+        self.assertIsNone(deleted.result(TIMEOUT_SECS))
+
+    def test_retry_failed_listing(self):
+        self.job_list.errors = [cloud_error(503), ClientRequestError('reset')]
+        self.job_list.add(make_job('job'))
+        future = self.poller.track_create('job')
+        self.assertEqual(future.result(TIMEOUT_SECS).name, 'job')
+        self.assertGreaterEqual(self.job_list.num_listings, 3)
+
+    def test_non_retryable_listing_error(self):
+        error = cloud_error(403)
+        self.job_list.errors = [error]
+        future = self.poller.track_create('job')
+        self.assertIs(future.exception(TIMEOUT_SECS), error)
+        self.assertEqual(self.poller.num_pending, 0)
+
+    def test_timeout(self):
+        self.poller.timeout = 0.05
+        future = self.poller.track_create('job')
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            future.result(TIMEOUT_SECS)
+
+    def test_timeout_while_listing_fails(self):
+        self.poller.timeout = 0.05
+        error = cloud_error(503)
+        self.job_list.errors = [error for _ in range(100)]
+        future = self.poller.track_create('job')
+        self.assertIs(future.exception(TIMEOUT_SECS), error)
+        self.assertEqual(self.poller.num_pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
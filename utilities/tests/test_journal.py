@@ -0,0 +1,111 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from utilities.journal import CONFIRMED, INTENT, SUBMITTED, \
+    SubmissionJournal
+from utilities.tests.fakes import make_experiment_utils, make_jcp
+
+TIMEOUT_SECS = 10
+
+
+class SubmissionJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal.db')
+        self.journal = SubmissionJournal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_states(self):
+        self.assertIsNone(self.journal.get_state('job'))
+        self.journal.record_intent('job')
+        self.assertEqual(self.journal.get_state('job'), INTENT)
+        self.journal.record_submitted('job')
+        self.assertEqual(self.journal.get_state('job'), SUBMITTED)
+        self.journal.record_confirmed('job')
+        self.assertEqual(self.journal.get_state('job'), CONFIRMED)
+
+    def test_get_job_names(self):
+        self.journal.record_intent('a')
+        self.journal.record_submitted('b')
+        self.journal.record_submitted('c')
+        self.assertEqual(sorted(self.journal.get_job_names()),
+                         ['a', 'b', 'c'])
+        self.assertEqual(sorted(self.journal.get_job_names(SUBMITTED)),
+                         ['b', 'c'])
+        self.assertEqual(self.journal.get_job_names(CONFIRMED), [])
+
+    def test_remove(self):
+        self.journal.record_confirmed('job')
+        self.journal.remove('job')
+        self.assertIsNone(self.journal.get_state('job'))
+        self.journal.remove('job')
+
+    def test_reopen(self):
+        self.journal.record_submitted('job')
+        self.journal.close()
+        self.journal = SubmissionJournal(self.path)
+        self.assertEqual(self.journal.get_state('job'), SUBMITTED)
+
+
+class ResumeSubmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = SubmissionJournal(
+            os.path.join(self.directory, 'journal.db'))
+        self.experiment_utils = make_experiment_utils()
+        self.jobs = self.experiment_utils.client.jobs
+        self.jcps = [make_jcp(i) for i in range(3)]
+        self.names = [self.experiment_utils.get_job_name(jcp, 'prefix')
+                      for jcp in self.jcps]
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def submit(self):
+        return self.experiment_utils.submit_jobs(
+            self.jcps, 'prefix', journal=self.journal).result(TIMEOUT_SECS)
+
+    def test_skip_created_jobs(self):
+        self.assertEqual(len(self.submit()), 3)
+        self.assertEqual(sorted(self.journal.get_job_names(CONFIRMED)),
+                         sorted(self.names))
+        self.assertEqual(self.submit(), [])
+        self.assertEqual(self.jobs.calls['create'], 3)
+        self.assertEqual(self.jobs.calls['get'], 0)
+
+    def test_intent_is_recorded_before_create(self):
+        states = []
+        create = self.jobs.create
+
+        def record_state(*args, **kwargs):
+            states.append(self.journal.get_state(args[3]))
+            return create(*args, **kwargs)
+        self.jobs.create = record_state
+        self.submit()
+        self.assertEqual(states, [INTENT] * 3)
+
+    def test_look_up_jobs_which_may_have_been_sent(self):
+        # The first job was created, but the journal was not updated after
+        # its request was sent; the second was not sent.
+        self.experiment_utils._submit_job(self.names[0], self.jcps[0],
+                                          track=False)
+        self.journal.record_intent(self.names[0])
+        self.journal.record_intent(self.names[1])
+        jobs = self.submit()
+        self.assertEqual(sorted(job.name for job in jobs),
+                         sorted(self.names[1:]))
+        self.assertEqual(self.jobs.calls['create'], 3)
+        self.assertEqual(self.jobs.calls['get'], 2)
+        self.assertEqual(self.journal.get_state(self.names[0]), CONFIRMED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import utilities.job_factory as job_factory
+from utilities.job_factory import FileParameter
+from utilities.listing_cache import ListingCache, ListingEntry
+from utilities.tests.fakes import FakeFileService
+
+LOCATION = 'BLOB/container'
+
+
+def make_entries(*names):
+    return [ListingEntry(name, False, len(name), 0.0) for name in names]
+
+
+class ListingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'listings.db')
+        self.cache = ListingCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get('account', LOCATION))
+        entries = make_entries('a', 'b')
+        self.cache.put('account', LOCATION, '', '', entries)
+        self.assertEqual(sorted(self.cache.get('account', LOCATION)), entries)
+        self.assertIsNone(self.cache.get('other', LOCATION))
+        self.assertIsNone(self.cache.get('account', 'BLOB/other'))
+        self.assertIsNone(self.cache.get('account', LOCATION, 'directory'))
+
+    def test_shorter_prefix_answers_longer_prefix(self):
+        self.cache.put('account', LOCATION, '', 'cat',
+                       make_entries('cat_1', 'cats'))
+        self.assertEqual(self.cache.get('account', LOCATION, '', 'cat_'),
+                         make_entries('cat_1'))
+        self.assertIsNone(self.cache.get('account', LOCATION, '', 'ca'))
+
+    def test_put_replaces_covered_listings(self):
+        self.cache.put('account', LOCATION, '', 'cat_', make_entries('cat_1'))
+        self.cache.put('account', LOCATION, '', 'cat',
+                       make_entries('cat_2', 'cats'))
+        self.assertEqual(self.cache.get('account', LOCATION, '', 'cat_'),
+                         make_entries('cat_2'))
+
+    def test_expiry(self):
+        self.cache.put('account', LOCATION, '', '', make_entries('a'))
+        self.assertIsNone(self.cache.get('account', LOCATION, max_age=-1))
+        self.assertEqual(self.cache.get('account', LOCATION, max_age=None),
+                         make_entries('a'))
+
+    def test_invalidate(self):
+        self.cache.put('account', LOCATION, '', '', make_entries('a'))
+        self.cache.put('account', 'FILE/share', '', '', make_entries('b'))
+        self.cache.put('other', LOCATION, '', '', make_entries('c'))
+        self.cache.invalidate(location=LOCATION, account='account')
+        self.assertIsNone(self.cache.get('account', LOCATION))
+        self.assertIsNotNone(self.cache.get('account', 'FILE/share'))
+        self.assertIsNotNone(self.cache.get('other', LOCATION))
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get('other', LOCATION))
+
+    def test_persistence(self):
+        self.cache.put('account', LOCATION, '', '', make_entries('a'))
+        self.cache.close()
+        self.cache = ListingCache(self.path)
+        self.assertEqual(self.cache.get('account', LOCATION),
+                         make_entries('a'))
+
+
+class CachedFileParameterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ListingCache(os.path.join(self.directory, 'listings.db'))
+        self.service = FakeFileService({'a/1.txt': 1, 'a/2.txt': 2,
+                                        'b/3.txt': 3})
+        self.file_service = job_factory.FileService
+        job_factory.FileService = lambda account, key: self.service
+
+    def tearDown(self):
+        job_factory.FileService = self.file_service
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def make_parameter(self, **kwargs):
+        return FileParameter('FILE', 'account', 'key', 'FILE', 'data', 'JOB',
+                             fileshare='share', listing_cache=self.cache,
+                             **kwargs)
+
+    def test_listings_are_reused(self):
+        values = self.make_parameter().values
+        self.assertEqual(len(values), 3)
+        num_listings = len(self.service.listings)
+        self.service.files['a/4.txt'] = 4
+        self.assertEqual(self.make_parameter().values, values)
+        self.assertEqual(self.make_parameter(filter_str='a/').values,
+                         values[:2])
+        self.assertEqual(len(self.service.listings), num_listings)
+
+    def test_expired_listings_are_listed_again(self):
+        self.make_parameter()
+        self.service.files['a/4.txt'] = 4
+        self.assertEqual(len(self.make_parameter(max_listing_age=-1).values),
+                         4)
+
+    def test_invalidated_listings_are_listed_again(self):
+        self.make_parameter()
+        self.service.files['a/4.txt'] = 4
+        self.cache.invalidate('account', 'FILE/share')
+        self.assertEqual(len(self.make_parameter().values), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
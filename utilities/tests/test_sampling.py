@@ -0,0 +1,71 @@
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from utilities.job_factory import DiscreteParameter, NumericParameter, \
+    ParameterSweep
+from utilities.sampling import MAX_SOBOL_DIMS, HaltonSampler, SobolSampler, \
+    get_sampler
+
+
+class SamplerTest(unittest.TestCase):
+    def test_shape_and_range(self):
+        for method in ['RANDOM', 'SOBOL', 'HALTON']:
+            points = get_sampler(method, 3, seed=0).sample(100)
+            self.assertEqual(points.shape, (100, 3))
+            self.assertTrue(np.all((points >= 0) & (points < 1)), method)
+
+    def test_seed(self):
+        for method in ['RANDOM', 'SOBOL', 'HALTON']:
+            np.testing.assert_array_equal(
+                get_sampler(method, 2, seed=1).sample(10),
+                get_sampler(method, 2, seed=1).sample(10))
+
+    def test_consecutive_batches(self):
+        for method in ['SOBOL', 'HALTON']:
+            sampler = get_sampler(method, 2, seed=0)
+            batches = np.vstack([sampler.sample(3), sampler.sample(5)])
+            np.testing.assert_array_equal(
+                batches, get_sampler(method, 2, seed=0).sample(8))
+
+    def test_unscrambled_sequences(self):
+        np.testing.assert_array_equal(
+            SobolSampler(1, scramble=False).sample(4)[:, 0],
+            [0, 0.5, 0.75, 0.25])
+        np.testing.assert_allclose(
+            HaltonSampler(2, scramble=False).sample(3),
+            [[0.5, 1 / 3.0], [0.25, 2 / 3.0], [0.75, 1 / 9.0]])
+
+    def test_sobol_points_are_stratified(self):
+        points = get_sampler('SOBOL', 4, seed=0).sample(16)
+        for dim in range(4):
+            np.testing.assert_array_equal(
+                np.sort(np.floor(points[:, dim] * 16)), np.arange(16))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            SobolSampler(MAX_SOBOL_DIMS + 1)
+        with self.assertRaises(ValueError):
+            get_sampler('GRID', 2)
+
+
+class ParameterSweepSamplingTest(unittest.TestCase):
+    def test_generate_param_dicts(self):
+        parameter_sweep = ParameterSweep([
+            NumericParameter('LR', 'REAL', 1e-4, 1e-1, 'LOG'),
+            NumericParameter('LAYERS', 'INTEGER', 1, 4, 'LINEAR'),
+            DiscreteParameter('OPTIMIZER', ['sgd', 'adam'])])
+        for method in ['RANDOM', 'SOBOL', 'HALTON']:
+            param_dicts = list(parameter_sweep._generate_param_dicts(
+                num=20, seed=0, sampler=method))
+            self.assertEqual(len(param_dicts), 20)
+            for param_dict in param_dicts:
+                self.assertTrue(1e-4 <= param_dict['PARAM_LR'] <= 1e-1)
+                self.assertIn(param_dict['PARAM_LAYERS'], [1, 2, 3, 4])
+                self.assertIn(param_dict['PARAM_OPTIMIZER'], ['sgd', 'adam'])
+
+
+if __name__ == '__main__':
+    unittest.main()
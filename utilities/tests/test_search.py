@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from utilities.job_factory import DictParameter, DiscreteParameter, \
+    NumericParameter, ParameterSweep
+from utilities.search import TPESearch
+
+
+def make_parameter_sweep():
+    return ParameterSweep([
+        NumericParameter('X', 'REAL', 0, 1, 'LINEAR'),
+        DiscreteParameter('OPTIMIZER', ['sgd', 'adam', 'rmsprop']),
+        DictParameter('MODEL', [{'DEPTH': 1, 'WIDTH': 8},
+                                {'DEPTH': 2, 'WIDTH': 16}])])
+
+
+class TPESearchTest(unittest.TestCase):
+    def check_proposals(self, param_dicts, num):
+        self.assertEqual(len(param_dicts), num)
+        for param_dict in param_dicts:
+            self.assertTrue(0 <= param_dict['PARAM_X'] <= 1)
+            self.assertIn(param_dict['PARAM_OPTIMIZER'],
+                          ['sgd', 'adam', 'rmsprop'])
+            self.assertIn(param_dict['PARAM_MODEL__DEPTH'], [1, 2])
+
+    def test_startup_proposals_are_random(self):
+        search = TPESearch(make_parameter_sweep(), seed=0)
+        self.check_proposals(search.propose(5), 5)
+
+    def test_no_observations(self):
+        # Both the good and bad splits are empty
+        search = TPESearch(make_parameter_sweep(), num_startup_jobs=0,
+                           seed=0)
+        self.check_proposals(search.propose(3), 3)
+
+    def test_one_observation(self):
+        # The bad split is empty
+        search = TPESearch(make_parameter_sweep(), num_startup_jobs=0,
+                           seed=0)
+        search.observe(search.propose(1)[0], 0.5)
+        self.check_proposals(search.propose(3), 3)
+
+    def test_ignore_invalid_metrics(self):
+        search = TPESearch(make_parameter_sweep(), seed=0)
+        param_dict = search.propose(1)[0]
+        search.observe(param_dict, float('inf'))
+        search.observe(param_dict, None)
+        self.assertEqual(search.num_observations, 0)
+
+    def test_observe_environment_values(self):
+        search = TPESearch(make_parameter_sweep(), seed=0)
+        param_dict = search.propose(1)[0]
+        search.observe({name: str(value)
+                        for name, value in param_dict.items()}, 1.0)
+        self.assertEqual(search.num_observations, 1)
+
+    def test_converges_to_good_region(self):
+        search = TPESearch(make_parameter_sweep(), num_startup_jobs=10,
+                           seed=0)
+        for _ in range(6):
+            for param_dict in search.propose(5):
+                loss = (param_dict['PARAM_X'] - 0.2) ** 2
+                if param_dict['PARAM_OPTIMIZER'] != 'adam':
+                    loss += 1
+                search.observe(param_dict, loss)
+        proposals = search.propose(20)
+        self.assertLess(np.median([abs(p['PARAM_X'] - 0.2)
+                                   for p in proposals]), 0.2)
+        self.assertGreater(sum(p['PARAM_OPTIMIZER'] == 'adam'
+                               for p in proposals), 10)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            TPESearch(make_parameter_sweep(), gamma=1)
+        with self.assertRaises(ValueError):
+            TPESearch(make_parameter_sweep()).propose(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
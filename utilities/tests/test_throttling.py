@@ -0,0 +1,161 @@
+from __future__ import print_function
+
+import time
+import unittest
+
+from msrest.exceptions import ClientRequestError
+from msrestazure.azure_exceptions import CloudError
+
+from utilities.tests.fakes import FakeObject, FakeResponse, cloud_error
+from utilities.throttling import AdaptiveConcurrencyLimiter, \
+    RequestThrottle, RetryPolicy, TokenBucket, get_retry_after, \
+    is_congestion_error
+
+
+class AdaptiveConcurrencyLimiterTest(unittest.TestCase):
+    def test_acquire_up_to_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2)
+        self.assertTrue(limiter.try_acquire())
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        self.assertEqual(limiter.in_flight, 2)
+        limiter.release()
+        self.assertEqual(limiter.in_flight, 1)
+        self.assertEqual(limiter.limit, 2)
+        self.assertTrue(limiter.try_acquire())
+
+    def test_additive_increase(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2)
+        # Each success adds 1 / limit: 2 -> 2.5 -> 2.9 -> 3.24
+        for _ in range(3):
+            limiter.try_acquire()
+            limiter.on_success(1.0)
+        self.assertEqual(limiter.limit, 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+        limiter.try_acquire()
+        limiter.on_congestion()
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_decrease_once_per_congestion_event(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+        for _ in range(3):
+            limiter.try_acquire()
+        limiter.on_success(10.0)
+        limiter.on_congestion()
+        limiter.on_congestion()
+        self.assertEqual(limiter.limit, 4)
+
+    def test_slow_request_decreases_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+        limiter.try_acquire()
+        limiter.on_success(0.001)
+        limiter.try_acquire()
+        limiter.on_success(1.0)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_limit_bounds(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, min_limit=2,
+                                             max_limit=3)
+        limiter.try_acquire()
+        limiter.on_congestion()
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(10):
+            limiter.try_acquire()
+            limiter.on_success(1.0)
+        self.assertEqual(limiter.limit, 3)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrencyLimiter(min_limit=0)
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrencyLimiter(min_limit=4, max_limit=2)
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrencyLimiter(backoff_ratio=1)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=20, capacity=2)
+        started = time.time()
+        bucket.acquire()
+        bucket.acquire()
+        self.assertLess(time.time() - started, 0.04)
+        bucket.acquire()
+        self.assertGreaterEqual(time.time() - started, 0.04)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=1000, capacity=10)
+        bucket.pause(0.1)
+        started = time.time()
+        bucket.acquire()
+        self.assertGreaterEqual(time.time() - started, 0.09)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0)
+        with self.assertRaises(ValueError):
+            TokenBucket(capacity=0)
+
+
+class RequestThrottleTest(unittest.TestCase):
+    def setUp(self):
+        self.throttle = RequestThrottle(
+            TokenBucket(rate=1e6, capacity=1e6),
+            RetryPolicy(max_retries=2, base_delay=0, max_delay=0))
+        self.calls = 0
+
+    def fail(self, errors):
+        def func(value):
+            self.calls += 1
+            if errors:
+                raise errors.pop(0)
+            return value
+        return func
+
+    def test_retry_retryable_errors(self):
+        func = self.fail([cloud_error(503), ClientRequestError('reset')])
+        self.assertEqual(self.throttle.call(func, 'result'), 'result')
+        self.assertEqual(self.calls, 3)
+
+    def test_give_up_after_max_retries(self):
+        func = self.fail([cloud_error(429) for _ in range(3)])
+        with self.assertRaises(CloudError):
+            self.throttle.call(func, 'result')
+        self.assertEqual(self.calls, 3)
+
+    def test_do_not_retry_other_errors(self):
+        func = self.fail([cloud_error(400)])
+        with self.assertRaises(CloudError):
+            self.throttle.call(func, 'result')
+        self.assertEqual(self.calls, 1)
+
+    def test_backoff_pauses_on_retry_after(self):
+        error = cloud_error(429, {'Retry-After': '0.1'})
+        self.assertEqual(self.throttle.backoff(error, 0), 0.1)
+        started = time.time()
+        self.throttle.acquire()
+        self.assertGreaterEqual(time.time() - started, 0.09)
+
+
+class ErrorClassificationTest(unittest.TestCase):
+    def test_is_congestion_error(self):
+        self.assertTrue(is_congestion_error(cloud_error(429)))
+        self.assertTrue(is_congestion_error(cloud_error(503)))
+        self.assertFalse(is_congestion_error(cloud_error(404)))
+        self.assertFalse(is_congestion_error(ValueError()))
+
+    def test_get_retry_after(self):
+        error = FakeObject(response=FakeResponse(429, {'Retry-After': '5'}))
+        self.assertEqual(get_retry_after(error), 5)
+        error = FakeObject(response=FakeResponse(
+            429, {'Retry-After': 'invalid'}))
+        self.assertIsNone(get_retry_after(error))
+        self.assertIsNone(get_retry_after(ValueError()))
+
+
+if __name__ == '__main__':
+    unittest.main()
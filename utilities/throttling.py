@@ -0,0 +1,332 @@
+from __future__ import print_function
+
+import email.utils
+import random
+import threading
+import time
+
+import requests
+from msrest.exceptions import ClientRequestError
+from msrestazure.azure_exceptions import CloudError
+
+INITIAL_CONCURRENCY = 8
+LATENCY_TOLERANCE = 2.0
+BACKOFF_RATIO = 0.5
+BASELINE_DRIFT = 0.01
+REQUESTS_PER_SEC = 20
+BURST_SIZE = 40
+NUM_RETRIES = 5
+BASE_DELAY_SECS = 1
+MAX_DELAY_SECS = 60
+RETRYABLE_STATUS_CODES = (408, 429)
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """
+    AIMD (additive increase, multiplicative decrease) controller for the
+    number of requests allowed in flight against a service.
+
+    The limit grows by roughly one request per window of successful
+    requests, and is cut by backoff_ratio whenever the service signals
+    congestion (throttling, 5xx) or a request takes much longer than the
+    best latency observed recently.
+    """
+
+    def __init__(self, initial_limit=INITIAL_CONCURRENCY, min_limit=1,
+                 max_limit=None, backoff_ratio=BACKOFF_RATIO,
+                 latency_tolerance=LATENCY_TOLERANCE):
+        """
+        :param initial_limit: number of requests allowed in flight at start
+        :param min_limit: lower bound of the limit
+        :param max_limit: upper bound of the limit. If None, the limit is
+        unbounded.
+        :param backoff_ratio: factor the limit is multiplied by on congestion
+        :param latency_tolerance: a request slower than latency_tolerance
+        times the baseline latency is treated as a congestion signal
+        """
+        if min_limit < 1:
+            raise ValueError("Minimum limit must be at least 1")
+        if max_limit is not None and max_limit < min_limit:
+            raise ValueError("Maximum limit must not be less than minimum")
+        if not 0 < backoff_ratio < 1:
+            raise ValueError("Backoff ratio must be between 0 and 1")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(self._clamp(initial_limit))
+        self._in_flight = 0
+        self._baseline_latency = None
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        """Current number of requests allowed in flight."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        """Number of requests currently in flight."""
+        return self._in_flight
+
+    def try_acquire(self):
+        """
+        Reserve a slot for a request if the limit allows it.
+
+        :return: True if a slot was reserved, False otherwise
+        """
+        with self._lock:
+            if self._in_flight < int(self._limit):
+                self._in_flight += 1
+                return True
+            return False
+
+    def on_success(self, latency):
+        """
+        Release a slot after a successful request.
+
+        :param latency: duration of the request in seconds
+        """
+        with self._lock:
+            self._in_flight -= 1
+            if self._baseline_latency is None:
+                self._baseline_latency = latency
+            else:
+                # Let the baseline drift up slowly so that it follows the
+                # service if it becomes permanently slower.
+                self._baseline_latency = min(
+                    latency, self._baseline_latency * (1 + BASELINE_DRIFT))
+            if latency > self.latency_tolerance * self._baseline_latency:
+                self._decrease()
+            else:
+                self._limit = self._clamp(self._limit + 1.0 / self._limit)
+
+    def on_congestion(self):
+        """Release a slot after a request was throttled or failed with 5xx."""
+        with self._lock:
+            self._in_flight -= 1
+            self._decrease()
+
+    def release(self):
+        """
+        Release a slot without adjusting the limit, e.g. after a request
+        failed for a reason unrelated to load.
+        """
+        with self._lock:
+            self._in_flight -= 1
+
+    def _decrease(self):
+        # Congestion signals from requests that were already in flight when
+        # the limit was cut describe the same event; only react once per
+        # baseline latency.
+        now = time.time()
+        if now - self._last_decrease < (self._baseline_latency or 0):
+            return
+        self._last_decrease = now
+        self._limit = self._clamp(self._limit * self.backoff_ratio)
+
+    def _clamp(self, limit):
+        limit = max(self.min_limit, limit)
+        if self.max_limit is not None:
+            limit = min(self.max_limit, limit)
+        return limit
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter. Tokens are added at a constant
+    rate up to a maximum burst size; each request consumes one token.
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SEC, capacity=BURST_SIZE):
+        """
+        :param rate: number of tokens added per second
+        :param capacity: maximum number of tokens in the bucket
+        """
+        if rate <= 0 or capacity < 1:
+            raise ValueError("Rate and capacity must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last_refill = time.time()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and consume it.
+
+        :return: None
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now,
+                           (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for the given number of seconds, e.g. when
+        the service responded with a Retry-After header.
+
+        :param seconds: number of seconds to pause for
+        :return: None
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     time.time() + seconds)
+            self._tokens = 0
+
+    def _refill(self, now):
+        elapsed = max(0, now - max(self._last_refill, self._paused_until))
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._last_refill = max(now, self._last_refill)
+
+
+class RetryPolicy(object):
+    """
+    Decides which errors are retried and how long to wait before each
+    retry: exponential backoff with full jitter, or the delay requested by
+    the service in a Retry-After header.
+    """
+
+    def __init__(self, max_retries=NUM_RETRIES, base_delay=BASE_DELAY_SECS,
+                 max_delay=MAX_DELAY_SECS):
+        """
+        :param max_retries: number of retries before an error is raised
+        :param base_delay: delay in seconds before the first retry
+        :param max_delay: maximum delay in seconds between retries
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error):
+        """
+        Whether the request that raised error can be retried: throttling,
+        timeouts, 5xx responses and connection failures.
+        """
+        if isinstance(error, CloudError):
+            return is_congestion_error(error) or \
+                error.status_code in RETRYABLE_STATUS_CODES
+        return isinstance(error, (ClientRequestError,
+                                  requests.exceptions.ConnectionError,
+                                  requests.exceptions.Timeout))
+
+    def get_delay(self, attempt, error=None):
+        """
+        Number of seconds to wait before retrying.
+
+        :param attempt: number of retries already made
+        :param error: the error raised by the last attempt
+        """
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, backoff)
+
+
+class RequestThrottle(object):
+    """
+    Rate limiter and retry policy applied together to requests against a
+    service. One instance is meant to be shared by all callers talking to
+    the same endpoint, see get_default_throttle.
+    """
+
+    def __init__(self, rate_limiter=None, retry_policy=None):
+        """
+        :param rate_limiter: a TokenBucket. If None, a TokenBucket with
+        default rate is used.
+        :param retry_policy: a RetryPolicy. If None, a RetryPolicy with
+        default settings is used.
+        """
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def acquire(self):
+        """Block until the rate limiter allows another request."""
+        self.rate_limiter.acquire()
+
+    def backoff(self, error, attempt):
+        """
+        Compute the delay before retrying after error. If the service asked
+        for a delay with Retry-After, all requests sharing this throttle are
+        paused for that long.
+
+        :param error: the error raised by the last attempt
+        :param attempt: number of retries already made
+        :return: number of seconds to wait before retrying
+        """
+        delay = self.retry_policy.get_delay(attempt, error)
+        if get_retry_after(error) is not None:
+            self.rate_limiter.pause(delay)
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), waiting for the rate limiter before each
+        attempt and retrying retryable errors.
+
+        :return: the return value of func
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if (attempt >= self.retry_policy.max_retries or
+                        not self.retry_policy.is_retryable(e)):
+                    raise
+                time.sleep(self.backoff(e, attempt))
+                attempt += 1
+
+
+_default_throttle = None
+_default_throttle_lock = threading.Lock()
+
+
+def get_default_throttle():
+    """
+    Returns the RequestThrottle shared by all utilities in this process
+    which do not receive an explicit throttle.
+    """
+    global _default_throttle
+    with _default_throttle_lock:
+        if _default_throttle is None:
+            _default_throttle = RequestThrottle()
+        return _default_throttle
+
+
+def is_congestion_error(error):
+    """Whether error is a throttling (429) or server-side (5xx) error."""
+    return isinstance(error, CloudError) and (
+        error.status_code == 429 or error.status_code >= 500)
+
+
+def get_retry_after(error):
+    """
+    Returns the number of seconds requested by the Retry-After header of the
+    response that caused error, or None if there is no such header.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())